@@ -1,13 +1,40 @@
-from flask import Flask, redirect, url_for, session, request, jsonify, send_file
+from flask import Flask, Response, g, redirect, url_for, session, request, jsonify, send_file
 from flask_sqlalchemy import SQLAlchemy
+from flask_jwt_extended import JWTManager, create_access_token
 from authlib.integrations.flask_client import OAuth
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 import os
-import requests
 import datetime
-import json
-import io
 import logging
+import unicodedata
+import uuid
+import io
+import time
+import signal
+import threading
+from urllib.parse import quote
 from flask_cors import CORS
+from transfer import TransferError, ChunkRing, MappedChunks, MemoryBudget, choose_chunk_size, source_chunks, file_chunks
+from jobs import TransferQueue, TRANSFER_DIRECTIONS
+from clients import configure_clients
+from changes import ChangeFeedError, start_cursor
+from metadata_cache import MetadataCache
+from listings import ListingError, ITEMS_KEY, parse_fields, parse_page_size, project, stream_listing
+from file_index import DriveIndexer, ROW_BUILDERS, entry_dict
+from drive_sync import (SyncScheduler, SYNC_MODES, CONFLICT_POLICIES, install_sync_indexes, next_run_time,
+                        normalize_root, parse_schedule)
+from search import FileSearch, SEARCH_MODES, install_search_index
+from fingerprints import ContentHasher, FingerprintStore, native_hashes
+from tree_transfer import copy_tree, is_folder
+from tokens import TokenManager, TokenRefreshError
+from users import UserCache, request_user_id
+from uploads import SpoolingRequest, is_spooled
+from preview_cache import PREVIEW_SIZES, PreviewCache
+from content_cache import ContentCache, content_revision
+from metrics import ROUTE_LATENCY, render as render_metrics
+from providers import get_provider
+from compression import EncodedBody, send_encoded
 
 # Configure logging
 logging.basicConfig(
@@ -20,13 +47,152 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.secret_key = os.getenv("SECRET_KEY", "your_secret_key")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///users.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///users.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Bytes of a SQLite database read through mmap rather than copied into each connection's
+# page cache; searches of a large index fetch rows all over the file (0 turns it off)
+app.config["SQLITE_MMAP_SIZE"] = int(os.getenv("SQLITE_MMAP_SIZE", 1024 * 1024 * 1024))
+# Upper bound on bytes held in memory per proxied download chunk
+app.config["DOWNLOAD_CHUNK_SIZE"] = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 256 * 1024))
+# Uploads and transfers send chunks between TRANSFER_CHUNK_SIZE and TRANSFER_MAX_CHUNK_SIZE
+# (multiples of 1280 KiB, growing with file size) and hold at most TRANSFER_BUFFERS of them
+app.config["TRANSFER_CHUNK_SIZE"] = int(os.getenv("TRANSFER_CHUNK_SIZE", 1280 * 1024))
+app.config["TRANSFER_MAX_CHUNK_SIZE"] = int(os.getenv("TRANSFER_MAX_CHUNK_SIZE", 5 * 1024 * 1024))
+app.config["TRANSFER_BUFFERS"] = int(os.getenv("TRANSFER_BUFFERS", 3))
+# Upload requests larger than UPLOAD_SPOOL_THRESHOLD bytes are written to a temp file in
+# UPLOAD_SPOOL_DIR (default: the system temp dir) and sent from a memory map of it
+app.config["UPLOAD_SPOOL_THRESHOLD"] = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", 1024 * 1024))
+app.config["UPLOAD_SPOOL_DIR"] = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Chunk memory all in-progress uploads may hold together; further uploads wait their turn
+app.config["UPLOAD_MEMORY_BUDGET"] = int(os.getenv("UPLOAD_MEMORY_BUDGET", 256 * 1024 * 1024))
+# Transfer jobs running at once, overall and against each provider
+app.config["TRANSFER_WORKERS"] = int(os.getenv("TRANSFER_WORKERS", 4))
+app.config["TRANSFER_PROVIDER_LIMITS"] = {
+    'google': int(os.getenv("GOOGLE_TRANSFER_LIMIT", 4)),
+    'onedrive': int(os.getenv("ONEDRIVE_TRANSFER_LIMIT", 4))
+}
+# OAuth tokens are refreshed in the background this many seconds before they
+# expire; the refresher checks every TOKEN_REFRESH_INTERVAL seconds
+app.config["TOKEN_REFRESH_MARGIN"] = int(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+app.config["TOKEN_REFRESH_INTERVAL"] = int(os.getenv("TOKEN_REFRESH_INTERVAL", 60))
+# Access tokens kept in memory, and seconds one is kept after it was loaded or refreshed;
+# the refresher only keeps the tokens still held ahead of expiry
+app.config["TOKEN_CACHE_SIZE"] = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+app.config["TOKEN_CACHE_TTL"] = int(os.getenv("TOKEN_CACHE_TTL", 900))
+# API clients can swap a signed-in session for a JWT (POST /auth/token) valid this many seconds
+app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", app.secret_key)
+app.config["JWT_ACCESS_TOKEN_EXPIRES"] = datetime.timedelta(seconds=int(os.getenv("JWT_ACCESS_TOKEN_EXPIRES", 3600)))
+# Signed-in users kept in memory, and seconds before a cached user row is re-read
+app.config["USER_CACHE_SIZE"] = int(os.getenv("USER_CACHE_SIZE", 10000))
+app.config["USER_CACHE_TTL"] = int(os.getenv("USER_CACHE_TTL", 300))
+# Folder transfers: source folders listed (and destination folders created) at once
+app.config["TREE_CRAWL_WORKERS"] = int(os.getenv("TREE_CRAWL_WORKERS", 8))
+# Batch endpoints: most files per call, and provider batch requests sent at once
+app.config["BATCH_MAX_ITEMS"] = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+app.config["BATCH_CONCURRENCY"] = int(os.getenv("BATCH_CONCURRENCY", 4))
+# Pooled provider HTTP clients: connection limits, keep-alive, HTTP/2 and timeouts (seconds)
+app.config["HTTP_MAX_CONNECTIONS"] = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+app.config["HTTP_MAX_KEEPALIVE_CONNECTIONS"] = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 10))
+app.config["HTTP_KEEPALIVE_EXPIRY"] = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+app.config["HTTP2_ENABLED"] = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+app.config["HTTP_CONNECT_TIMEOUT"] = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+app.config["HTTP_TIMEOUT"] = float(os.getenv("HTTP_TIMEOUT", 60))
+# Provider requests per second the clients pace themselves to. A throttling response halves the
+# rate, which then climbs back over HTTP_RATE_RECOVERY seconds
+app.config["HTTP_RATE_LIMITS"] = {
+    'google': float(os.getenv("GOOGLE_RATE_LIMIT", 100)),
+    'onedrive': float(os.getenv("ONEDRIVE_RATE_LIMIT", 50))
+}
+app.config["HTTP_RATE_RECOVERY"] = float(os.getenv("HTTP_RATE_RECOVERY", 30))
+# Retries of throttled, failed or dropped provider requests, with jittered exponential backoff (seconds)
+app.config["HTTP_MAX_RETRIES"] = int(os.getenv("HTTP_MAX_RETRIES", 5))
+app.config["HTTP_BACKOFF_BASE"] = float(os.getenv("HTTP_BACKOFF_BASE", 0.5))
+app.config["HTTP_BACKOFF_MAX"] = float(os.getenv("HTTP_BACKOFF_MAX", 60))
+# Connection pool per provider for the ASGI app (asgi.py), which runs every download and transfer at once
+app.config["ASYNC_HTTP_MAX_CONNECTIONS"] = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 500))
+app.config["ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS"] = int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS", 100))
+# Pools each provider's async connections are split across, to keep httpx's per-request pool bookkeeping cheap
+app.config["ASYNC_HTTP_POOL_SHARDS"] = int(os.getenv("ASYNC_HTTP_POOL_SHARDS", 10))
+# File metadata cache: entries kept, seconds they live, and how often a cached
+# listing is checked against the provider change feed
+app.config["METADATA_CACHE_SIZE"] = int(os.getenv("METADATA_CACHE_SIZE", 10000))
+app.config["METADATA_CACHE_TTL"] = int(os.getenv("METADATA_CACHE_TTL", 300))
+app.config["METADATA_CHANGE_CHECK_INTERVAL"] = int(os.getenv("METADATA_CHANGE_CHECK_INTERVAL", 15))
+# Seconds between incremental syncs of the local file index
+app.config["INDEX_SYNC_INTERVAL"] = int(os.getenv("INDEX_SYNC_INTERVAL", 60))
+# Scheduled drive syncs: copies and deletes in flight per run, and seconds
+# without a heartbeat before another process may take over a run
+app.config["SYNC_WORKERS"] = int(os.getenv("SYNC_WORKERS", 4))
+app.config["SYNC_STALE_AFTER"] = int(os.getenv("SYNC_STALE_AFTER", 600))
+# Start the token refresher, transfer queue, indexer and sync scheduler in every
+# process that imports the app (e.g. each gunicorn worker), rather than only in
+# `flask --app app worker`; off by default so web processes just serve requests
+app.config["BACKGROUND_SERVICES"] = os.getenv("BACKGROUND_SERVICES", "false").lower() == "true"
+# Searches matching more files than this skip ranking/sorting and return in index order
+app.config["SEARCH_RANK_LIMIT"] = int(os.getenv("SEARCH_RANK_LIMIT", 5000))
+# Finish a transfer without copying when an identical file is already at the destination
+app.config["TRANSFER_SKIP_IDENTICAL"] = os.getenv("TRANSFER_SKIP_IDENTICAL", "true").lower() == "true"
+# Thumbnails served by /preview are kept in PREVIEW_CACHE_DIR, up to PREVIEW_CACHE_MAX_BYTES
+# (least recently used go first); browsers reuse one for PREVIEW_MAX_AGE seconds, then revalidate by ETag
+app.config["PREVIEW_CACHE_DIR"] = os.getenv("PREVIEW_CACHE_DIR", os.path.join(app.instance_path, 'previews'))
+app.config["PREVIEW_CACHE_MAX_BYTES"] = int(os.getenv("PREVIEW_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+app.config["PREVIEW_MAX_AGE"] = int(os.getenv("PREVIEW_MAX_AGE", 7 * 24 * 3600))
+# JSON responses to GETs of at least COMPRESS_MIN_SIZE bytes are sent with brotli, zstd or gzip,
+# as the client accepts, at these levels
+app.config["COMPRESS_MIN_SIZE"] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+app.config["COMPRESS_LEVELS"] = {
+    'br': int(os.getenv("COMPRESS_BROTLI_LEVEL", 5)),
+    'zstd': int(os.getenv("COMPRESS_ZSTD_LEVEL", 3)),
+    'gzip': int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+}
+# Optional disk cache of downloaded content, keyed by file revision: up to CONTENT_CACHE_MAX_BYTES
+# (0 turns it off) in CONTENT_CACHE_DIR; files over CONTENT_CACHE_MAX_FILE_SIZE are never cached
+app.config["CONTENT_CACHE_DIR"] = os.getenv("CONTENT_CACHE_DIR", os.path.join(app.instance_path, 'content'))
+app.config["CONTENT_CACHE_MAX_BYTES"] = int(os.getenv("CONTENT_CACHE_MAX_BYTES", 0))
+app.config["CONTENT_CACHE_MAX_FILE_SIZE"] = int(os.getenv("CONTENT_CACHE_MAX_FILE_SIZE", 512 * 1024 * 1024))
 db = SQLAlchemy(app)
+
+def configure_sqlite(dbapi_connection, _):
+    dbapi_connection.execute(f'PRAGMA mmap_size = {app.config["SQLITE_MMAP_SIZE"]}')
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', configure_sqlite)
+
 oauth = OAuth(app)
+jwt = JWTManager(app)
 CORS(app, allow_origins=["*"], supports_credentials=True)
 
+configure_clients(
+    max_connections=app.config["HTTP_MAX_CONNECTIONS"],
+    max_keepalive_connections=app.config["HTTP_MAX_KEEPALIVE_CONNECTIONS"],
+    keepalive_expiry=app.config["HTTP_KEEPALIVE_EXPIRY"],
+    http2=app.config["HTTP2_ENABLED"],
+    connect_timeout=app.config["HTTP_CONNECT_TIMEOUT"],
+    timeout=app.config["HTTP_TIMEOUT"],
+    rate_limits=app.config["HTTP_RATE_LIMITS"],
+    rate_recovery=app.config["HTTP_RATE_RECOVERY"],
+    max_retries=app.config["HTTP_MAX_RETRIES"],
+    backoff_base=app.config["HTTP_BACKOFF_BASE"],
+    backoff_max=app.config["HTTP_BACKOFF_MAX"]
+)
+
+preview_cache = PreviewCache(app.config["PREVIEW_CACHE_DIR"], app.config["PREVIEW_CACHE_MAX_BYTES"])
+
+content_cache = ContentCache(
+    app.config["CONTENT_CACHE_DIR"],
+    app.config["CONTENT_CACHE_MAX_BYTES"],
+    app.config["CONTENT_CACHE_MAX_FILE_SIZE"]
+) if app.config["CONTENT_CACHE_MAX_BYTES"] else None
+
+metadata_cache = MetadataCache(
+    maxsize=app.config["METADATA_CACHE_SIZE"],
+    ttl=app.config["METADATA_CACHE_TTL"],
+    check_interval=app.config["METADATA_CHANGE_CHECK_INTERVAL"]
+)
+
 # Frontend URL for redirect after auth
 FRONTEND_URL = "http://localhost:5173"
 
@@ -56,10 +222,355 @@ onedrive = oauth.register(
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(150), nullable=False)
+    email = db.Column(db.String(150), nullable=False, unique=True)
     google_token = db.Column(db.JSON)
     onedrive_token = db.Column(db.JSON)
 
+user_cache = UserCache(db, User, maxsize=app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"])
+
+def current_user():
+    """The signed-in user of this request (a cached snapshot), or None."""
+    if 'current_user' not in g:
+        user_id = request_user_id()
+        g.current_user = user_cache.get(user_id) if user_id is not None else None
+    return g.current_user
+
+def refresh_with(client):
+    def refresh(refresh_token):
+        return client.fetch_access_token(grant_type='refresh_token', refresh_token=refresh_token)
+    return refresh
+
+token_manager = TokenManager(
+    app, db, User, {'google': refresh_with(google), 'onedrive': refresh_with(onedrive)},
+    refresh_margin=app.config["TOKEN_REFRESH_MARGIN"],
+    check_interval=app.config["TOKEN_REFRESH_INTERVAL"],
+    maxsize=app.config["TOKEN_CACHE_SIZE"],
+    ttl=app.config["TOKEN_CACHE_TTL"]
+)
+
+@app.errorhandler(TokenRefreshError)
+def token_refresh_failed(e):
+    return jsonify({"error": e.message}), 401
+
+class TransferJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    direction = db.Column(db.String(32), nullable=False)
+    # file, or folder for a recursive transfer that queues a file job per file it finds
+    kind = db.Column(db.String(16), nullable=False, default='file')
+    file_id = db.Column(db.String(255), nullable=False)
+    file_name = db.Column(db.String(255))
+    # The folder job a file job was queued by, and the destination folder to put the copy in
+    tree_id = db.Column(db.String(32), db.ForeignKey('transfer_job.id'))
+    destination_parent_id = db.Column(db.String(255))
+    # queued -> running -> completed | failed
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    bytes_total = db.Column(db.BigInteger)
+    bytes_done = db.Column(db.BigInteger, nullable=False, default=0)
+    error = db.Column(db.Text)
+    result = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_transfer_job_status_created', 'status', 'created_at'),
+        db.Index('ix_transfer_job_tree', 'tree_id', 'status'),
+    )
+
+class IndexedFile(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    provider = db.Column(db.String(16), primary_key=True)
+    file_id = db.Column(db.String(255), primary_key=True)
+    name = db.Column(db.Text, nullable=False)
+    size = db.Column(db.BigInteger)
+    mime_type = db.Column(db.String(255))
+    is_folder = db.Column(db.Boolean, nullable=False, default=False)
+    parent_id = db.Column(db.String(255))
+    # Slash-separated path from the drive root, maintained by the indexer
+    path = db.Column(db.Text)
+    modified_time = db.Column(db.DateTime)
+    # md5 for Google Drive, quickXorHash (or sha1) for OneDrive
+    content_hash = db.Column(db.String(128))
+    hash_algorithm = db.Column(db.String(16))
+    indexed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_indexed_file_parent', 'user_id', 'provider', 'parent_id', 'name'),
+        db.Index('ix_indexed_file_hash', 'user_id', 'provider', 'content_hash'),
+    )
+
+class IndexSyncState(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    provider = db.Column(db.String(16), primary_key=True)
+    # Drive changes page token or Graph delta link for the next incremental sync
+    cursor = db.Column(db.Text)
+    # Position in an unfinished full crawl, so it can carry on after a restart
+    crawl_cursor = db.Column(db.Text)
+    crawl_started_at = db.Column(db.DateTime)
+    full_synced_at = db.Column(db.DateTime)
+    synced_at = db.Column(db.DateTime)
+    root_id = db.Column(db.String(255))
+    error = db.Column(db.Text)
+
+class ContentFingerprint(db.Model):
+    # Hashes of a file's content under both providers' algorithms, recorded when it was transferred
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    provider = db.Column(db.String(16), primary_key=True)
+    file_id = db.Column(db.String(255), primary_key=True)
+    name = db.Column(db.Text)
+    size = db.Column(db.BigInteger)
+    md5 = db.Column(db.String(32))
+    quick_xor_hash = db.Column(db.String(28))
+    recorded_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_content_fingerprint_md5', 'user_id', 'provider', 'md5'),
+        db.Index('ix_content_fingerprint_quick_xor_hash', 'user_id', 'provider', 'quick_xor_hash'),
+    )
+
+class SyncJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(255))
+    # gdrive-to-onedrive or onedrive-to-gdrive (one-way), or two-way
+    mode = db.Column(db.String(32), nullable=False)
+    # The folder synced on each drive, as an index path; '' for the whole drive
+    google_path = db.Column(db.Text, nullable=False, default='')
+    onedrive_path = db.Column(db.Text, nullable=False, default='')
+    # Five-field crontab expression, in the server's time zone
+    schedule = db.Column(db.String(255), nullable=False)
+    # newer, google, onedrive or skip: what a two-way sync does when both sides changed
+    conflict_policy = db.Column(db.String(16), nullable=False, default='newer')
+    propagate_deletes = db.Column(db.Boolean, nullable=False, default=False)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    # Index rows written since this changed after the last clean run; None until the first
+    index_watermark = db.Column(db.DateTime)
+    # Set while a run is in progress, and kept fresh by it
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+
+class SyncRun(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    sync_id = db.Column(db.String(32), db.ForeignKey('sync_job.id'), nullable=False)
+    # running -> completed | completed_with_errors | failed
+    status = db.Column(db.String(32), nullable=False)
+    # Counts by outcome, and the changes made
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_sync_run_sync_started', 'sync_id', 'started_at'),
+    )
+
+class SyncedFile(db.Model):
+    # A sync job's baseline: what each side held at a path (relative to its folder) after the last run
+    sync_id = db.Column(db.String(32), db.ForeignKey('sync_job.id'), primary_key=True)
+    path = db.Column(db.Text, primary_key=True)
+    google_id = db.Column(db.String(255))
+    google_hash = db.Column(db.String(128))
+    onedrive_id = db.Column(db.String(255))
+    onedrive_hash = db.Column(db.String(128))
+    size = db.Column(db.BigInteger)
+    synced_at = db.Column(db.DateTime, nullable=False)
+
+fingerprint_store = FingerprintStore(db, ContentFingerprint, IndexedFile)
+
+upload_budget = MemoryBudget(app.config["UPLOAD_MEMORY_BUDGET"])
+
+def transfer_chunk_size(total_size):
+    return choose_chunk_size(total_size, app.config["TRANSFER_CHUNK_SIZE"], app.config["TRANSFER_MAX_CHUNK_SIZE"])
+
+def transfer_ring(total_size):
+    return ChunkRing(transfer_chunk_size(total_size), app.config["TRANSFER_BUFFERS"])
+
+def upload_chunks(file, chunk_size, hasher):
+    # Spooled uploads are sent straight from a mapping of the temp file; small ones go through a ring
+    if is_spooled(file.stream):
+        return MappedChunks(file.stream, chunk_size, app.config["TRANSFER_BUFFERS"], hasher)
+    return file_chunks(file.stream, ChunkRing(chunk_size, app.config["TRANSFER_BUFFERS"]), hasher)
+
+def uploaded_file_size(file):
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    return size
+
+def file_metadata(user, provider, file_id, fields=('name',), cached=True):
+    """Metadata for a file from the cache, else from the provider; None if not found."""
+    item = metadata_cache.get(user.id, provider, file_id, fields) if cached else None
+    if item is not None:
+        return item
+    
+    item = get_provider(provider).stat(token_manager.access_token(user, provider), file_id)
+    if item is None:
+        return None
+    metadata_cache.put_many(user.id, provider, [item])
+    return item
+
+def listing_body(provider, body, items, next_cursor, fields):
+    return {**body, ITEMS_KEY[provider]: project(items, fields), 'next_cursor': next_cursor}
+
+def cached_pages(user_id, provider, pages):
+    for items in pages:
+        metadata_cache.put_many(user_id, provider, items)
+        yield items
+
+def list_files(user, provider, access_token):
+    """Listing endpoint shared by both providers.
+
+    Query parameters: fields (comma-separated item fields), page_size, cursor
+    (next_cursor from the previous page), and all=1 to follow every page and
+    stream the merged items, as NDJSON or with format=json as one JSON object.
+    The default first page is always fetched with full fields so it can be
+    served from the metadata cache; projection is applied on the way out.
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        page_size = parse_page_size(provider, request.args.get('page_size'))
+    except ListingError as e:
+        return jsonify({"error": e.message}), e.status
+    cursor = request.args.get('cursor')
+
+    if request.args.get('all', '').lower() in ('1', 'true'):
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in ('ndjson', 'json'):
+            return jsonify({"error": "format must be ndjson or json"}), 400
+        pages = get_provider(provider).list_all(access_token, fields)
+        if fields is None:
+            pages = cached_pages(user.id, provider, pages)
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+        return Response(stream_listing(provider, pages, fmt), mimetype=mimetype)
+
+    if cursor or page_size:
+        try:
+            body, items, next_cursor = get_provider(provider).list(access_token, fields, page_size, cursor)
+        except ListingError as e:
+            logger.error(f"{e.message}: {e.status}")
+            return jsonify({"error": e.message}), e.status
+        if fields is None:
+            metadata_cache.put_many(user.id, provider, items)
+        return jsonify(listing_body(provider, body, items, next_cursor, None))
+
+    listing = metadata_cache.get_listing(user.id, provider, access_token)
+    if listing is None:
+        change_cursor = listing_cursor(provider, access_token)
+        try:
+            body, items, next_cursor = get_provider(provider).list(access_token)
+        except ListingError as e:
+            logger.error(f"{e.message}: {e.status}")
+            return jsonify({"error": e.message}), e.status
+        listing = metadata_cache.put_listing(user.id, provider, listing_body(provider, body, items, next_cursor, None),
+                                             items, change_cursor)
+    # Rendered once per projection while the listing stays cached; repeat polls reuse it and its ETag
+    key = tuple(fields) if fields else None
+    encoded = listing.renders.get(key)
+    if encoded is None:
+        body = listing.body
+        encoded = listing.renders[key] = EncodedBody(app.json.dumps(
+            listing_body(provider, body, body[ITEMS_KEY[provider]], body['next_cursor'], fields)).encode())
+    return encoded_json(encoded)
+
+def listing_cursor(provider, access_token):
+    # Taken before listing so no change made during the listing is missed
+    try:
+        return start_cursor(provider, access_token)
+    except ChangeFeedError as e:
+        logger.warning(f"Not caching {provider} listing: {e.message}")
+        return None
+
+# Response headers passed through from the provider to the client on downloads
+DOWNLOAD_PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+def attachment_disposition(file_name):
+    # Same encoding send_file uses, so non-ASCII names survive the header
+    try:
+        file_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', file_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(file_name, safe='!#$&+^`|~')}"}
+    return {'filename': file_name}
+
+def cached_content(provider, file_id, metadata, file_name):
+    """The file served from the content cache, or None on a miss (or with the cache off)."""
+    revision = content_revision(provider, metadata) if content_cache else None
+    path = content_cache.get(provider, file_id, revision) if revision else None
+    if path is None:
+        return None
+    mime_type = metadata.get('mimeType') or (metadata.get('file') or {}).get('mimeType')
+    try:
+        response = send_file(path, mimetype=mime_type or 'application/octet-stream', as_attachment=True,
+                             download_name=file_name, etag=content_cache.etag(provider, file_id, revision),
+                             conditional=True)
+    except FileNotFoundError:
+        # Evicted since the lookup
+        return None
+    logger.info(f"Serving {provider} file {file_id} from the content cache")
+    return response
+
+def content_fill(provider, file_id, metadata):
+    """A ContentFill to copy this download into the content cache, or None if it won't be cached."""
+    # Only whole-file downloads are cached
+    if content_cache is None or 'Range' in request.headers:
+        return None
+    revision = content_revision(provider, metadata)
+    if not revision or metadata.get('size') is None:
+        return None
+    return content_cache.fill(provider, file_id, revision, int(metadata['size']))
+
+def stream_download(client, url, headers, file_name, start_fill=None):
+    """Proxy provider file content to the client in bounded chunks.
+
+    Range/If-Range headers are forwarded so clients can resume and seek.
+    Returns None if the provider did not answer with file content. If the
+    provider sends the whole file, start_fill may return a ContentFill that
+    gets a copy of every chunk.
+    """
+    upstream_headers = dict(headers)
+    # Ask for the raw bytes so Content-Length matches what we forward
+    upstream_headers['Accept-Encoding'] = 'identity'
+    for name in ('Range', 'If-Range'):
+        if name in request.headers:
+            upstream_headers[name] = request.headers[name]
+
+    response = client.get(url, headers=upstream_headers, stream=True)
+    if response.status_code == 416:
+        response.close()
+        return Response(status=416, headers={'Content-Range': response.headers.get('Content-Range', '')})
+    if response.status_code not in (200, 206):
+        response.close()
+        return None
+
+    chunk_size = app.config["DOWNLOAD_CHUNK_SIZE"]
+    fill = start_fill() if start_fill and response.status_code == 200 else None
+
+    def generate():
+        try:
+            for chunk in response.iter_raw(chunk_size=chunk_size):
+                if fill:
+                    fill.write(chunk)
+                yield chunk
+            if fill:
+                fill.commit()
+        finally:
+            # A download cut short leaves nothing in the cache
+            if fill:
+                fill.discard()
+            response.close()
+
+    proxied = Response(generate(), status=response.status_code, direct_passthrough=True)
+    for name in DOWNLOAD_PASSTHROUGH_HEADERS:
+        if name in response.headers:
+            proxied.headers[name] = response.headers[name]
+    if 'Content-Type' not in response.headers:
+        proxied.headers['Content-Type'] = 'application/octet-stream'
+    proxied.headers.setdefault('Accept-Ranges', 'bytes')
+    proxied.headers.set('Content-Disposition', 'attachment', **attachment_disposition(file_name))
+    return proxied
+
 @app.route('/')
 def home():
     return "Cloud File Manager API"
@@ -69,17 +580,34 @@ def home():
 def login_google():
     return google.authorize_redirect(url_for('authorize_google', _external=True, _scheme="https"))
 
+def sign_in(provider, email, token):
+    """Save a provider token for the user already signed in, else for the user with this email."""
+    user = db.session.get(User, session['user_id']) if session.get('user_id') else None
+    if user is None:
+        user = User.query.filter_by(email=email).first()
+    if user is None:
+        user = User(email=email)
+        db.session.add(user)
+    setattr(user, f'{provider}_token', token)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent sign-in created the row for this email first
+        db.session.rollback()
+        user = User.query.filter_by(email=email).one()
+        setattr(user, f'{provider}_token', token)
+        db.session.commit()
+    session['user_id'] = user.id
+    user_cache.evict(user.id)
+    token_manager.store(user.id, provider, token)
+    logger.info(f"User {user.id} signed in with {provider}")
+    return user
+
 @app.route('/authorize/google')
 def authorize_google():
     token = google.authorize_access_token()
     user_info = google.get('userinfo').json()
-    user = User.query.filter_by(email=user_info['email']).first()
-    if not user:
-        user = User(email=user_info['email'], google_token=token)
-        db.session.add(user)
-    else:
-        user.google_token = token
-    db.session.commit()
+    sign_in('google', user_info['email'], token)
     
     # Redirect to frontend after successful login
     return redirect(FRONTEND_URL)
@@ -105,166 +633,35 @@ def authorize_onedrive():
         logger.error(f"No email field found in OneDrive user info: {'sc'}")
         return jsonify({"error": 'user_info'}), 400
     
-    user = User.query.filter_by(email=email).first()
-    if not user:
-        user = User(email=email, onedrive_token=token)
-        db.session.add(user)
-    else:
-        user.onedrive_token = token
-    
-    db.session.commit()
+    sign_in('onedrive', email, token)
     
     # Redirect to frontend after successful login
     return redirect(FRONTEND_URL)
 
-# Google Drive operations
-@app.route('/files/google')
-def list_google_files():
-    user = User.query.first()
-    if not user or not user.google_token:
-        logger.warning("User not authenticated with Google")
-        return jsonify({"error": "User not authenticated with Google"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
-        
-    headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
-    response = requests.get('https://www.googleapis.com/drive/v3/files', headers=headers).json()
-    return jsonify(response)
-
-@app.route('/upload/google', methods=['POST'])
-def upload_google():
-    user = User.query.first()
-    if not user or not user.google_token:
-        logger.warning("User not authenticated with Google")
-        return jsonify({"error": "User not authenticated with Google"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
-    
-    if 'file' not in request.files:
-        logger.warning("No file provided in request")
-        return jsonify({"error": "No file provided"}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        logger.warning("Empty filename provided")
-        return jsonify({"error": "No file selected"}), 400
-    
-    logger.info(f"Uploading file to Google Drive: {file.filename}")
-    metadata = {'name': file.filename}
-    files = {
-        'metadata': ('metadata', json.dumps(metadata), 'application/json'),
-        'file': (file.filename, file.read(), 'application/octet-stream')
-    }
-    headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
-    response = requests.post('https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart', headers=headers, files=files)
-    return response.json()
-
-@app.route('/download/google/<file_id>', methods=['GET'])
-def download_google(file_id):
-    user = User.query.first()
-    if not user or not user.google_token:
-        logger.warning("User not authenticated with Google")
-        return jsonify({"error": "User not authenticated with Google"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
-    
-    headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
-    
-    # Get file metadata to get name
-    logger.info(f"Getting metadata for Google Drive file: {file_id}")
-    metadata_response = requests.get(f'https://www.googleapis.com/drive/v3/files/{file_id}?fields=name', headers=headers)
-    if metadata_response.status_code != 200:
-        logger.error(f"File not found on Google Drive: {file_id}")
-        return jsonify({"error": "File not found"}), 404
-    
-    file_name = metadata_response.json().get('name', 'downloaded_file')
-    
-    # Download file content
-    logger.info(f"Downloading file from Google Drive: {file_name} ({file_id})")
-    response = requests.get(f'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media', headers=headers, stream=True)
-    if response.status_code != 200:
-        logger.error(f"Failed to download file from Google Drive: {file_id}")
-        return jsonify({"error": "Failed to download file"}), 500
-    
-    return send_file(
-        io.BytesIO(response.content),
-        mimetype=response.headers.get('Content-Type', 'application/octet-stream'),
-        as_attachment=True,
-        download_name=file_name
-    )
+# File operations, one set of routes for every provider
+def not_signed_in(provider):
+    sign_in_name = get_provider(provider).sign_in_name
+    logger.warning(f"User not authenticated with {sign_in_name}")
+    return jsonify({"error": f"User not authenticated with {sign_in_name}"}), 401
 
-@app.route('/delete/google/<file_id>', methods=['DELETE'])
-def delete_google(file_id):
-    user = User.query.first()
-    if not user or not user.google_token:
-        logger.warning("User not authenticated with Google")
-        return jsonify({"error": "User not authenticated with Google"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
+@app.route('/files/<any(google, onedrive):provider>')
+def list_provider_files(provider):
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        return not_signed_in(provider)
     
-    headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
-    logger.info(f"Deleting file from Google Drive: {file_id}")
-    response = requests.delete(f'https://www.googleapis.com/drive/v3/files/{file_id}', headers=headers)
+    access_token = token_manager.access_token(user, provider)
     
-    if response.status_code == 204:
-        logger.info(f"Successfully deleted file from Google Drive: {file_id}")
-        return jsonify({"success": True, "message": "File deleted successfully"})
-    else:
-        logger.error(f"Failed to delete file from Google Drive: {file_id}, status: {response.status_code}")
-        return jsonify({"error": "Failed to delete file", "status": response.status_code}), response.status_code
-
-# OneDrive operations
-@app.route('/files/onedrive')
-def list_onedrive_files():
-    user = User.query.first()
-    if not user or not user.onedrive_token:
-        logger.warning("User not authenticated with OneDrive")
-        return jsonify({"error": "User not authenticated with OneDrive"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
+    return list_files(user, provider, access_token)
+
+@app.route('/upload/<any(google, onedrive):provider>', methods=['POST'])
+def upload_file(provider):
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        return not_signed_in(provider)
     
-    headers = {'Authorization': f'Bearer {user.onedrive_token["access_token"]}'}
-    response = requests.get('https://graph.microsoft.com/v1.0/me/drive/root/children', headers=headers).json()
-    return jsonify(response)
-
-@app.route('/upload/onedrive', methods=['POST'])
-def upload_onedrive():
-    user = User.query.first()
-    if not user or not user.onedrive_token:
-        logger.warning("User not authenticated with OneDrive")
-        return jsonify({"error": "User not authenticated with OneDrive"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
+    storage = get_provider(provider)
+    access_token = token_manager.access_token(user, provider)
     
     if 'file' not in request.files:
         logger.warning("No file provided in request")
@@ -275,307 +672,793 @@ def upload_onedrive():
         logger.warning("Empty filename provided")
         return jsonify({"error": "No file selected"}), 400
     
-    file_content = file.read()
     file_name = file.filename
-    logger.info(f"Uploading file to OneDrive: {file_name} ({len(file_content)} bytes)")
-    
-    # For OneDrive, we need to use a different approach compared to Google Drive
-    # First, create an upload session for large files
-    headers = {
-        'Authorization': f'Bearer {user.onedrive_token["access_token"]}',
-        'Content-Type': 'application/json'
-    }
-    
-    # For small files (less than 4MB), we can use simple upload
-    if len(file_content) < 4 * 1024 * 1024:
-        logger.info(f"Using simple upload for small file: {file_name}")
-        upload_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{file_name}:/content'
-        headers = {
-            'Authorization': f'Bearer {user.onedrive_token["access_token"]}',
-            'Content-Type': 'application/octet-stream'
-        }
-        response = requests.put(upload_url, headers=headers, data=file_content)
-        return response.json()
-    
-    # For larger files, create an upload session
-    else:
-        logger.info(f"Using session upload for large file: {file_name}")
-        create_session_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{file_name}:/createUploadSession'
-        session_response = requests.post(create_session_url, headers=headers)
-        upload_session = session_response.json()
-        
-        # If we got an upload URL, use it to upload the file in chunks
-        if 'uploadUrl' in upload_session:
-            upload_url = upload_session['uploadUrl']
-            total_size = len(file_content)
-            chunk_size = 320 * 1024  # 320 KB chunks
-            
-            # Upload file in chunks
-            for i in range(0, total_size, chunk_size):
-                chunk = file_content[i:i + chunk_size]
-                chunk_end = min(i + chunk_size - 1, total_size - 1)
-                
-                logger.info(f"Uploading chunk {i}-{chunk_end}/{total_size} for file: {file_name}")
-                headers = {
-                    'Content-Length': str(len(chunk)),
-                    'Content-Range': f'bytes {i}-{chunk_end}/{total_size}'
-                }
-                
-                response = requests.put(upload_url, headers=headers, data=chunk)
-                
-                # Final chunk will return the complete file metadata
-                if i + chunk_size >= total_size:
-                    logger.info(f"Upload completed for file: {file_name}")
-                    return response.json()
-        
-        logger.error(f"Failed to create upload session for file: {file_name}")
-        return jsonify({"error": "Failed to create upload session"}), 500
-
-@app.route('/download/onedrive/<file_id>', methods=['GET'])
-def download_onedrive(file_id):
-    user = User.query.first()
-    if not user or not user.onedrive_token:
-        logger.warning("User not authenticated with OneDrive")
-        return jsonify({"error": "User not authenticated with OneDrive"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
-    
-    headers = {'Authorization': f'Bearer {user.onedrive_token["access_token"]}'}
-    
-    # Get file metadata
-    logger.info(f"Getting metadata for OneDrive file: {file_id}")
-    metadata_response = requests.get(f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}', headers=headers)
-    if metadata_response.status_code != 200:
-        logger.error(f"File not found on OneDrive: {file_id}")
+    total_size = uploaded_file_size(file)
+    logger.info(f"Uploading file to {storage.display_name}: {file_name} ({total_size} bytes)")
+    
+    hasher = ContentHasher()
+    chunk_size = transfer_chunk_size(total_size)
+    try:
+        with upload_budget.reserve(chunk_size * app.config["TRANSFER_BUFFERS"]):
+            item = storage.write(upload_chunks(file, chunk_size, hasher), file_name, total_size, access_token)
+    except TransferError as e:
+        logger.error(f"{e.message}: {file_name}")
+        return jsonify({"error": e.message, "status": e.status}), 500
+    
+    metadata_cache.evict(user.id, provider)
+    metadata_cache.put_many(user.id, provider, [item])
+    fingerprint_store.record(user.id, provider, item, hasher.hashes(), hasher.size)
+    logger.info(f"Upload completed for file: {file_name}")
+    return item
+
+@app.route('/download/<any(google, onedrive):provider>/<file_id>', methods=['GET'])
+def download_file(provider, file_id):
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        return not_signed_in(provider)
+    
+    storage = get_provider(provider)
+    access_token = token_manager.access_token(user, provider)
+    
+    headers = {'Authorization': f'Bearer {access_token}'}
+    
+    # Get file metadata (usually cached from the listing, unless the content cache needs the current revision)
+    logger.info(f"Getting metadata for {storage.display_name} file: {file_id}")
+    metadata = file_metadata(user, provider, file_id, cached=content_cache is None)
+    if metadata is None:
+        logger.error(f"File not found on {storage.display_name}: {file_id}")
         return jsonify({"error": "File not found"}), 404
     
-    file_name = metadata_response.json().get('name', 'downloaded_file')
+    file_name = metadata.get('name', 'downloaded_file')
     
     # Download file content
-    logger.info(f"Downloading file from OneDrive: {file_name} ({file_id})")
-    response = requests.get(f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/content', headers=headers, stream=True)
-    if response.status_code != 200:
-        logger.error(f"Failed to download file from OneDrive: {file_id}")
+    response = cached_content(provider, file_id, metadata, file_name)
+    if response is not None:
+        return response
+    logger.info(f"Downloading file from {storage.display_name}: {file_name} ({file_id})")
+    response = stream_download(storage.http, storage.content_url(file_id), headers, file_name,
+                               start_fill=lambda: content_fill(provider, file_id, metadata))
+    if response is None:
+        logger.error(f"Failed to download file from {storage.display_name}: {file_id}")
         return jsonify({"error": "Failed to download file"}), 500
     
-    return send_file(
-        io.BytesIO(response.content),
-        mimetype=response.headers.get('Content-Type', 'application/octet-stream'),
-        as_attachment=True,
-        download_name=file_name
-    )
+    return response
 
-@app.route('/delete/onedrive/<file_id>', methods=['DELETE'])
-def delete_onedrive(file_id):
-    user = User.query.first()
-    if not user or not user.onedrive_token:
-        logger.warning("User not authenticated with OneDrive")
-        return jsonify({"error": "User not authenticated with OneDrive"}), 401
-    
-    # Check if token needs refresh
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
+@app.route('/delete/<any(google, onedrive):provider>/<file_id>', methods=['DELETE'])
+def delete_file(provider, file_id):
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        return not_signed_in(provider)
+    
+    storage = get_provider(provider)
+    access_token = token_manager.access_token(user, provider)
     
-    headers = {'Authorization': f'Bearer {user.onedrive_token["access_token"]}'}
-    logger.info(f"Deleting file from OneDrive: {file_id}")
-    response = requests.delete(f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}', headers=headers)
+    logger.info(f"Deleting file from {storage.display_name}: {file_id}")
+    status = storage.delete(access_token, file_id)
     
-    if response.status_code == 204:
-        logger.info(f"Successfully deleted file from OneDrive: {file_id}")
+    if status == 204:
+        metadata_cache.evict(user.id, provider, file_id)
+        logger.info(f"Successfully deleted file from {storage.display_name}: {file_id}")
         return jsonify({"success": True, "message": "File deleted successfully"})
     else:
-        logger.error(f"Failed to delete file from OneDrive: {file_id}, status: {response.status_code}")
-        return jsonify({"error": "Failed to delete file", "status": response.status_code}), response.status_code
+        logger.error(f"Failed to delete file from {storage.display_name}: {file_id}, status: {status}")
+        return jsonify({"error": "Failed to delete file", "status": status}), status
 
-# New routes for file transfer between drives
+# Thumbnails, served from the on-disk preview cache
 
-@app.route('/transfer/gdrive-to-onedrive/<file_id>', methods=['POST'])
-def transfer_gdrive_to_onedrive(file_id):
-    user = User.query.first()
+# The field that changes whenever a file's content does, so its thumbnail can be cached by it
+PREVIEW_VERSION_FIELDS = {'google': 'modifiedTime', 'onedrive': 'lastModifiedDateTime'}
+
+@app.route('/preview/<provider>/<file_id>', methods=['GET'])
+def preview_file(provider, file_id):
+    """A file's thumbnail; size is small, medium (default) or large.
+
+    Thumbnails are fetched from the provider once per file version and then
+    served from local disk, with an ETag so browsers can revalidate for free.
+    """
+    if provider not in PREVIEW_VERSION_FIELDS:
+        return jsonify({"error": f"Unknown provider: {provider}"}), 404
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        return not_signed_in(provider)
+    size = request.args.get('size', 'medium')
+    if size not in PREVIEW_SIZES:
+        return jsonify({"error": f"size must be one of: {', '.join(PREVIEW_SIZES)}"}), 400
+
+    version_field = PREVIEW_VERSION_FIELDS[provider]
+    metadata = file_metadata(user, provider, file_id, fields=(version_field,))
+    if metadata is None:
+        return jsonify({"error": "File not found"}), 404
+    key = [user.id, provider, file_id, metadata.get(version_field), size]
+    preview = preview_cache.get(key)
+    if preview is None:
+        response = get_provider(provider).thumbnail(token_manager.access_token(user, provider), file_id, size)
+        if response is not None and response.status_code != 200:
+            logger.error(f"Failed to fetch {provider} thumbnail for {file_id}, status: {response.status_code}")
+            return jsonify({"error": "Failed to fetch preview", "status": response.status_code}), 502
+        if response is None:
+            preview = preview_cache.put(key, None, None)
+        else:
+            preview = preview_cache.put(key, response.content, response.headers.get('Content-Type', 'image/jpeg'))
+    if preview.content is None:
+        return jsonify({"error": "No preview available"}), 404
+
+    response = send_file(io.BytesIO(preview.content), mimetype=preview.content_type, etag=preview.etag,
+                         max_age=app.config["PREVIEW_MAX_AGE"], conditional=True)
+    # Thumbnails belong to one user; shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+# File transfer between drives. Transfers run as queued jobs (see jobs.py);
+# the routes only enqueue them and report progress.
+
+def skipped_transfer(progress, file_name, item, destination):
+    size = int(item.get('size') or 0)
+    progress.start(file_name, size)
+    progress.advance(size)
+    logger.info(f"Identical file already on {destination}, skipping transfer: {file_name} ({item['id']})")
+    return {"success": True, "skipped": True, "message": f"Identical file already on {destination}",
+            "destination": destination, "file": item}
+
+def find_existing_copy(user, source, metadata, destination, parent_id=None):
+    if not app.config["TRANSFER_SKIP_IDENTICAL"]:
+        return None
+    # Candidates are re-read from the provider, so a renamed or changed file is never taken as a copy
+    existing = fingerprint_store.find_copy(user.id, source, metadata, destination,
+                                           lambda item_id: file_metadata(user, destination, item_id, cached=False),
+                                           folder_id=parent_id)
+    if existing is None:
+        return None
+    # The source metadata may have come from the cache; only skip if its content is still the same
+    current = file_metadata(user, source, metadata['id'], cached=False)
+    if current is None or native_hashes(source, current) != native_hashes(source, metadata):
+        return None
+    return existing
+
+def record_transfer(user, source, metadata, destination, item, hasher):
+    """Check the streamed bytes against the hashes the providers report, then remember them."""
+    hashes = hasher.hashes()
+    for algorithm, value in native_hashes(destination, item).items():
+        if value != hashes[algorithm]:
+            raise TransferError(f"Copy on {destination} does not match the bytes sent ({algorithm})", 502)
+    fingerprint_store.record(user.id, destination, item, hashes, hasher.size)
+    # Cached source metadata can predate an edit; a source whose hash differs is not recorded
+    if all(value == hashes[algorithm] for algorithm, value in native_hashes(source, metadata).items()):
+        fingerprint_store.record(user.id, source, metadata, hashes, hasher.size)
+    else:
+        logger.warning(f"{source} file {metadata['id']} changed since its metadata was read; not recording it")
+
+def copy_file(user, direction, file_id, progress, parent_id=None):
+    source, destination = TRANSFER_DIRECTIONS[direction]
+    source_storage, destination_storage = get_provider(source), get_provider(destination)
+    
+    # Step 1: Get file metadata from the source
+    logger.info(f"Getting metadata for {source_storage.display_name} file: {file_id}")
+    metadata = file_metadata(user, source, file_id, source_storage.transfer_fields)
+    if metadata is None:
+        raise TransferError(f"File not found on {source_storage.display_name}", 404)
+    
+    file_name = metadata.get('name', 'transferred_file')
+    existing = find_existing_copy(user, source, metadata, destination, parent_id)
+    if existing:
+        return skipped_transfer(progress, file_name, existing, destination_storage.display_name)
+    
+    # Step 2: Stream file content from the source
+    logger.info(f"Downloading file from {source_storage.display_name}: {file_name} ({file_id})")
+    try:
+        download_response = source_storage.read(token_manager.access_token(user, source), file_id)
+    except TransferError as e:
+        raise TransferError(f"Failed to download file from {source_storage.display_name}", e.status)
+    
+    total_size = int(metadata.get('size') or download_response.headers.get('Content-Length', 0)) or None
+    content_type = (source_storage.content_type(metadata)
+                    or download_response.headers.get('Content-Type', 'application/octet-stream'))
+    progress.start(file_name, total_size)
+    
+    # Step 3: Upload to the destination chunk by chunk as the download arrives
+    logger.info(f"Uploading file to {destination_storage.display_name}: {file_name} ({total_size} bytes)")
+    hasher = ContentHasher()
+    try:
+        item = destination_storage.write(source_chunks(download_response, transfer_ring(total_size), hasher), file_name,
+                                         total_size, token_manager.access_token(user, destination), content_type,
+                                         progress=progress.advance, parent_id=parent_id)
+    finally:
+        download_response.close()
+    
+    metadata_cache.evict(user.id, destination)
+    metadata_cache.put_many(user.id, destination, [item])
+    record_transfer(user, source, metadata, destination, item, hasher)
+    logger.info(f"File transferred successfully to {destination_storage.display_name}: {file_name}")
+    return {"success": True, "message": "File transferred successfully", "destination": destination_storage.display_name,
+            "file": item}
+
+def transfer_tree(user, job, progress):
+    source, destination = TRANSFER_DIRECTIONS[job.direction]
+    folder = file_metadata(user, source, job.file_id, ('name', 'mimeType') if source == 'google' else ('name',))
+    if folder is None:
+        raise TransferError("Folder not found", 404)
+    if not is_folder(source, folder):
+        raise TransferError("Not a folder; use the single-file transfer instead", 400)
+    progress.start(folder['name'], None)
+    # A folder job that was requeued after a restart picks up where its crawl got to
+    queued = transfer_queue.tree_file_ids(job.id)
+    
+    def tokens():
+        return {provider: token_manager.access_token(user, provider) for provider in (source, destination)}
+    
+    def on_folder(destination_folder_id, path, files, skipped):
+        for item in skipped:
+            logger.info(f"Skipping {path}/{item['name']}: it has no downloadable content")
+        # The listing already has what each copy needs, so its metadata lookup is usually a cache hit
+        metadata_cache.put_many(user.id, source, files)
+        new_files = [item for item in files if item['id'] not in queued]
+        if new_files:
+            transfer_queue.submit_tree_files(job, destination_folder_id, new_files)
+        progress.touch()
+    
+    root, summary = copy_tree(source, destination, tokens, folder, job.destination_parent_id or 'root', on_folder,
+                              workers=app.config["TREE_CRAWL_WORKERS"])
+    metadata_cache.evict(user.id, destination)
+    return {"success": True, "folder": root, **summary}
+
+def run_transfer_job(job, progress):
+    user = user_cache.get(job.user_id)
+    if not user or not user.google_token or not user.onedrive_token:
+        raise TransferError("User not authenticated with both Google Drive and OneDrive", 401)
+    if job.kind == 'folder':
+        return transfer_tree(user, job, progress)
+    return copy_file(user, job.direction, job.file_id, progress, job.destination_parent_id)
+
+transfer_queue = TransferQueue(
+    app, db, TransferJob, run_transfer_job,
+    workers=app.config["TRANSFER_WORKERS"],
+    provider_limits=app.config["TRANSFER_PROVIDER_LIMITS"]
+)
+
+def job_status(job):
+    bytes_done, bytes_total = transfer_queue.progress(job)
+    status = {
+        "id": job.id,
+        "direction": job.direction,
+        "kind": job.kind,
+        "file_id": job.file_id,
+        "file_name": job.file_name,
+        "status": job.status,
+        "bytes_total": bytes_total,
+        "bytes_done": bytes_done,
+        "throughput": None,
+        "eta_seconds": None,
+        "error": job.error,
+        "result": job.result,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+    if job.started_at:
+        elapsed = ((job.finished_at or datetime.datetime.now()) - job.started_at).total_seconds()
+        if elapsed > 0 and bytes_done:
+            status["throughput"] = round(bytes_done / elapsed)
+            if job.status == 'running' and bytes_total:
+                status["eta_seconds"] = round((bytes_total - bytes_done) / status["throughput"], 1)
+    if job.kind == 'folder':
+        status["tree"] = transfer_queue.tree_summary(job)
+    elif job.tree_id:
+        status["tree_id"] = job.tree_id
+    return status
+
+def enqueue_transfer(direction, file_id):
+    user = current_user()
     
     # Check if the user is authenticated to both services
     if not user or not user.google_token or not user.onedrive_token:
         logger.warning("User not authenticated with both services")
         return jsonify({"error": "User not authenticated with both Google Drive and OneDrive"}), 401
     
-    # Check and refresh Google token if needed
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
-    
-    # Check and refresh OneDrive token if needed
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
-    
-    google_headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
-    
-    # Step 1: Get file metadata from Google Drive
-    logger.info(f"Getting metadata for Google Drive file: {file_id}")
-    metadata_response = requests.get(f'https://www.googleapis.com/drive/v3/files/{file_id}?fields=name', headers=google_headers)
-    if metadata_response.status_code != 200:
-        logger.error(f"File not found on Google Drive: {file_id}")
-        return jsonify({"error": "File not found on Google Drive"}), 404
-    
-    file_name = metadata_response.json().get('name', 'transferred_file')
-    
-    # Step 2: Download file content from Google Drive
-    logger.info(f"Downloading file from Google Drive: {file_name} ({file_id})")
-    download_response = requests.get(f'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media', headers=google_headers)
-    if download_response.status_code != 200:
-        logger.error(f"Failed to download file from Google Drive: {file_id}")
-        return jsonify({"error": "Failed to download file from Google Drive"}), 500
-    
-    file_content = download_response.content
-    content_type = download_response.headers.get('Content-Type', 'application/octet-stream')
-    
-    # Step 3: Upload to OneDrive
-    logger.info(f"Uploading file to OneDrive: {file_name} ({len(file_content)} bytes)")
-    
-    onedrive_headers = {
-        'Authorization': f'Bearer {user.onedrive_token["access_token"]}',
-        'Content-Type': content_type
-    }
-    
-    # For small files (less than 4MB), use simple upload
-    if len(file_content) < 4 * 1024 * 1024:
-        logger.info(f"Using simple upload for small file to OneDrive: {file_name}")
-        upload_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{file_name}:/content'
-        response = requests.put(upload_url, headers=onedrive_headers, data=file_content)
-        
-        if response.status_code in [200, 201]:
-            logger.info(f"File transferred successfully to OneDrive: {file_name}")
-            return jsonify({"success": True, "message": "File transferred successfully", "destination": "OneDrive", "file": response.json()})
-        else:
-            logger.error(f"Failed to upload file to OneDrive: {file_name}")
-            return jsonify({"error": "Failed to upload file to OneDrive", "status": response.status_code}), 500
-    
-    # For larger files, create an upload session
-    else:
-        logger.info(f"Using session upload for large file to OneDrive: {file_name}")
-        session_headers = {
-            'Authorization': f'Bearer {user.onedrive_token["access_token"]}',
-            'Content-Type': 'application/json'
-        }
-        
-        create_session_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{file_name}:/createUploadSession'
-        session_response = requests.post(create_session_url, headers=session_headers)
-        upload_session = session_response.json()
-        
-        if 'uploadUrl' in upload_session:
-            upload_url = upload_session['uploadUrl']
-            total_size = len(file_content)
-            chunk_size = 320 * 1024  # 320 KB chunks
-            
-            # Upload file in chunks
-            for i in range(0, total_size, chunk_size):
-                chunk = file_content[i:i + chunk_size]
-                chunk_end = min(i + chunk_size - 1, total_size - 1)
-                
-                logger.info(f"Uploading chunk {i}-{chunk_end}/{total_size} for file to OneDrive: {file_name}")
-                chunk_headers = {
-                    'Content-Length': str(len(chunk)),
-                    'Content-Range': f'bytes {i}-{chunk_end}/{total_size}'
-                }
-                
-                response = requests.put(upload_url, headers=chunk_headers, data=chunk)
-                
-                # Check the final chunk response
-                if i + chunk_size >= total_size:
-                    if response.status_code in [200, 201]:
-                        logger.info(f"File transferred successfully to OneDrive: {file_name}")
-                        return jsonify({"success": True, "message": "File transferred successfully", "destination": "OneDrive", "file": response.json()})
-                    else:
-                        logger.error(f"Failed to complete upload to OneDrive: {file_name}")
-                        return jsonify({"error": "Failed to complete upload to OneDrive", "status": response.status_code}), 500
-        
-        logger.error(f"Failed to create upload session for OneDrive: {file_name}")
-        return jsonify({"error": "Failed to create upload session for OneDrive"}), 500
+    job = transfer_queue.submit(user.id, direction, file_id)
+    logger.info(f"Queued transfer job {job.id}: {direction} {file_id}")
+    status_url = url_for('get_job', job_id=job.id)
+    return jsonify({"success": True, "job_id": job.id, "status": job.status, "status_url": status_url}), 202, {'Location': status_url}
+
+@app.route('/transfer/gdrive-to-onedrive/<file_id>', methods=['POST'])
+def transfer_gdrive_to_onedrive(file_id):
+    return enqueue_transfer('gdrive-to-onedrive', file_id)
 
 @app.route('/transfer/onedrive-to-gdrive/<file_id>', methods=['POST'])
 def transfer_onedrive_to_gdrive(file_id):
-    user = User.query.first()
-    
-    # Check if the user is authenticated to both services
+    return enqueue_transfer('onedrive-to-gdrive', file_id)
+
+def batch_file_ids():
+    """File IDs from a batch request body, or an error response."""
+    file_ids = (request.get_json(silent=True) or {}).get('file_ids')
+    if not isinstance(file_ids, list) or not file_ids or not all(isinstance(f, str) and f for f in file_ids):
+        return None, (jsonify({"error": "file_ids must be a non-empty list of file IDs"}), 400)
+    if len(file_ids) > app.config["BATCH_MAX_ITEMS"]:
+        return None, (jsonify({"error": f"At most {app.config['BATCH_MAX_ITEMS']} files per batch"}), 400)
+    return file_ids, None
+
+@app.route('/transfer/batch', methods=['POST'])
+def transfer_batch():
+    direction = (request.get_json(silent=True) or {}).get('direction')
+    if direction not in TRANSFER_DIRECTIONS:
+        return jsonify({"error": f"direction must be one of {', '.join(TRANSFER_DIRECTIONS)}"}), 400
+    file_ids, error = batch_file_ids()
+    if error:
+        return error
+    
+    user = current_user()
     if not user or not user.google_token or not user.onedrive_token:
         logger.warning("User not authenticated with both services")
         return jsonify({"error": "User not authenticated with both Google Drive and OneDrive"}), 401
     
-    # Check and refresh Google token if needed
-    if 'expires_at' in user.google_token and datetime.datetime.fromtimestamp(user.google_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing Google token")
-        token = google.refresh_token(user.google_token['refresh_token'])
-        user.google_token = token
-        db.session.commit()
-    
-    # Check and refresh OneDrive token if needed
-    if 'expires_at' in user.onedrive_token and datetime.datetime.fromtimestamp(user.onedrive_token['expires_at']) < datetime.datetime.now():
-        logger.info("Refreshing OneDrive token")
-        token = onedrive.refresh_token(user.onedrive_token['refresh_token'])
-        user.onedrive_token = token
-        db.session.commit()
-    
-    onedrive_headers = {'Authorization': f'Bearer {user.onedrive_token["access_token"]}'}
-    
-    # Step 1: Get file metadata from OneDrive
-    logger.info(f"Getting metadata for OneDrive file: {file_id}")
-    metadata_response = requests.get(f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}', headers=onedrive_headers)
-    if metadata_response.status_code != 200:
-        logger.error(f"File not found on OneDrive: {file_id}")
-        return jsonify({"error": "File not found on OneDrive"}), 404
-    
-    file_name = metadata_response.json().get('name', 'transferred_file')
-    
-    # Step 2: Download file content from OneDrive
-    logger.info(f"Downloading file from OneDrive: {file_name} ({file_id})")
-    download_response = requests.get(f'https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/content', headers=onedrive_headers)
-    if download_response.status_code != 200:
-        logger.error(f"Failed to download file from OneDrive: {file_id}")
-        return jsonify({"error": "Failed to download file from OneDrive"}), 500
-    
-    file_content = download_response.content
-    content_type = download_response.headers.get('Content-Type', 'application/octet-stream')
-    
-    # Step 3: Upload to Google Drive
-    logger.info(f"Uploading file to Google Drive: {file_name} ({len(file_content)} bytes)")
-    
-    google_headers = {'Authorization': f'Bearer {user.google_token["access_token"]}'}
+    # The queue's worker pool bounds how many of these run at once
+    jobs = transfer_queue.submit_many(user.id, [(direction, file_id) for file_id in file_ids])
+    logger.info(f"Queued {len(jobs)} transfer jobs: {direction}")
+    return jsonify({
+        "success": True,
+        "results": [
+            {"file_id": job.file_id, "job_id": job.id, "status": job.status, "status_url": url_for('get_job', job_id=job.id)}
+            for job in jobs
+        ]
+    }), 202
+
+@app.route('/transfer/tree', methods=['POST'])
+def transfer_tree_route():
+    body = request.get_json(silent=True) or {}
+    direction, folder_id = body.get('direction'), body.get('folder_id')
+    if direction not in TRANSFER_DIRECTIONS:
+        return jsonify({"error": f"direction must be one of {', '.join(TRANSFER_DIRECTIONS)}"}), 400
+    if not isinstance(folder_id, str) or not folder_id:
+        return jsonify({"error": "folder_id is required"}), 400
+    destination_parent_id = body.get('destination_parent_id')
+    if destination_parent_id is not None and (not isinstance(destination_parent_id, str) or not destination_parent_id):
+        return jsonify({"error": "destination_parent_id must be a folder ID"}), 400
+    
+    user = current_user()
+    if not user or not user.google_token or not user.onedrive_token:
+        logger.warning("User not authenticated with both services")
+        return jsonify({"error": "User not authenticated with both Google Drive and OneDrive"}), 401
     
-    metadata = {'name': file_name}
-    files = {
-        'metadata': ('metadata', json.dumps(metadata), 'application/json'),
-        'file': (file_name, file_content, content_type)
+    # The folder job crawls the tree and queues a job per file; its status sums them up
+    job = transfer_queue.submit_tree(user.id, direction, folder_id, destination_parent_id)
+    logger.info(f"Queued folder transfer job {job.id}: {direction} {folder_id}")
+    status_url = url_for('get_job', job_id=job.id)
+    return jsonify({"success": True, "job_id": job.id, "status": job.status, "status_url": status_url}), 202, {'Location': status_url}
+
+@app.route('/delete/batch', methods=['POST'])
+def delete_batch():
+    provider = (request.get_json(silent=True) or {}).get('provider')
+    if provider not in ('google', 'onedrive'):
+        return jsonify({"error": "provider must be 'google' or 'onedrive'"}), 400
+    file_ids, error = batch_file_ids()
+    if error:
+        return error
+    
+    user = current_user()
+    if not user or not getattr(user, f'{provider}_token'):
+        logger.warning(f"User not authenticated with {provider}")
+        return jsonify({"error": f"User not authenticated with {provider}"}), 401
+    
+    access_token = token_manager.access_token(user, provider)
+    results = get_provider(provider).delete_many(access_token, file_ids, max_workers=app.config["BATCH_CONCURRENCY"])
+    for result in results:
+        if result["success"]:
+            metadata_cache.evict(user.id, provider, result["file_id"])
+    failed = sum(1 for result in results if not result["success"])
+    if failed:
+        logger.error(f"Failed to delete {failed} of {len(results)} files from {provider}")
+    return jsonify({"success": not failed, "deleted": len(results) - failed, "failed": failed, "results": results})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    user = current_user()
+    job = db.session.get(TransferJob, job_id)
+    if not user or not job or job.user_id != user.id:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_status(job))
+
+drive_indexer = DriveIndexer(
+    app, db, IndexedFile, IndexSyncState, User, token_manager.access_token,
+    interval=app.config["INDEX_SYNC_INTERVAL"]
+)
+
+def delete_synced_file(user, provider, file_id):
+    storage = get_provider(provider)
+    status = storage.delete(token_manager.access_token(user, provider), file_id)
+    # 404: already gone, which is what the sync wanted
+    if status not in (204, 404):
+        raise TransferError(f"Failed to delete file from {storage.display_name}", status)
+    metadata_cache.evict(user.id, provider, file_id)
+    logger.info(f"Sync deleted file from {storage.display_name}: {file_id}")
+
+sync_scheduler = SyncScheduler(
+    app, db, SyncJob, SyncRun, SyncedFile, IndexedFile, IndexSyncState, drive_indexer, fingerprint_store,
+    user_cache.get, token_manager.access_token, copy_file, delete_synced_file,
+    workers=app.config["SYNC_WORKERS"],
+    stale_after=app.config["SYNC_STALE_AFTER"]
+)
+
+def index_page(query):
+    limit = max(1, min(request.args.get('limit', 200, type=int), 1000))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    entries = db.session.scalars(query.offset(offset).limit(limit + 1)).all()
+    return {
+        "files": [entry_dict(entry) for entry in entries[:limit]],
+        "next_offset": offset + limit if len(entries) > limit else None
     }
-    
-    response = requests.post('https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart', headers=google_headers, files=files)
-    
-    if response.status_code in [200, 201]:
-        logger.info(f"File transferred successfully to Google Drive: {file_name}")
-        return jsonify({"success": True, "message": "File transferred successfully", "destination": "Google Drive", "file": response.json()})
+
+@app.route('/index/<provider>/files', methods=['GET'])
+def index_files(provider):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    if provider not in ROW_BUILDERS:
+        return jsonify({"error": f"Unknown provider: {provider}"}), 404
+    
+    state = db.session.get(IndexSyncState, (user.id, provider))
+    if not state or not state.full_synced_at:
+        return jsonify({"error": f"{provider} index is not built yet"}), 503
+    parent_id = request.args.get('parent', state.root_id)
+    query = db.select(IndexedFile).filter_by(user_id=user.id, provider=provider, parent_id=parent_id) \
+        .order_by(IndexedFile.name, IndexedFile.file_id)
+    return jsonify({**index_page(query), "parent": parent_id, "synced_at": state.synced_at.isoformat()})
+
+@app.route('/index/<provider>/files/<file_id>', methods=['GET'])
+def index_file(provider, file_id):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    entry = db.session.get(IndexedFile, (user.id, provider, file_id))
+    if entry is None:
+        return jsonify({"error": "File not found in index"}), 404
+    return jsonify(entry_dict(entry))
+
+def parse_search_filters():
+    """Column filters from the query string; raises ValueError on a malformed value."""
+    filters = []
+    if request.args.get('provider'):
+        filters.append(IndexedFile.provider == request.args['provider'])
+    if request.args.get('type') in ('file', 'folder'):
+        filters.append(IndexedFile.is_folder == (request.args['type'] == 'folder'))
+    if request.args.get('min_size'):
+        filters.append(IndexedFile.size >= int(request.args['min_size']))
+    if request.args.get('max_size'):
+        filters.append(IndexedFile.size <= int(request.args['max_size']))
+    if request.args.get('modified_after'):
+        filters.append(IndexedFile.modified_time >= datetime.datetime.fromisoformat(request.args['modified_after']))
+    if request.args.get('modified_before'):
+        filters.append(IndexedFile.modified_time < datetime.datetime.fromisoformat(request.args['modified_before']))
+    return filters
+
+SEARCH_SORTS = {
+    'name': (IndexedFile.name, IndexedFile.file_id),
+    'modified': (IndexedFile.modified_time.desc(), IndexedFile.file_id),
+    'size': (IndexedFile.size.desc(), IndexedFile.file_id),
+}
+
+@app.route('/search', methods=['GET'])
+def search_files():
+    """Search both drives' indexed names, paths and mime types.
+
+    mode is words (default: every word starts a word in the name, path or
+    mime type), prefix (name starts with q) or substring (name contains every
+    word anywhere). Filters: provider, type (file|folder), min_size, max_size,
+    modified_after, modified_before (ISO dates). sort is relevance (default),
+    name, modified or size; paginate with limit and offset. When more than
+    SEARCH_RANK_LIMIT files match, results come back unsorted, in index order,
+    and matches is SEARCH_RANK_LIMIT with more_matches set.
+    """
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    term = request.args.get('q', '').strip()
+    if not term:
+        return jsonify({"error": "q is required"}), 400
+    mode = request.args.get('mode', 'words')
+    if mode not in SEARCH_MODES:
+        return jsonify({"error": f"Unknown mode: {mode}"}), 400
+    sort = request.args.get('sort', 'relevance')
+    if sort != 'relevance' and sort not in SEARCH_SORTS:
+        return jsonify({"error": f"Unknown sort: {sort}"}), 400
+    try:
+        filters = parse_search_filters()
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    
+    search = FileSearch(IndexedFile, term, mode)
+    query = search.select(user.id).where(*filters)
+    # One pass over the matches, stopping past the rank limit where the exact total isn't needed;
+    # ranking and sorting then only look at the rows it found
+    rank_limit = app.config["SEARCH_RANK_LIMIT"]
+    rowids = db.session.scalars(search.matches(query, rank_limit)).all()
+    sorted_results = len(rowids) <= rank_limit
+    if not sorted_results:
+        query = query.order_by(search.index_order())
+    elif sort == 'relevance':
+        query = search.rows(db.session.scalars(search.ranked(rowids)).all())
     else:
-        logger.error(f"Failed to upload file to Google Drive: {file_name}")
-        return jsonify({"error": "Failed to upload file to Google Drive", "status": response.status_code}), 500
+        query = search.rows(rowids, SEARCH_SORTS[sort])
+    return jsonify({**index_page(query), "matches": min(len(rowids), rank_limit), "more_matches": not sorted_results,
+                    "sorted": sorted_results})
+
+@app.route('/index/status', methods=['GET'])
+def index_status():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    status = {}
+    for state in IndexSyncState.query.filter_by(user_id=user.id):
+        status[state.provider] = {
+            "files": IndexedFile.query.filter_by(user_id=user.id, provider=state.provider).count(),
+            "crawling": state.crawl_started_at is not None,
+            "full_synced_at": state.full_synced_at.isoformat() if state.full_synced_at else None,
+            "synced_at": state.synced_at.isoformat() if state.synced_at else None,
+            "error": state.error
+        }
+    return jsonify(status)
+
+@app.route('/index/sync', methods=['POST'])
+def index_sync():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    drive_indexer.wake()
+    return jsonify({"success": True, "status_url": url_for('index_status')}), 202
+
+# Scheduled syncs between the drives (see drive_sync.py)
+
+def sync_run_status(run):
+    return {
+        "id": run.id,
+        "status": run.status,
+        "result": run.result,
+        "error": run.error,
+        "started_at": run.started_at.isoformat(),
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None
+    }
+
+def sync_status(sync, runs=1):
+    recent = SyncRun.query.filter_by(sync_id=sync.id).order_by(SyncRun.started_at.desc()).limit(runs)
+    next_run = next_run_time(sync.schedule) if sync.enabled else None
+    return {
+        "id": sync.id,
+        "name": sync.name,
+        "mode": sync.mode,
+        "google_path": sync.google_path,
+        "onedrive_path": sync.onedrive_path,
+        "schedule": sync.schedule,
+        "conflict_policy": sync.conflict_policy,
+        "propagate_deletes": sync.propagate_deletes,
+        "enabled": sync.enabled,
+        "running": sync.heartbeat_at is not None,
+        "next_run_at": next_run.isoformat() if next_run else None,
+        "created_at": sync.created_at.isoformat(),
+        "runs": [sync_run_status(run) for run in recent]
+    }
+
+def sync_settings(body, required=()):
+    """Validated sync job settings from a request body, or an error response."""
+    missing = [field for field in required if field not in body]
+    if missing:
+        return None, (jsonify({"error": f"{', '.join(missing)} required"}), 400)
+    settings = {}
+    if 'mode' in body:
+        if body['mode'] not in SYNC_MODES:
+            return None, (jsonify({"error": f"mode must be one of {', '.join(SYNC_MODES)}"}), 400)
+        settings['mode'] = body['mode']
+    for field in ('google_path', 'onedrive_path'):
+        if field in body:
+            settings[field] = normalize_root(body[field])
+            if settings[field] is None:
+                return None, (jsonify({"error": f"{field} must be a folder path like /Photos, or / for the whole drive"}), 400)
+    if 'schedule' in body:
+        try:
+            parse_schedule(body['schedule'])
+        except (TypeError, ValueError) as e:
+            return None, (jsonify({"error": f"schedule must be a crontab expression: {e}"}), 400)
+        settings['schedule'] = body['schedule']
+    if 'conflict_policy' in body:
+        if body['conflict_policy'] not in CONFLICT_POLICIES:
+            return None, (jsonify({"error": f"conflict_policy must be one of {', '.join(CONFLICT_POLICIES)}"}), 400)
+        settings['conflict_policy'] = body['conflict_policy']
+    for field in ('propagate_deletes', 'enabled'):
+        if field in body:
+            if not isinstance(body[field], bool):
+                return None, (jsonify({"error": f"{field} must be true or false"}), 400)
+            settings[field] = body[field]
+    if 'name' in body:
+        if body['name'] is not None and not isinstance(body['name'], str):
+            return None, (jsonify({"error": "name must be a string"}), 400)
+        settings['name'] = body['name']
+    return settings, None
+
+def user_sync(sync_id):
+    user = current_user()
+    sync = db.session.get(SyncJob, sync_id)
+    if not user or not sync or sync.user_id != user.id:
+        return None
+    return sync
+
+@app.route('/sync', methods=['POST'])
+def create_sync():
+    user = current_user()
+    if not user or not user.google_token or not user.onedrive_token:
+        logger.warning("User not authenticated with both services")
+        return jsonify({"error": "User not authenticated with both Google Drive and OneDrive"}), 401
+    settings, error = sync_settings(request.get_json(silent=True) or {}, required=('mode', 'schedule'))
+    if error:
+        return error
+    
+    sync = SyncJob(user_id=user.id, **settings)
+    db.session.add(sync)
+    db.session.commit()
+    sync_scheduler.reload()
+    logger.info(f"Created sync {sync.id}: {sync.mode} on {sync.schedule}")
+    status_url = url_for('get_sync', sync_id=sync.id)
+    return jsonify(sync_status(sync)), 201, {'Location': status_url}
+
+@app.route('/sync', methods=['GET'])
+def list_syncs():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    syncs = SyncJob.query.filter_by(user_id=user.id).order_by(SyncJob.created_at)
+    return jsonify({"syncs": [sync_status(sync) for sync in syncs]})
+
+@app.route('/sync/<sync_id>', methods=['GET'])
+def get_sync(sync_id):
+    sync = user_sync(sync_id)
+    if not sync:
+        return jsonify({"error": "Sync not found"}), 404
+    return jsonify(sync_status(sync, runs=max(1, min(request.args.get('runs', 20, type=int), 100))))
+
+@app.route('/sync/<sync_id>', methods=['PATCH'])
+def update_sync(sync_id):
+    sync = user_sync(sync_id)
+    if not sync:
+        return jsonify({"error": "Sync not found"}), 404
+    settings, error = sync_settings(request.get_json(silent=True) or {})
+    if error:
+        return error
+    
+    # The baseline pairs files of the old folders and direction; start again from a full comparison
+    if any(settings.get(field, getattr(sync, field)) != getattr(sync, field)
+           for field in ('mode', 'google_path', 'onedrive_path')):
+        if sync.heartbeat_at is not None:
+            return jsonify({"error": "Sync is running; change its folders or mode once the run finishes"}), 409
+        SyncedFile.query.filter_by(sync_id=sync.id).delete()
+        sync.index_watermark = None
+    for field, value in settings.items():
+        setattr(sync, field, value)
+    db.session.commit()
+    sync_scheduler.reload()
+    return jsonify(sync_status(sync))
+
+@app.route('/sync/<sync_id>', methods=['DELETE'])
+def delete_sync(sync_id):
+    sync = user_sync(sync_id)
+    if not sync:
+        return jsonify({"error": "Sync not found"}), 404
+    if sync.heartbeat_at is not None:
+        return jsonify({"error": "Sync is running; delete it once the run finishes"}), 409
+    SyncedFile.query.filter_by(sync_id=sync.id).delete()
+    SyncRun.query.filter_by(sync_id=sync.id).delete()
+    db.session.delete(sync)
+    db.session.commit()
+    sync_scheduler.reload()
+    logger.info(f"Deleted sync {sync_id}")
+    return jsonify({"success": True, "message": "Sync deleted"})
+
+@app.route('/sync/<sync_id>/run', methods=['POST'])
+def run_sync(sync_id):
+    sync = user_sync(sync_id)
+    if not sync:
+        return jsonify({"error": "Sync not found"}), 404
+    if sync.heartbeat_at is not None:
+        return jsonify({"error": "Sync is already running"}), 409
+    if not sync_scheduler.run_now(sync.id):
+        return jsonify({"error": "Syncs are not running in this process"}), 503
+    status_url = url_for('get_sync', sync_id=sync.id)
+    return jsonify({"success": True, "status_url": status_url}), 202, {'Location': status_url}
+
+@app.route('/auth/token', methods=['POST'])
+def issue_token():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "User not authenticated"}), 401
+    expires = app.config["JWT_ACCESS_TOKEN_EXPIRES"]
+    return jsonify({"access_token": create_access_token(identity=str(user.id)), "token_type": "Bearer",
+                    "expires_in": int(expires.total_seconds())})
 
 @app.route('/logout', methods=['POST'])
 def logout():
-    logger.info("User logged out")
+    logger.info(f"User {session.get('user_id')} logged out")
     session.clear()
     return jsonify({"success": True, "message": "Logged out successfully"})
 
-if __name__ == '__main__':
+@app.before_request
+def start_route_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def time_route(response):
+    # Streamed responses are timed to their first byte, not to the end of the stream
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        ROUTE_LATENCY.labels('flask', request.method, route, response.status_code).observe(time.perf_counter() - started)
+    return response
+
+def encoded_json(body):
+    """A JSON response of an EncodedBody, which encode_json sends from the copies body keeps."""
+    g.encoded_body = body
+    return Response(body.data, mimetype='application/json')
+
+@app.after_request
+def encode_json(response):
+    # ETags, 304s and compression for JSON GETs; streamed listings and file content pass through as they are
+    if (request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.mimetype != 'application/json'
+            or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    body = g.pop('encoded_body', None) or EncodedBody(response.get_data())
+    return send_encoded(request, response, body, app.config["COMPRESS_LEVELS"], app.config["COMPRESS_MIN_SIZE"])
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this process."""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+def start_background_services():
+    """Create the schema and start the background services in this process, once."""
+    if sync_scheduler.running:
+        return
     with app.app_context():
         db.create_all()
+        with db.engine.begin() as connection:
+            install_search_index(connection)
+            install_sync_indexes(connection)
+    token_manager.start()
+    transfer_queue.start()
+    drive_indexer.start()
+    sync_scheduler.start()
+
+def stop_background_services():
+    sync_scheduler.shutdown()
+    drive_indexer.shutdown()
+    transfer_queue.shutdown()
+    token_manager.shutdown()
+
+@app.cli.command('worker')
+def run_worker():
+    """Run the background services without serving requests.
+
+    Web processes (gunicorn app:app, uvicorn asgi:app) only serve requests
+    unless BACKGROUND_SERVICES is set; run one or more of these beside them:
+
+        flask --app app worker
+
+    Transfers and sync runs are claimed through the database, so several
+    workers share the load. Syncs started with POST /sync/<id>/run need the
+    services in the web process itself.
+    """
+    start_background_services()
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    logger.info("Background worker running")
+    stop.wait()
+    logger.info("Stopping background worker")
+    stop_background_services()
+
+# Starting here rather than in a gunicorn hook; with --preload the services would
+# start in the master and not survive the fork, so don't combine the two
+if app.config["BACKGROUND_SERVICES"]:
+    start_background_services()
+
+if __name__ == '__main__':
+    # The services run in this process, so the reloader, which would start them
+    # again in its child, stays off; use `flask --app app run --debug` beside a worker to reload
+    start_background_services()
     logger.info("Starting Cloud File Manager API server")
-    app.run(debug=True,host='0.0.0.0',port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
@@ -0,0 +1,456 @@
+"""Async variant of the file routes, served by an ASGI server.
+
+    uvicorn asgi:app --port 5001
+
+Listing, upload, download, delete and single-file transfers run on one event
+loop with the pooled async clients, so a slow provider call or a multi-GB
+stream holds a coroutine rather than a worker thread, and one process can
+keep hundreds of them going. Everything else (sign-in, search, folder and
+batch transfers) stays on the Flask app, whose models, caches and token
+manager this module shares; database work runs on the thread pool inside a
+Flask app context.
+
+Requests carry the same credentials as on the Flask app: a JWT from
+/auth/token, or the Flask session cookie. Transfers are not queued: each runs
+as a task in this process and writes its progress to its TransferJob row, so
+/jobs/<id> works on either app. A task cancelled at shutdown hands its job
+back to the Flask queue, which also requeues the jobs of a process that died
+once their heartbeat goes stale.
+
+Uploads take the file as the raw request body with ?name=, instead of a
+multipart form.
+"""
+import asyncio
+import datetime
+import functools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from flask_jwt_extended import decode_token
+from itsdangerous import BadSignature
+from starlette.concurrency import run_in_threadpool
+from werkzeug.http import dump_options_header
+
+import async_transfer
+from app import (app as flask_app, db, TransferJob, user_cache, token_manager, metadata_cache, fingerprint_store,
+                 transfer_queue, find_existing_copy, record_transfer, job_status, listing_body, listing_cursor,
+                 attachment_disposition, DOWNLOAD_PASSTHROUGH_HEADERS)
+from changes import GOOGLE_FILE_FIELDS
+from clients import close_async_clients, configure_async_clients, get_async_client
+from fingerprints import ContentHasher
+from jobs import JobProgress, TRANSFER_DIRECTIONS
+from listings import ListingError, ITEMS_KEY, parse_fields, parse_page_size, page_request, page_result
+from metrics import ROUTE_LATENCY, TRANSFERS_IN_FLIGHT, render as render_metrics
+from tokens import TokenRefreshError
+from providers import STORAGE_PROVIDERS, get_provider
+from transfer import TransferError, choose_chunk_size
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_NAMES = {name: provider.display_name for name, provider in STORAGE_PROVIDERS.items()}
+# As the Flask routes word it
+SIGN_IN_NAMES = {name: provider.sign_in_name for name, provider in STORAGE_PROVIDERS.items()}
+
+configure_async_clients(max_connections=flask_app.config["ASYNC_HTTP_MAX_CONNECTIONS"],
+                        max_keepalive_connections=flask_app.config["ASYNC_HTTP_MAX_KEEPALIVE_CONNECTIONS"],
+                        pool_shards=flask_app.config["ASYNC_HTTP_POOL_SHARDS"])
+
+
+class APIError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _in_app_context(function, *args, **kwargs):
+    with flask_app.app_context():
+        return function(*args, **kwargs)
+
+
+async def in_app_context(function, *args, **kwargs):
+    """Run blocking (database) work on the thread pool inside a Flask app context."""
+    return await run_in_threadpool(_in_app_context, function, *args, **kwargs)
+
+
+def request_user_id(request):
+    """The user ID from a Bearer JWT or the Flask session cookie, or None."""
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        try:
+            with flask_app.app_context():
+                claims = decode_token(authorization[len('Bearer '):])
+        except Exception as e:
+            logger.warning(f"Rejected token: {e}")
+            raise APIError("Invalid or expired token", 401)
+        if claims.get('type') != 'access':
+            raise APIError("Invalid or expired token", 401)
+        return int(claims['sub'])
+    cookie = request.cookies.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if not cookie:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds())).get('user_id')
+    except BadSignature:
+        return None
+
+
+async def signed_in(request, *providers):
+    """The request's user, who must be signed in to every provider given."""
+    user_id = request_user_id(request)
+    user = await in_app_context(user_cache.get, user_id) if user_id is not None else None
+    for provider in providers:
+        if not user or not getattr(user, f'{provider}_token'):
+            if len(providers) > 1:
+                raise APIError("User not authenticated with both Google Drive and OneDrive", 401)
+            logger.warning(f"User not authenticated with {SIGN_IN_NAMES[provider]}")
+            raise APIError(f"User not authenticated with {SIGN_IN_NAMES[provider]}", 401)
+    if not user:
+        raise APIError("User not authenticated", 401)
+    return user
+
+
+async def access_token(user, provider):
+    # A dict lookup unless the token is due for a refresh, which blocks
+    return await run_in_threadpool(token_manager.access_token, user, provider)
+
+
+def checked_provider(provider):
+    if provider not in PROVIDER_NAMES:
+        raise APIError("Not found", 404)
+    return provider
+
+
+async def file_metadata(user, provider, file_id, token, fields=('name',)):
+    """Metadata for a file from the cache, else from the provider; None if not found."""
+    item = metadata_cache.get(user.id, provider, file_id, fields)
+    if item is not None:
+        return item
+    item = await get_provider(provider).stat_async(token, file_id)
+    if item is None:
+        return None
+    metadata_cache.put_many(user.id, provider, [item])
+    return item
+
+
+def chunk_size(total_size):
+    return choose_chunk_size(total_size, flask_app.config["TRANSFER_CHUNK_SIZE"],
+                             flask_app.config["TRANSFER_MAX_CHUNK_SIZE"])
+
+
+@asynccontextmanager
+async def lifespan(_):
+    yield
+    await cancel_transfers()
+    await close_async_clients()
+
+
+app = FastAPI(title="Cloud File Manager (async)", lifespan=lifespan)
+
+
+@app.middleware('http')
+async def time_route(request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    ROUTE_LATENCY.labels('asgi', request.method, route.path if route else 'unmatched',
+                         response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+@app.exception_handler(APIError)
+async def api_error(request, e):
+    return JSONResponse({"error": e.message}, status_code=e.status)
+
+
+@app.exception_handler(ListingError)
+async def listing_error(request, e):
+    logger.error(f"{e.message}: {e.status}")
+    return JSONResponse({"error": e.message}, status_code=e.status)
+
+
+@app.exception_handler(TokenRefreshError)
+async def token_refresh_failed(request, e):
+    return JSONResponse({"error": e.message}, status_code=401)
+
+
+@app.get('/files/{provider}')
+async def list_files(provider: str, request: Request):
+    """One page of files; the same fields, page_size and cursor parameters as the Flask listing.
+
+    all=1 is only served by the Flask app.
+    """
+    provider = checked_provider(provider)
+    user = await signed_in(request, provider)
+    token = await access_token(user, provider)
+    fields = parse_fields(request.query_params.get('fields'))
+    page_size = parse_page_size(provider, request.query_params.get('page_size'))
+    cursor = request.query_params.get('cursor')
+    if request.query_params.get('all', '').lower() in ('1', 'true'):
+        raise APIError("all=1 is not supported here; page with cursor instead", 400)
+
+    async def fetch(fields=None):
+        url, params = page_request(provider, GOOGLE_FILE_FIELDS, fields, page_size, cursor)
+        response = await get_async_client(provider).get(url, params=params,
+                                                         headers={'Authorization': f'Bearer {token}'})
+        return page_result(provider, response)
+
+    if cursor or page_size:
+        body, items, next_cursor = await fetch(fields)
+        if fields is None:
+            metadata_cache.put_many(user.id, provider, items)
+        return listing_body(provider, body, items, next_cursor, None)
+
+    # Checking a cached listing polls the change feed, which is blocking
+    listing = await run_in_threadpool(metadata_cache.get_listing, user.id, provider, token)
+    if listing is None:
+        change_cursor = await run_in_threadpool(listing_cursor, provider, token)
+        body, items, next_cursor = await fetch()
+        listing = metadata_cache.put_listing(user.id, provider, listing_body(provider, body, items, next_cursor, None),
+                                             items, change_cursor)
+    body = listing.body
+    return listing_body(provider, body, body[ITEMS_KEY[provider]], body['next_cursor'], fields)
+
+
+@app.post('/upload/{provider}')
+async def upload_file(provider: str, request: Request, name: str = ''):
+    """Upload the request body as a file called name; Content-Length is required."""
+    provider = checked_provider(provider)
+    user = await signed_in(request, provider)
+    token = await access_token(user, provider)
+    if not name:
+        logger.warning("Empty filename provided")
+        raise APIError("No file name given", 400)
+    try:
+        total_size = int(request.headers['Content-Length'])
+    except (KeyError, ValueError):
+        raise APIError("Content-Length is required", 411)
+    content_type = request.headers.get('Content-Type', 'application/octet-stream')
+
+    logger.info(f"Uploading file to {PROVIDER_NAMES[provider]}: {name} ({total_size} bytes)")
+    hasher = ContentHasher()
+    try:
+        item = await get_provider(provider).write_async(
+            async_transfer.iter_chunks(request.stream(), chunk_size(total_size), hasher), name, total_size, token,
+            content_type)
+    except TransferError as e:
+        logger.error(f"{e.message}: {name}")
+        return JSONResponse({"error": e.message, "status": e.status}, status_code=500)
+    metadata_cache.evict(user.id, provider)
+    metadata_cache.put_many(user.id, provider, [item])
+    await in_app_context(fingerprint_store.record, user.id, provider, item, hasher.hashes(), hasher.size)
+    logger.info(f"Upload completed for file: {name}")
+    return item
+
+
+@app.get('/download/{provider}/{file_id}')
+async def download_file(provider: str, file_id: str, request: Request):
+    """Stream a file's content through; Range and If-Range are passed to the provider."""
+    provider = checked_provider(provider)
+    user = await signed_in(request, provider)
+    token = await access_token(user, provider)
+    metadata = await file_metadata(user, provider, file_id, token)
+    if metadata is None:
+        logger.error(f"File not found on {PROVIDER_NAMES[provider]}: {file_id}")
+        raise APIError("File not found", 404)
+    file_name = metadata.get('name', 'downloaded_file')
+
+    headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'identity'}
+    for header in ('Range', 'If-Range'):
+        if header in request.headers:
+            headers[header] = request.headers[header]
+    logger.info(f"Downloading file from {PROVIDER_NAMES[provider]}: {file_name} ({file_id})")
+    upstream = await get_async_client(provider).get(get_provider(provider).content_url(file_id), headers=headers,
+                                                     stream=True)
+    if upstream.status_code == 416:
+        await upstream.aclose()
+        return Response(status_code=416, headers={'Content-Range': upstream.headers.get('Content-Range', '')})
+    if upstream.status_code not in (200, 206):
+        await upstream.aclose()
+        logger.error(f"Failed to download file from {PROVIDER_NAMES[provider]}: {file_id}")
+        raise APIError("Failed to download file", 500)
+
+    async def body():
+        # Also runs when the client goes away mid-stream
+        try:
+            async for chunk in upstream.aiter_raw(flask_app.config["DOWNLOAD_CHUNK_SIZE"]):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    response_headers = {name: upstream.headers[name] for name in DOWNLOAD_PASSTHROUGH_HEADERS
+                        if name in upstream.headers}
+    response_headers.setdefault('Content-Type', 'application/octet-stream')
+    response_headers.setdefault('Accept-Ranges', 'bytes')
+    response_headers['Content-Disposition'] = dump_options_header('attachment', attachment_disposition(file_name))
+    return StreamingResponse(body(), status_code=upstream.status_code, headers=response_headers)
+
+
+@app.delete('/delete/{provider}/{file_id}')
+async def delete_file(provider: str, file_id: str, request: Request):
+    provider = checked_provider(provider)
+    user = await signed_in(request, provider)
+    token = await access_token(user, provider)
+    logger.info(f"Deleting file from {PROVIDER_NAMES[provider]}: {file_id}")
+    status = await get_provider(provider).delete_async(token, file_id)
+    if status != 204:
+        logger.error(f"Failed to delete file from {PROVIDER_NAMES[provider]}: {file_id}, status: {status}")
+        return JSONResponse({"error": "Failed to delete file", "status": status}, status_code=status)
+    metadata_cache.evict(user.id, provider, file_id)
+    logger.info(f"Successfully deleted file from {PROVIDER_NAMES[provider]}: {file_id}")
+    return {"success": True, "message": "File deleted successfully"}
+
+
+# Single-file transfers, each a task on the event loop
+
+running_transfers = {}
+
+
+class AsyncJobProgress(JobProgress):
+    """JobProgress that writes to the database from the thread pool, never blocking the event loop."""
+
+    def __init__(self, queue, job_id):
+        super().__init__(queue, job_id)
+        self._pending = None
+
+    def _flush(self):
+        # A write still in flight is left to finish; the next advance() writes the newer figures
+        if self._pending and not self._pending.done():
+            return
+        self._flushed = time.monotonic()
+        self._pending = asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            self._queue.update_job, self.job_id, file_name=self.file_name, bytes_total=self.bytes_total,
+            bytes_done=self.bytes_done, heartbeat_at=datetime.datetime.now()))
+
+    async def flushed(self):
+        if self._pending:
+            await self._pending
+
+
+async def copy_file(user, direction, file_id, progress):
+    """Stream one file from the source drive to the destination; the async app.copy_file."""
+    source, destination = TRANSFER_DIRECTIONS[direction]
+    source_storage, destination_storage = get_provider(source), get_provider(destination)
+    source_token = await access_token(user, source)
+    logger.info(f"Getting metadata for {PROVIDER_NAMES[source]} file: {file_id}")
+    metadata = await file_metadata(user, source, file_id, source_token, source_storage.transfer_fields)
+    if metadata is None:
+        raise TransferError(f"File not found on {PROVIDER_NAMES[source]}", 404)
+    file_name = metadata.get('name', 'transferred_file')
+
+    existing = await in_app_context(find_existing_copy, user, source, metadata, destination)
+    if existing:
+        size = int(existing.get('size') or 0)
+        progress.start(file_name, size)
+        progress.advance(size)
+        logger.info(f"Identical file already on {PROVIDER_NAMES[destination]}, skipping transfer: {file_name}")
+        return {"success": True, "skipped": True, "message": f"Identical file already on {PROVIDER_NAMES[destination]}",
+                "destination": PROVIDER_NAMES[destination], "file": existing}
+
+    logger.info(f"Downloading file from {PROVIDER_NAMES[source]}: {file_name} ({file_id})")
+    try:
+        download = await source_storage.read_async(source_token, file_id)
+    except TransferError as e:
+        raise TransferError(f"Failed to download file from {PROVIDER_NAMES[source]}", e.status)
+    try:
+        total_size = int(metadata.get('size') or download.headers.get('Content-Length', 0)) or None
+        content_type = (source_storage.content_type(metadata)
+                        or download.headers.get('Content-Type', 'application/octet-stream'))
+        progress.start(file_name, total_size)
+
+        logger.info(f"Uploading file to {PROVIDER_NAMES[destination]}: {file_name} ({total_size} bytes)")
+        hasher = ContentHasher()
+        chunks = async_transfer.iter_chunks(async_transfer.source_pieces(download), chunk_size(total_size), hasher)
+        destination_token = await access_token(user, destination)
+        item = await destination_storage.write_async(chunks, file_name, total_size, destination_token, content_type,
+                                                     progress=progress.advance)
+    finally:
+        await download.aclose()
+
+    metadata_cache.evict(user.id, destination)
+    metadata_cache.put_many(user.id, destination, [item])
+    await in_app_context(record_transfer, user, source, metadata, destination, item, hasher)
+    logger.info(f"File transferred successfully to {PROVIDER_NAMES[destination]}: {file_name}")
+    return {"success": True, "message": "File transferred successfully", "destination": PROVIDER_NAMES[destination],
+            "file": item}
+
+
+async def run_transfer(user, job_id, direction, file_id):
+    progress = transfer_queue.active[job_id]
+    try:
+        with TRANSFERS_IN_FLIGHT.labels(direction).track_inprogress():
+            result = await copy_file(user, direction, file_id, progress)
+        values = {'status': 'completed', 'result': result}
+        logger.info(f"Transfer job {job_id} completed")
+    except asyncio.CancelledError:
+        # Shutting down: hand the job to the Flask queue to run again
+        await progress.flushed()
+        await in_app_context(transfer_queue.update_job, job_id, status='queued', started_at=None)
+        logger.warning(f"Transfer job {job_id} returned to the queue")
+        raise
+    except Exception as e:
+        logger.exception(f"Transfer job {job_id} failed")
+        values = {'status': 'failed', 'error': getattr(e, 'message', str(e))}
+    finally:
+        transfer_queue.active.pop(job_id, None)
+        running_transfers.pop(job_id, None)
+    await progress.flushed()
+    await in_app_context(transfer_queue.update_job, job_id, bytes_done=progress.bytes_done,
+                         finished_at=datetime.datetime.now(), **values)
+
+
+def create_running_job(user_id, direction, file_id):
+    now = datetime.datetime.now()
+    job = TransferJob(user_id=user_id, direction=direction, file_id=file_id, status='running', started_at=now,
+                      heartbeat_at=now)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+async def cancel_transfers():
+    tasks = list(running_transfers.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@app.post('/transfer/{direction}/{file_id}', status_code=202)
+async def transfer_file(direction: str, file_id: str, request: Request):
+    if direction not in TRANSFER_DIRECTIONS:
+        raise APIError("Not found", 404)
+    user = await signed_in(request, *TRANSFER_DIRECTIONS[direction])
+    job_id = await in_app_context(create_running_job, user.id, direction, file_id)
+    # Registered with the queue so job_status reports live progress and the queue never requeues it as stale
+    transfer_queue.active[job_id] = AsyncJobProgress(transfer_queue, job_id)
+    running_transfers[job_id] = asyncio.create_task(run_transfer(user, job_id, direction, file_id))
+    logger.info(f"Started transfer job {job_id}: {direction} {file_id}")
+    status_url = f'/jobs/{job_id}'
+    return JSONResponse({"success": True, "job_id": job_id, "status": "running", "status_url": status_url},
+                        status_code=202, headers={'Location': status_url})
+
+
+def owned_job_status(user_id, job_id):
+    job = db.session.get(TransferJob, job_id)
+    if not job or job.user_id != user_id:
+        return None
+    return job_status(job)
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str, request: Request):
+    user = await signed_in(request)
+    status = await in_app_context(owned_job_status, user.id, job_id)
+    if status is None:
+        raise APIError("Job not found", 404)
+    return status
+
+
+@app.get('/metrics')
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
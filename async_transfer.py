@@ -0,0 +1,252 @@
+"""Asyncio streaming transfers and chunked uploads, for the ASGI app.
+
+The same protocol handling as transfer.py (chunk sizes, one simple upload
+for small files, upload sessions for the rest, resuming a chunk from the
+offset the session reports) over async byte sources and the pooled async
+clients. A transfer only holds the event loop while it copies bytes, so one
+process can keep hundreds of them moving.
+
+The source is packed into whole chunks as it arrives; the next chunk is read
+while the previous one is being sent, so at most two are held at a time.
+"""
+import asyncio
+import json
+import logging
+
+import httpx
+
+from clients import get_async_client
+from transfer import (GOOGLE_API_URL, GRAPH_API_URL, READ_SIZE, UPLOAD_ATTEMPTS, UPLOAD_RESULT_FIELDS,
+                      TransferError, onedrive_item_path)
+
+logger = logging.getLogger(__name__)
+
+
+async def open_source(provider, url, headers):
+    """Open a provider content URL for streaming, or raise TransferError; the caller must aclose it."""
+    response = await get_async_client(provider).get(url, headers={**headers, 'Accept-Encoding': 'identity'},
+                                                    stream=True)
+    if response.status_code != 200:
+        await response.aclose()
+        raise TransferError("Failed to download source file", response.status_code)
+    return response
+
+
+def source_pieces(response):
+    return response.aiter_raw(READ_SIZE)
+
+
+async def iter_chunks(pieces, chunk_size, hasher=None):
+    """Pack an async iterator of byte pieces into chunk_size chunks; only the last may be shorter."""
+    buffer = bytearray()
+    async for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            chunk = bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+            if hasher:
+                # Hashing a few MB takes milliseconds; keep it off the event loop
+                await asyncio.to_thread(hasher.update, chunk)
+            yield chunk
+    if buffer:
+        chunk = bytes(buffer)
+        if hasher:
+            await asyncio.to_thread(hasher.update, chunk)
+        yield chunk
+
+
+async def _resume_chunk(provider, policy, chunk, offset, put, query_offset):
+    """PUT one chunk, resuming from the session's reported offset on failure.
+
+    Returns the last provider response, or None if the session had already
+    received the whole chunk.
+    """
+    end = offset + len(chunk)
+    sent = offset
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            response = await put(chunk[sent - offset:], sent)
+            delay = policy.retry_chunk(response, attempt)
+            if delay is None:
+                return response
+            logger.warning(f"{provider} chunk at {sent} failed with {response.status_code} (attempt {attempt})")
+        except httpx.TransportError as e:
+            logger.warning(f"{provider} chunk at {sent} lost connection (attempt {attempt}): {e}")
+            delay = policy.retry_chunk_error(e, attempt)
+        if attempt == UPLOAD_ATTEMPTS:
+            break
+        await asyncio.sleep(delay)
+        # Ask the session how much it has, then send only the rest
+        sent, response = await query_offset()
+        if response is not None:
+            return response
+        if sent is None or not offset <= sent <= end:
+            raise TransferError(f"{provider} upload session lost the chunk at offset {offset}")
+        if sent == end:
+            return None
+    raise TransferError(f"Failed to upload chunk to {provider}")
+
+
+async def _send_all(first, rest, send, on_chunk=None):
+    """Send chunks in order, reading each one while the one before it is in flight.
+
+    Returns (bytes sent, last provider response).
+    """
+    pending = None
+    last = None
+    offset = 0
+
+    async def chunks():
+        yield first
+        async for chunk in rest:
+            yield chunk
+
+    try:
+        async for chunk in chunks():
+            if on_chunk:
+                on_chunk(chunk, offset)
+            if pending:
+                last = await pending or last
+            pending = asyncio.ensure_future(send(chunk, offset))
+            offset += len(chunk)
+        if pending:
+            last = await pending or last
+    except BaseException:
+        if pending:
+            pending.cancel()
+        raise
+    return offset, last
+
+
+async def upload_to_onedrive(chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                             api_url=GRAPH_API_URL, progress=None, parent_id=None):
+    """Upload an async chunk iterator to OneDrive and return the created item.
+
+    Arguments are as for transfer.upload_to_onedrive.
+    """
+    if total_size is None:
+        raise TransferError("File size is required for a OneDrive upload session")
+
+    chunk_iter = chunks.__aiter__()
+    first = await anext(chunk_iter, b'')
+    item_path = onedrive_item_path(file_name, parent_id)
+    client = get_async_client('onedrive')
+    if len(first) == total_size:
+        response = await client.put(f'{api_url}/me/drive/{item_path}/content', content=first, headers={
+            'Authorization': f'Bearer {access_token}', 'Content-Type': content_type})
+        if response.status_code not in (200, 201):
+            raise TransferError("Failed to upload file to OneDrive", response.status_code)
+        if progress:
+            progress(total_size)
+        return response.json()
+
+    session_response = await client.post(f'{api_url}/me/drive/{item_path}/createUploadSession',
+                                         headers={'Authorization': f'Bearer {access_token}'})
+    upload_url = session_response.json().get('uploadUrl') if session_response.is_success else None
+    if not upload_url:
+        raise TransferError("Failed to create upload session for OneDrive", session_response.status_code)
+
+    async def put(data, start):
+        return await client.put(upload_url, content=data, retry=False, headers={
+            'Content-Range': f'bytes {start}-{start + len(data) - 1}/{total_size}'})
+
+    async def query_offset():
+        # Upload URLs are pre-authenticated; GET reports nextExpectedRanges
+        status = await client.get(upload_url)
+        if status.status_code != 200:
+            return None, None
+        ranges = status.json().get('nextExpectedRanges') or []
+        return (int(ranges[0].split('-')[0]) if ranges else None), None
+
+    async def send(chunk, offset):
+        response = await _resume_chunk('OneDrive', client.policy, chunk, offset, put, query_offset)
+        if response is not None and response.status_code not in (200, 201, 202):
+            raise TransferError("Failed to upload chunk to OneDrive", response.status_code)
+        if progress:
+            progress(offset + len(chunk))
+        return response
+
+    try:
+        sent, response = await _send_all(first, chunk_iter, send)
+        if sent != total_size or response is None or response.status_code not in (200, 201):
+            raise TransferError("Failed to complete upload to OneDrive",
+                                response.status_code if response is not None else None)
+    except BaseException:
+        await client.delete(upload_url)
+        raise
+    return response.json()
+
+
+async def upload_to_google(chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                           api_url=GOOGLE_API_URL, progress=None, parent_id=None):
+    """Upload an async chunk iterator to Google Drive and return the created file.
+
+    Arguments are as for transfer.upload_to_google; chunks must come from
+    iter_chunks so that only the last one is short.
+    """
+    metadata = {'name': file_name}
+    if parent_id:
+        metadata['parents'] = [parent_id]
+    chunk_iter = chunks.__aiter__()
+    first = await anext(chunk_iter, b'')
+    client = get_async_client('google')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if total_size is not None and len(first) == total_size:
+        files = {'metadata': ('metadata', json.dumps(metadata), 'application/json'),
+                 'file': (file_name, first, content_type)}
+        response = await client.post(f'{api_url}/upload/drive/v3/files?uploadType=multipart&fields={UPLOAD_RESULT_FIELDS}',
+                                     headers=headers, files=files)
+        if response.status_code not in (200, 201):
+            raise TransferError("Failed to upload file to Google Drive", response.status_code)
+        if progress:
+            progress(len(first))
+        return response.json()
+
+    session_headers = {**headers, 'X-Upload-Content-Type': content_type}
+    if total_size is not None:
+        session_headers['X-Upload-Content-Length'] = str(total_size)
+    session_response = await client.post(
+        f'{api_url}/upload/drive/v3/files?uploadType=resumable&fields={UPLOAD_RESULT_FIELDS}',
+        headers=session_headers, json=metadata)
+    upload_url = session_response.headers.get('Location')
+    if session_response.status_code != 200 or not upload_url:
+        raise TransferError("Failed to create upload session for Google Drive", session_response.status_code)
+
+    # Until the source ends the total may be unknown; a short chunk is always the last
+    state = {'total': '*' if total_size is None else total_size, 'chunk_size': len(first)}
+
+    async def put(data, start):
+        content_range = f'bytes {start}-{start + len(data) - 1}/{state["total"]}' if len(data) else f'bytes */{state["total"]}'
+        return await client.put(upload_url, content=data, retry=False, headers={'Content-Range': content_range})
+
+    async def query_offset():
+        # An empty PUT reports how much the session has stored
+        status = await client.put(upload_url, content=b'', headers={'Content-Range': f'bytes */{state["total"]}'})
+        if status.status_code in (200, 201):
+            return None, status
+        if status.status_code != 308:
+            return None, None
+        received = status.headers.get('Range')
+        return (int(received.rsplit('-', 1)[1]) + 1 if received else 0), None
+
+    async def send(chunk, offset):
+        response = await _resume_chunk('Google Drive', client.policy, chunk, offset, put, query_offset)
+        if response is not None and response.status_code not in (200, 201, 308):
+            raise TransferError("Failed to upload chunk to Google Drive", response.status_code)
+        if progress:
+            progress(offset + len(chunk))
+        return response
+
+    def note_last(chunk, offset):
+        if len(chunk) < state['chunk_size']:
+            state['total'] = offset + len(chunk)
+
+    sent, response = await _send_all(first, chunk_iter, send, on_chunk=note_last)
+    if state['total'] == '*':
+        # Source ended on a chunk boundary; close the session with an empty request
+        state['total'] = sent
+        response = await send(b'', sent)
+    if response is None or response.status_code not in (200, 201):
+        raise TransferError("Failed to complete upload to Google Drive",
+                            response.status_code if response is not None else None)
+    return response.json()
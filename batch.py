@@ -0,0 +1,141 @@
+"""Batched deletes against the Drive and Graph batch endpoints.
+
+Google accepts up to 100 calls per multipart/mixed request to batch/drive/v3
+and Graph up to 20 per JSON $batch request. Batches are sent concurrently
+through a small thread pool and every file gets its own result. Deletes the
+provider throttled inside an otherwise successful batch are batched again
+after the provider policy's backoff.
+"""
+import json
+import logging
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from clients import get_client
+from metrics import RETRIES
+from throttling import GOOGLE_RATE_LIMIT_REASONS
+from transfer import GOOGLE_API_URL, GRAPH_API_URL
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_BATCH_SIZE = 100
+GRAPH_BATCH_SIZE = 20
+# Per-call statuses worth sending again
+THROTTLED_STATUSES = (429, 503)
+
+
+def _groups(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _result(file_id, status, error=None):
+    result = {"file_id": file_id, "success": status in (200, 204), "status": status}
+    if error:
+        result["error"] = error
+    return result
+
+
+def _run_batches(provider, send, file_ids, size, max_workers):
+    policy = get_client(provider).policy
+    results = {}
+    pending = list(dict.fromkeys(file_ids))
+    for attempt in range(1, policy.max_retries + 2):
+        groups = _groups(pending, size)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            for result in (result for batch in executor.map(send, groups) for result in batch):
+                results[result["file_id"]] = result
+        pending = [file_id for file_id in pending if results[file_id]["status"] in THROTTLED_STATUSES]
+        if not pending or attempt > policy.max_retries:
+            break
+        policy.throttled()
+        RETRIES.labels(provider, 'batch_throttled').inc(len(pending))
+        delay = policy.backoff(attempt)
+        logger.warning(f"{len(pending)} {provider} batch deletes throttled; retrying in {delay:.1f}s")
+        time.sleep(delay)
+    return [results[file_id] for file_id in file_ids]
+
+
+def google_batch_delete(file_ids, access_token, max_workers=4, api_url=GOOGLE_API_URL):
+    def send(group):
+        boundary = f'batch_{uuid.uuid4().hex}'
+        parts = [
+            f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{index}>\r\n\r\n'
+            f'DELETE /drive/v3/files/{file_id} HTTP/1.1\r\n\r\n'
+            for index, file_id in enumerate(group)
+        ]
+        body = ''.join(parts) + f'--{boundary}--\r\n'
+        try:
+            response = get_client('google').post(f'{api_url}/batch/drive/v3', content=body.encode(), headers={
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': f'multipart/mixed; boundary={boundary}'
+            })
+        except httpx.HTTPError as e:
+            return [_result(file_id, 502, str(e)) for file_id in group]
+        if response.status_code != 200:
+            return [_result(file_id, response.status_code, "Batch request failed") for file_id in group]
+
+        statuses = _parse_google_batch(response)
+        return [_result(file_id, *statuses.get(str(index), (502, "Missing from batch response")))
+                for index, file_id in enumerate(group)]
+
+    logger.info(f"Deleting {len(file_ids)} files from Google Drive in batches of {GOOGLE_BATCH_SIZE}")
+    return _run_batches('google', send, file_ids, GOOGLE_BATCH_SIZE, max_workers)
+
+
+def _parse_google_batch(response):
+    """Map request Content-ID to (status, error message) from a multipart/mixed reply."""
+    match = re.search(r'boundary="?([^";]+)"?', response.headers.get('Content-Type', ''))
+    if not match:
+        return {}
+    statuses = {}
+    for part in response.text.split(f'--{match[1]}'):
+        content_id = re.search(r'Content-ID:\s*<response-([^>]+)>', part, re.IGNORECASE)
+        status_line = re.search(r'HTTP/1\.1 (\d{3})', part)
+        if not content_id or not status_line:
+            continue
+        status = int(status_line[1])
+        error = None
+        if status not in (200, 204):
+            body = re.split(r'\r?\n\r?\n', part.strip(), maxsplit=2)[-1]
+            try:
+                details = json.loads(body)['error']
+                error = details['message']
+            except (ValueError, KeyError, TypeError):
+                details, error = {}, "Failed to delete file"
+            # Drive reports per-call rate limiting as a 403; treat it as the 429 it means
+            if status == 403 and any(item.get('reason') in GOOGLE_RATE_LIMIT_REASONS
+                                     for item in details.get('errors', [])):
+                status = 429
+        statuses[content_id[1]] = (status, error)
+    return statuses
+
+
+def graph_batch_delete(file_ids, access_token, max_workers=4, api_url=GRAPH_API_URL):
+    def send(group):
+        payload = {"requests": [
+            {"id": str(index), "method": "DELETE", "url": f"/me/drive/items/{file_id}"}
+            for index, file_id in enumerate(group)
+        ]}
+        try:
+            response = get_client('onedrive').post(f'{api_url}/$batch', json=payload,
+                                                   headers={'Authorization': f'Bearer {access_token}'})
+        except httpx.HTTPError as e:
+            return [_result(file_id, 502, str(e)) for file_id in group]
+        if response.status_code != 200:
+            return [_result(file_id, response.status_code, "Batch request failed") for file_id in group]
+
+        statuses = {}
+        for item in response.json().get('responses', []):
+            error = None
+            if item.get('status') not in (200, 204):
+                error = (item.get('body') or {}).get('error', {}).get('message', "Failed to delete file")
+            statuses[item.get('id')] = (item.get('status', 502), error)
+        return [_result(file_id, *statuses.get(str(index), (502, "Missing from batch response")))
+                for index, file_id in enumerate(group)]
+
+    logger.info(f"Deleting {len(file_ids)} files from OneDrive in batches of {GRAPH_BATCH_SIZE}")
+    return _run_batches('onedrive', send, file_ids, GRAPH_BATCH_SIZE, max_workers)
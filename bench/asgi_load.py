@@ -0,0 +1,272 @@
+"""Concurrent downloads and transfers against the Flask app and the ASGI app.
+
+Each app is started in its own process on a fresh SQLite database with one
+signed-in user, talking to bench/mock_cloud.py in place of Drive and Graph
+(a transport rewrites the provider hosts). The load generator then opens
+every download and transfer at once and reports latency, failures, and the
+server's peak thread count and RSS.
+
+    python bench/asgi_load.py                                   # 200 downloads, 100 transfers
+    python bench/asgi_load.py --downloads 500 --transfers 0 --size 1M --rate 512K
+    python bench/asgi_load.py --apps asgi
+
+The Flask app runs on Werkzeug's threaded server with one transfer worker per
+transfer (TRANSFER_WORKERS), so neither side is held back by a queue limit.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROVIDER_HOSTS = ('www.googleapis.com', 'graph.microsoft.com')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def proc_status(pid):
+    """(RSS bytes, threads) of a process, from /proc."""
+    values = {}
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            name, _, value = line.partition(':')
+            values[name] = value.split()
+    return int(values['VmRSS'][0]) * 1024, int(values['Threads'][0])
+
+
+# Server side: runs in the child process started with --serve
+
+def redirect_to_mock(request, mock):
+    if request.url.host in PROVIDER_HOSTS:
+        request.url = request.url.copy_with(scheme='http', host=mock.host, port=mock.port)
+        request.headers['Host'] = f'{mock.host}:{mock.port}'
+
+
+def serve(kind, port, mock_url, connections):
+    import logging
+
+    sys.path.insert(0, ROOT)
+    import clients
+    from app import app, db, User
+    from flask_jwt_extended import create_access_token
+    from search import install_search_index
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    mock = httpx.URL(mock_url)
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+
+    class MockTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            redirect_to_mock(request, mock)
+            return super().handle_request(request)
+
+    class AsyncMockTransport(httpx.AsyncHTTPTransport):
+        async def handle_async_request(self, request):
+            redirect_to_mock(request, mock)
+            return await super().handle_async_request(request)
+
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as connection:
+            install_search_index(connection)
+        token = {'access_token': 'bench', 'refresh_token': 'bench', 'expires_at': time.time() + 10 ** 6}
+        user = User(email='bench@example.com', google_token=token, onedrive_token=token)
+        db.session.add(user)
+        db.session.commit()
+        print(json.dumps({'token': create_access_token(identity=str(user.id))}), flush=True)
+
+    for provider in clients.PROVIDERS:
+        clients.get_client(provider)._client._transport = MockTransport(limits=limits)
+    if kind == 'flask':
+        from app import transfer_queue
+        from werkzeug.serving import run_simple
+        transfer_queue.start()
+        run_simple('127.0.0.1', port, app, threaded=True)
+    else:
+        import uvicorn
+        from asgi import app as asgi_app
+        shard_limits = httpx.Limits(max_connections=connections // 10 + 1, max_keepalive_connections=connections // 10 + 1)
+        for provider in clients.PROVIDERS:
+            for client in clients.get_async_client(provider)._clients:
+                client._transport = AsyncMockTransport(limits=shard_limits)
+        uvicorn.run(asgi_app, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+
+
+# Load generator
+
+async def download(client, base_url, provider, size):
+    started = time.perf_counter()
+    received = 0
+    async with client.stream('GET', f'{base_url}/download/{provider}/{size}') as response:
+        async for piece in response.aiter_raw():
+            received += len(piece)
+    return time.perf_counter() - started, response.status_code == 200 and received == size
+
+
+poll_errors = [0]
+
+
+async def transfer(client, base_url, direction, size, poll_interval=0.25):
+    started = time.perf_counter()
+    response = await client.post(f'{base_url}/transfer/{direction}/{size}')
+    if response.status_code != 202:
+        return time.perf_counter() - started, False
+    status_url = f"{base_url}{response.json()['status_url']}"
+    while True:
+        await asyncio.sleep(poll_interval)
+        try:
+            response = await client.get(status_url)
+        except httpx.TransportError:
+            response = None
+        if response is None or response.status_code != 200:
+            # An overloaded server may fail a status check; the transfer itself can still finish
+            poll_errors[0] += 1
+            continue
+        job = response.json()
+        if job['status'] in ('completed', 'failed'):
+            return time.perf_counter() - started, job['status'] == 'completed'
+
+
+async def failed_on_error(job):
+    started = time.perf_counter()
+    try:
+        return await job
+    except httpx.HTTPError as e:
+        print(f'{type(e).__name__}: {e}', file=sys.stderr)
+        return time.perf_counter() - started, False
+
+
+async def sample(pid, peaks, stop):
+    while not stop.is_set():
+        rss, threads = proc_status(pid)
+        peaks['rss'] = max(peaks['rss'], rss)
+        peaks['threads'] = max(peaks['threads'], threads)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+def summarize(name, results, wall):
+    latencies = sorted(elapsed for elapsed, _ in results)
+    return {
+        f'{name}': len(results),
+        f'{name}_failed': sum(1 for _, ok in results if not ok),
+        f'{name}_p50_s': round(statistics.median(latencies), 2),
+        f'{name}_p95_s': round(latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0], 2),
+        f'{name}_wall_s': round(wall, 2),
+    }
+
+
+async def run_load(base_url, token, pid, downloads, transfers, size):
+    poll_errors[0] = 0
+    peaks = {'rss': 0, 'threads': 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample(pid, peaks, stop))
+    idle_rss, idle_threads = proc_status(pid)
+    report = {'idle_rss_mb': round(idle_rss / 2 ** 20, 1), 'idle_threads': idle_threads}
+    # Idle connections are dropped before the servers' 5 s keep-alive timeout can close them under a request
+    async with httpx.AsyncClient(headers={'Authorization': f'Bearer {token}'}, timeout=600,
+                                 limits=httpx.Limits(max_connections=None, keepalive_expiry=2)) as client:
+        async def timed(jobs):
+            started = time.perf_counter()
+            return await asyncio.gather(*(failed_on_error(job) for job in jobs)), time.perf_counter() - started
+
+        phases = [('downloads', [download(client, base_url, ('google', 'onedrive')[n % 2], size)
+                                 for n in range(downloads)]),
+                  ('transfers', [transfer(client, base_url, ('gdrive-to-onedrive', 'onedrive-to-gdrive')[n % 2], size)
+                                 for n in range(transfers)])]
+        for name, jobs in phases:
+            if jobs:
+                results, wall = await timed(jobs)
+                report.update(summarize(name, results, wall))
+    stop.set()
+    await sampler
+    report['peak_rss_mb'] = round(peaks['rss'] / 2 ** 20, 1)
+    report['peak_threads'] = peaks['threads']
+    report['status_poll_errors'] = poll_errors[0]
+    return report
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Nothing listening on port {port}')
+
+
+def bench(kind, mock_url, args):
+    port = free_port()
+    connections = 2 * max(args.downloads, args.transfers)
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {**os.environ,
+               'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               'JWT_SECRET_KEY': 'bench-secret',
+               'TRANSFER_WORKERS': str(max(args.transfers, 1)),
+               'GOOGLE_TRANSFER_LIMIT': str(max(args.transfers, 1)),
+               'ONEDRIVE_TRANSFER_LIMIT': str(max(args.transfers, 1)),
+               'TRANSFER_SKIP_IDENTICAL': 'false'}
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', kind, '--port', str(port), '--mock', mock_url,
+                                   '--connections', str(connections)],
+                                  cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+        try:
+            token = json.loads(server.stdout.readline())['token']
+            wait_for_port(port)
+            return asyncio.run(run_load(f'http://127.0.0.1:{port}', token, server.pid, args.downloads,
+                                        args.transfers, args.size))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    sys.path.insert(0, HERE)
+    from mock_cloud import parse_rate
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', nargs='+', choices=('flask', 'asgi'), default=['flask', 'asgi'])
+    parser.add_argument('--downloads', type=int, default=200, help='concurrent downloads')
+    parser.add_argument('--transfers', type=int, default=100, help='concurrent transfers')
+    parser.add_argument('--size', default='4M', help='file size, e.g. 4M')
+    parser.add_argument('--rate', default='2M', help='mock provider bytes per second per connection')
+    parser.add_argument('--serve', choices=('flask', 'asgi'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--mock', help=argparse.SUPPRESS)
+    parser.add_argument('--connections', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.port, args.mock, args.connections)
+
+    args.size = parse_rate(args.size)
+    mock_port = free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, 'mock_cloud.py'), '--port', str(mock_port),
+                             '--rate', args.rate], stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(mock_port)
+        for kind in args.apps:
+            print(json.dumps({'app': kind, **bench(kind, f'http://127.0.0.1:{mock_port}', args)}), flush=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Per-call latency of a pooled provider client against one connection per call.
+
+Starts a local HTTPS stub with a throwaway self-signed certificate and times
+small metadata-style GETs made the old way (module-level requests.get, a new
+TCP connection and TLS handshake every time) and through clients.ProviderClient.
+
+    python bench/http_clients.py --calls 500
+"""
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clients import DEFAULT_OPTIONS, POLICY_OPTIONS, ProviderClient  # noqa: E402
+from throttling import ProviderPolicy  # noqa: E402
+
+BODY = json.dumps({'id': 'file-id', 'name': 'report.pdf', 'mimeType': 'application/pdf', 'size': '1024'}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+
+def write_self_signed_cert(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                           critical=False)
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, 'stub.pem')
+    key_path = os.path.join(directory, 'stub.key')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def start_stub(cert_path, key_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_calls(call, count):
+    call()  # warm up
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(label, latencies):
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f'{label:<32} median {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = write_self_signed_cert(directory)
+        server = start_stub(cert_path, key_path)
+        url = f'https://127.0.0.1:{server.server_address[1]}/drive/v3/files/file-id'
+
+        def unpooled():
+            requests.get(url, verify=cert_path).json()
+
+        options = {k: v for k, v in DEFAULT_OPTIONS.items() if k not in POLICY_OPTIONS}
+        client = ProviderClient('bench', ProviderPolicy('bench', None),
+                                **{**options, 'verify': ssl.create_default_context(cafile=cert_path)})
+
+        def pooled():
+            client.get(url).json()
+
+        print(f'{args.calls} GETs against a local TLS stub')
+        report('requests.get (new connection)', time_calls(unpooled, args.calls))
+        report('ProviderClient (pooled)', time_calls(pooled, args.calls))
+        client.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Local stand-in for the Drive v3 and Graph endpoints the app uses.
+
+Downloads are synthetic bytes generated on the fly and uploads are read and
+discarded, so the server itself uses almost no memory whatever the file size.
+A file's ID is its size in bytes, optionally followed by -N to tell files of
+one size apart, so /drive/v3/files/1048576 and /v1.0/me/drive/items/1048576-7
+describe (and serve) a 1 MiB file.
+
+The root listing holds --files files and is paged like the real thing
+(pageSize/nextPageToken, $top/@odata.nextLink). Deletes, one at a time or
+through either batch endpoint, always succeed.
+
+To stand in for a slow or busy provider: --rate caps each download
+connection, --latency delays every response, and --throttle answers that
+fraction of requests with 429 and a Retry-After of --retry-after seconds.
+
+    python bench/mock_cloud.py --port 8900 --rate 2M
+    python bench/mock_cloud.py --files 5000 --latency 0.05 --throttle 0.02
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+BLOCK = bytes(range(256)) * 256  # 64 KiB
+_ids = itertools.count(1)
+_sessions = {}
+
+FILE_ID = r'(\d+)(?:-\d+)?'
+# Default and largest page sizes, as the providers have them
+PAGE_SIZES = {'google': (100, 1000), 'onedrive': (200, 999)}
+
+
+def file_item(provider, file_id):
+    size = int(file_id.split('-')[0])
+    name = f'file-{file_id}.bin'
+    if provider == 'google':
+        return {'id': file_id, 'name': name, 'size': str(size), 'mimeType': 'application/octet-stream'}
+    return {'id': file_id, 'name': name, 'size': size, 'file': {'mimeType': 'application/octet-stream'}}
+
+
+def listed_id(index):
+    # 1 KiB to 512 MiB, over and over
+    return f'{2 ** (10 + index % 20)}-{index}'
+
+
+class MockCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and small JSON bodies go out in separate writes; don't let Nagle hold the body
+    disable_nagle_algorithm = True
+    # Bytes per second per download, or None for as fast as possible
+    rate = None
+    # Seconds added before every response
+    latency = 0
+    # Fraction of requests answered 429, and the Retry-After they carry
+    throttle = 0
+    retry_after = 1
+    files = 20
+    random = random.Random(0)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def discard_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+
+    def delayed_or_throttled(self, throttle=True):
+        """Apply --latency, and answer 429 (returning True) for the --throttle share of requests."""
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle and self.throttle and self.random.random() < self.throttle:
+            self.discard_body()
+            self.send_json(429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}},
+                           {'Retry-After': str(self.retry_after)})
+            return True
+        return False
+
+    def send_bytes(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        started = time.monotonic()
+        sent = 0
+        while sent < size:
+            piece = BLOCK[:min(size - sent, len(BLOCK))]
+            self.wfile.write(piece)
+            sent += len(piece)
+            if self.rate:
+                time.sleep(max(0, started + sent / self.rate - time.monotonic()))
+
+    def listing_page(self, provider, query):
+        default, largest = PAGE_SIZES[provider]
+        if provider == 'google':
+            size, offset = query.get('pageSize'), query.get('pageToken')
+        else:
+            size, offset = query.get('$top'), query.get('$skiptoken')
+        size = min(int(size[0]), largest) if size else default
+        offset = int(offset[0]) if offset else 0
+        end = min(offset + size, self.files)
+        items = [file_item(provider, listed_id(index)) for index in range(offset, end)]
+        if provider == 'google':
+            body = {'kind': 'drive#fileList', 'incompleteSearch': False, 'files': items}
+            if end < self.files:
+                body['nextPageToken'] = str(end)
+            return body
+        body = {'value': items}
+        if end < self.files:
+            body['@odata.nextLink'] = f'{self.base_url}/v1.0/me/drive/root/children?$top={size}&$skiptoken={end}'
+        return body
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        # Upload status checks are never throttled; the uploads only retry the chunks themselves
+        session = re.fullmatch(r'/onedrive-upload/(\d+)', url.path)
+        if self.delayed_or_throttled(throttle=not session):
+            return
+        if session:
+            if int(session[1]) not in _sessions:
+                return self.send_json(404, {'error': 'unknown upload session'})
+            return self.send_json(200, {'nextExpectedRanges': [f'{_sessions[int(session[1])]}-']})
+        if match := re.fullmatch(r'/download/(\d+)', url.path):
+            return self.send_bytes(int(match[1]))
+        if match := re.fullmatch(rf'/drive/v3/files/{FILE_ID}', url.path):
+            if 'alt=media' in url.query:
+                return self.send_bytes(int(match[1]))
+            return self.send_json(200, file_item('google', url.path.rsplit('/', 1)[1]))
+        if match := re.fullmatch(rf'/v1\.0/me/drive/items/{FILE_ID}(/content)?', url.path):
+            if match[2]:
+                return self.send_bytes(int(match[1]))
+            return self.send_json(200, file_item('onedrive', url.path.split('/')[5]))
+        if url.path == '/drive/v3/files':
+            return self.send_json(200, self.listing_page('google', parse_qs(url.query)))
+        if url.path == '/v1.0/me/drive/root/children':
+            return self.send_json(200, self.listing_page('onedrive', parse_qs(url.query)))
+        self.send_json(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        if self.delayed_or_throttled():
+            return
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def google_batch(self):
+        content_ids = re.findall(r'Content-ID:\s*<([^>]+)>', self.read_body().decode(), re.IGNORECASE)
+        boundary = f'batch_{next(_ids)}'
+        parts = [f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                 f'HTTP/1.1 204 No Content\r\n\r\n' for content_id in content_ids]
+        payload = (''.join(parts) + f'--{boundary}--\r\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.delayed_or_throttled():
+            return
+        url = urlsplit(self.path)
+        if url.path == '/batch/drive/v3':
+            return self.google_batch()
+        if url.path == '/v1.0/$batch':
+            requests = json.loads(self.read_body() or b'{}').get('requests', [])
+            return self.send_json(200, {'responses': [{'id': item['id'], 'status': 204} for item in requests]})
+        self.discard_body()
+        if url.path.endswith(':/createUploadSession'):
+            session_id = next(_ids)
+            _sessions[session_id] = 0
+            return self.send_json(200, {'uploadUrl': f'{self.base_url}/onedrive-upload/{session_id}'})
+        if url.path == '/upload/drive/v3/files' and 'uploadType=resumable' in url.query:
+            session_id = next(_ids)
+            _sessions[session_id] = 0
+            return self.send_json(200, {}, {'Location': f'{self.base_url}/google-upload/{session_id}'})
+        if url.path == '/upload/drive/v3/files':
+            return self.send_json(200, {'id': str(next(_ids)), 'name': 'uploaded'})
+        self.send_json(404, {'error': 'not found'})
+
+    def do_PUT(self):
+        path = urlsplit(self.path).path
+        content_range = self.headers.get('Content-Range', '')
+        if self.delayed_or_throttled(throttle=not content_range.startswith('bytes */')):
+            return
+        self.discard_body()
+        if path.endswith(':/content'):
+            return self.send_json(201, {'id': str(next(_ids)), 'name': unquote(path.split(':/')[1])})
+
+        match = re.fullmatch(r'/(onedrive|google)-upload/(\d+)', path)
+        if not match or int(match[2]) not in _sessions:
+            return self.send_json(404, {'error': 'unknown upload session'})
+        provider, session_id = match[1], int(match[2])
+        span = re.fullmatch(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range)
+        if not span:
+            return self.send_json(400, {'error': 'bad Content-Range'})
+        received = int(span[2]) + 1 if span[2] else _sessions[session_id]
+        _sessions[session_id] = received
+        total = int(span[3]) if span[3] != '*' else None
+
+        if received == total:
+            del _sessions[session_id]
+            return self.send_json(201, {'id': str(next(_ids)), 'size': total})
+        if provider == 'onedrive':
+            return self.send_json(202, {'nextExpectedRanges': [f'{received}-']})
+        self.send_response(308)
+        self.send_header('Range', f'bytes=0-{received - 1}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class MockCloudServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open hundreds of connections at once
+    request_queue_size = 1024
+
+
+def serve(port=0, rate=None, latency=0, throttle=0, retry_after=1, files=20, seed=0):
+    MockCloudHandler.rate = rate
+    MockCloudHandler.latency = latency
+    MockCloudHandler.throttle = throttle
+    MockCloudHandler.retry_after = retry_after
+    MockCloudHandler.files = files
+    MockCloudHandler.random = random.Random(seed)
+    return MockCloudServer(('127.0.0.1', port), MockCloudHandler)
+
+
+def parse_rate(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.upper().rstrip('B')
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--rate', help='bytes per second per download, e.g. 2M')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--throttle', type=float, default=0, help='fraction of requests answered 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled requests, in seconds')
+    parser.add_argument('--files', type=int, default=20, help='files in the root listing')
+    parser.add_argument('--seed', type=int, default=0, help='seed for picking the throttled requests')
+    args = parser.parse_args()
+    server = serve(args.port, parse_rate(args.rate) if args.rate else None, args.latency, args.throttle,
+                   args.retry_after, args.files, args.seed)
+    print(f'Mock cloud listening on http://127.0.0.1:{server.server_address[1]}')
+    server.serve_forever()
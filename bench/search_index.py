@@ -0,0 +1,170 @@
+"""Latency of GET /search against a synthetic file index.
+
+Fills a scratch SQLite database with --files indexed files (Zipf-distributed
+words in names, a folder tree for paths, random sizes and dates), then times
+a fixed set of queries through the Flask test client, so routing, query
+building and JSON encoding are all included.
+
+    python bench/search_index.py --files 1000000
+    python bench/search_index.py --db /tmp/search.db   # reuse a filled database
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXTENSIONS = ['pdf', 'docx', 'xlsx', 'txt', 'jpg', 'png', 'mp4', 'csv', 'pptx', 'zip']
+MIME_TYPES = {'pdf': 'application/pdf', 'docx': 'application/msword', 'xlsx': 'application/vnd.ms-excel',
+              'txt': 'text/plain', 'jpg': 'image/jpeg', 'png': 'image/png', 'mp4': 'video/mp4',
+              'csv': 'text/csv', 'pptx': 'application/vnd.ms-powerpoint', 'zip': 'application/zip'}
+COMMON_WORDS = ['report', 'invoice', 'photo', 'draft', 'final', 'budget', 'notes', 'meeting', 'project', 'backup']
+
+QUERIES = [
+    ('rare word', 'q=zebrafinch'),
+    ('mid-frequency word', 'q={mid}'),
+    ('two words', 'q={mid} {common}'),
+    ('word prefix', 'q={mid_prefix}'),
+    ('common word', 'q=report'),
+    ('common word, sorted by name', 'q=report&sort=name'),
+    ('common word, page 10', 'q=report&offset=900&limit=100'),
+    ('one-letter prefix', 'q=r'),
+    ('name prefix', 'q={common} {mid_prefix}&mode=prefix'),
+    ('substring', 'q={infix}&mode=substring'),
+    ('substring, two words', 'q={infix} {common_infix}&mode=substring'),
+    ('filters: size and date', 'q=invoice&min_size=1000000&modified_after=2023-01-01'),
+    ('folder in path', 'q={folder}'),
+    ('mime type + provider', 'q=excel&provider=google'),
+]
+
+
+def make_vocabulary(rng, size=50000):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))))
+    return sorted(words)
+
+
+def fill(app_module, files, seed=7):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    epoch = datetime.datetime(2018, 1, 1)
+
+    IndexedFile = app_module.IndexedFile
+    with app_module.app.app_context():
+        app_module.db.session.add(app_module.User(email='bench@example.com', google_token={}, onedrive_token={}))
+        app_module.db.session.commit()
+
+        # A folder tree a few levels deep; files are spread over its folders
+        folders = [('root', '')]
+        rows = []
+        for provider in ('google', 'onedrive'):
+            for i in range(max(10, files // 200)):
+                parent_id, parent_path = rng.choice(folders[-500:] if i % 3 else folders[:50])
+                name = rng.choice(vocabulary).title() + rng.choice(['', ' Archive', ' 2023', ' Shared'])
+                folder_id = f'{provider}-folder-{i}'
+                folders.append((folder_id, f'{parent_path}/{name}'))
+                rows.append({'user_id': 1, 'provider': provider, 'file_id': folder_id, 'name': name,
+                             'is_folder': True, 'parent_id': parent_id, 'path': f'{parent_path}/{name}',
+                             'mime_type': 'application/vnd.google-apps.folder', 'indexed_at': epoch})
+
+        started = time.perf_counter()
+        table = IndexedFile.__table__
+        batch = []
+        for i in range(files):
+            words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 3))
+            if rng.random() < 0.3:
+                words.insert(0, rng.choice(COMMON_WORDS))
+            if i == files // 2:
+                words.append('zebrafinch')
+            extension = rng.choice(EXTENSIONS)
+            name = f"{rng.choice(' _-').join(words)}_{rng.randint(1, 999)}.{extension}"
+            parent_id, parent_path = rng.choice(folders)
+            batch.append({
+                'user_id': 1, 'provider': 'google' if i % 2 else 'onedrive', 'file_id': f'file-{i}',
+                'name': name, 'size': int(rng.lognormvariate(12, 2.5)), 'mime_type': MIME_TYPES[extension],
+                'is_folder': False, 'parent_id': parent_id, 'path': f'{parent_path}/{name}',
+                'modified_time': epoch + datetime.timedelta(seconds=rng.randint(0, 8 * 365 * 86400)),
+                'content_hash': None, 'hash_algorithm': None, 'indexed_at': epoch,
+            })
+            if len(batch) == 10000:
+                app_module.db.session.execute(table.insert(), batch)
+                batch = []
+        # Folder rows have fewer columns; an executemany needs the same keys in every row
+        for rows_of_a_kind in (batch, rows):
+            if rows_of_a_kind:
+                app_module.db.session.execute(table.insert(), rows_of_a_kind)
+        app_module.db.session.commit()
+        print(f'Inserted {files} files in {time.perf_counter() - started:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--db', help='database file to create, or reuse if it exists')
+    args = parser.parse_args()
+
+    db = args.db or os.path.join(tempfile.mkdtemp(), 'search.db')
+    reuse = os.path.exists(db)
+    os.environ['DATABASE_URL'] = f'sqlite:///{db}'
+    import app as app_module
+    from flask_jwt_extended import create_access_token
+
+    with app_module.app.app_context():
+        app_module.db.create_all()
+    if not reuse:
+        fill(app_module, args.files)
+    # Bulk-load first, then build the FTS tables in one pass, as install_search_index
+    # does for an index that predates them; the triggers then keep them current
+    started = time.perf_counter()
+    with app_module.app.app_context(), app_module.db.engine.begin() as connection:
+        app_module.install_search_index(connection)
+    if not reuse:
+        print(f'Built search index in {time.perf_counter() - started:.1f}s '
+              f'({os.path.getsize(db) / 2**20:.0f} MiB database)')
+
+    vocabulary = make_vocabulary(random.Random(7))
+    # Words at a few points along the Zipf curve, and a folder name
+    mid, common = vocabulary[200], vocabulary[5]
+    values = {'mid': mid, 'mid_prefix': mid[:3], 'common': common, 'infix': mid[1:5],
+              'common_infix': common[1:4], 'folder': vocabulary[100]}
+
+    # /search needs a signed-in user: the one fill() created, by JWT
+    with app_module.app.app_context():
+        user = app_module.User.query.filter_by(email='bench@example.com').one()
+        token = create_access_token(identity=str(user.id))
+    client = app_module.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    print(f'{"query":<32} {"matches":>8} {"sorted":>6} {"median":>9} {"p95":>9}')
+    for label, query in QUERIES:
+        url = '/search?' + query.format(**values)
+        response = client.get(url)  # warm the page cache
+        if response.status_code != 200:
+            sys.exit(f'{label}: /search answered {response.status_code}: {response.get_data(as_text=True)}')
+        # Past the rank limit the app stops counting and only says there are more
+        matches = f"{'>' if response.json['more_matches'] else ''}{response.json['matches']}"
+        ranked = response.json['sorted']
+        latencies = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            client.get(url)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+        print(f'{label:<32} {matches:>8} {str(ranked):>6} {statistics.median(latencies):>7.1f}ms {p95:>7.1f}ms')
+    if not args.db:
+        print(f'Database left at {db}; pass --db to reuse it')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""End-to-end benchmarks of listing, upload, download and transfer.
+
+Starts bench/mock_cloud.py and the app (as bench/asgi_load.py serves it: a
+fresh SQLite database, one signed-in user, provider hosts rewritten to the
+mock), runs each scenario with a fixed number of requests at a fixed
+concurrency, and prints one JSON line per app with each scenario's request
+count, failures, p50/p95 latency and throughput. Nothing leaves the machine,
+and the same arguments give the same workload, so runs can be compared.
+
+    python bench/suite.py --save baseline.json
+    python bench/suite.py --baseline baseline.json           # exits 1 on a regression
+    python bench/suite.py --apps asgi --scenarios download transfer --size 16M --latency 0.02 --throttle 0.01
+
+A scenario regresses when its p95 latency rises, or its throughput falls, by
+more than --tolerance (a fraction) against the baseline, or it fails more
+requests than the baseline did.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from asgi_load import free_port, transfer, wait_for_port  # noqa: E402
+from mock_cloud import parse_rate  # noqa: E402
+
+SCENARIOS = ('listing', 'upload', 'download', 'transfer')
+PROVIDERS = ('google', 'onedrive')
+DIRECTIONS = ('gdrive-to-onedrive', 'onedrive-to-gdrive')
+
+
+async def timed(request):
+    """(seconds, bytes moved, succeeded) of one scenario request."""
+    started = time.perf_counter()
+    try:
+        moved, ok = await request
+    except httpx.HTTPError as e:
+        print(f'{type(e).__name__}: {e}', file=sys.stderr)
+        moved, ok = 0, False
+    return time.perf_counter() - started, moved, ok
+
+
+async def list_page(client, base_url, provider, page_size, index):
+    # A cursor or page_size always goes to the provider, so the listing cache doesn't answer
+    response = await client.get(f'{base_url}/files/{provider}', params={'page_size': page_size})
+    return 0, response.status_code == 200
+
+
+async def upload(client, base_url, kind, provider, content, index):
+    name = f'bench-{index}.bin'
+    if kind == 'flask':
+        response = await client.post(f'{base_url}/upload/{provider}', files={'file': (name, content)})
+    else:
+        response = await client.post(f'{base_url}/upload/{provider}', params={'name': name}, content=content,
+                                     headers={'Content-Type': 'application/octet-stream'})
+    return len(content), response.status_code == 200
+
+
+async def download(client, base_url, provider, size, index):
+    received = 0
+    async with client.stream('GET', f'{base_url}/download/{provider}/{size}-{index}') as response:
+        async for piece in response.aiter_raw():
+            received += len(piece)
+    return received, response.status_code == 200 and received == size
+
+
+async def transfer_file(client, base_url, direction, size, index):
+    _, ok = await transfer(client, base_url, direction, f'{size}-{index}', poll_interval=0.05)
+    return size if ok else 0, ok
+
+
+def scenario_requests(scenario, kind, base_url, client, args, content):
+    """A factory per request of the scenario, alternating between the providers."""
+    indexes = range(args.requests)
+    if scenario == 'listing':
+        return [lambda n=n: list_page(client, base_url, PROVIDERS[n % 2], args.page_size, n) for n in indexes]
+    if scenario == 'upload':
+        return [lambda n=n: upload(client, base_url, kind, PROVIDERS[n % 2], content, n) for n in indexes]
+    if scenario == 'download':
+        return [lambda n=n: download(client, base_url, PROVIDERS[n % 2], args.size, n) for n in indexes]
+    return [lambda n=n: transfer_file(client, base_url, DIRECTIONS[n % 2], args.size, n) for n in indexes]
+
+
+def summarize(results, wall):
+    latencies = sorted(elapsed for elapsed, _, _ in results)
+    moved = sum(moved for _, moved, _ in results)
+    summary = {
+        'requests': len(results),
+        'failed': sum(1 for _, _, ok in results if not ok),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000, 1),
+        'requests_per_s': round(len(results) / wall, 1),
+    }
+    if moved:
+        summary['mb_per_s'] = round(moved / wall / 1000 ** 2, 1)
+    return summary
+
+
+async def run_scenarios(kind, base_url, token, args):
+    content = os.urandom(args.size)
+    report = {}
+    async with httpx.AsyncClient(headers={'Authorization': f'Bearer {token}'}, timeout=600,
+                                 limits=httpx.Limits(max_connections=None, keepalive_expiry=2)) as client:
+        for scenario in args.scenarios:
+            requests = scenario_requests(scenario, kind, base_url, client, args, content)
+            slots = asyncio.Semaphore(args.concurrency)
+
+            async def limited(request):
+                async with slots:
+                    return await timed(request())
+
+            # One untimed request first, so connection setup and imports don't count
+            await timed(requests[0]())
+            started = time.perf_counter()
+            results = await asyncio.gather(*(limited(request) for request in requests))
+            report[scenario] = summarize(results, time.perf_counter() - started)
+    return report
+
+
+def bench(kind, mock_url, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        # Provider pacing is set well above what the mock is asked for; the environment can still override it
+        env = {'GOOGLE_RATE_LIMIT': '10000', 'ONEDRIVE_RATE_LIMIT': '10000', **os.environ,
+               'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               'JWT_SECRET_KEY': 'bench-secret',
+               'TRANSFER_WORKERS': str(args.concurrency),
+               'GOOGLE_TRANSFER_LIMIT': str(args.concurrency),
+               'ONEDRIVE_TRANSFER_LIMIT': str(args.concurrency),
+               'TRANSFER_SKIP_IDENTICAL': 'false'}
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, 'asgi_load.py'), '--serve', kind,
+                                   '--port', str(port), '--mock', mock_url, '--connections', str(4 * args.concurrency)],
+                                  cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+        try:
+            token = json.loads(server.stdout.readline())['token']
+            wait_for_port(port)
+            return asyncio.run(run_scenarios(kind, f'http://127.0.0.1:{port}', token, args))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def regressions(results, baseline, tolerance):
+    """Messages for every scenario that did worse than its baseline."""
+    found = []
+    for kind, scenarios in results.items():
+        for scenario, current in scenarios.items():
+            before = baseline.get(kind, {}).get(scenario)
+            if before is None:
+                continue
+            name = f'{kind} {scenario}'
+            if current['failed'] > before['failed']:
+                found.append(f"{name}: {current['failed']} failed (baseline {before['failed']})")
+            if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                found.append(f"{name}: p95 {current['p95_ms']} ms (baseline {before['p95_ms']} ms)")
+            for metric in ('requests_per_s', 'mb_per_s'):
+                if metric in before and current.get(metric, 0) < before[metric] * (1 - tolerance):
+                    found.append(f"{name}: {metric} {current.get(metric, 0)} (baseline {before[metric]})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', nargs='+', choices=('flask', 'asgi'), default=['flask', 'asgi'])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight at once')
+    parser.add_argument('--size', default='4M', help='file size for uploads, downloads and transfers')
+    parser.add_argument('--files', type=int, default=1000, help='files in the mock root listing')
+    parser.add_argument('--page-size', type=int, default=100, help='files per listing request')
+    parser.add_argument('--rate', help='mock provider bytes per second per download, e.g. 2M')
+    parser.add_argument('--latency', type=float, default=0, help='seconds the mock adds to every response')
+    parser.add_argument('--throttle', type=float, default=0, help='fraction of mock requests answered 429')
+    parser.add_argument('--save', help='write the results to this file, to compare later runs against')
+    parser.add_argument('--baseline', help='results saved by an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='change allowed before it counts as a regression')
+    args = parser.parse_args()
+    args.size = parse_rate(args.size)
+
+    mock_port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'mock_cloud.py'), '--port', str(mock_port),
+               '--files', str(args.files), '--latency', str(args.latency), '--throttle', str(args.throttle)]
+    if args.rate:
+        command += ['--rate', args.rate]
+    mock = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_for_port(mock_port)
+        for kind in args.apps:
+            results[kind] = bench(kind, f'http://127.0.0.1:{mock_port}', args)
+            print(json.dumps({'app': kind, **results[kind]}), flush=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for message in found:
+            print(f'Regression: {message}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Peak RSS and throughput of streaming cloud-to-cloud transfers.
+
+Runs every transfer in a fresh interpreter against bench/mock_cloud.py and
+reports how far the process high-water mark rose during the copy.
+
+    python bench/transfer_memory.py                      # 10 MB, 500 MB, 5 GB
+    python bench/transfer_memory.py --sizes 10M 100M --max-chunk-size 10M
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+UNITS = {'K': 1024, 'M': 1000 ** 2, 'G': 1000 ** 3}
+
+
+def parse_size(text):
+    text = text.upper().rstrip('B')
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def proc_status(field):
+    # VmRSS is the current resident set and VmHWM its high-water mark, in kB
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f'{field} not available; this benchmark needs Linux /proc')
+
+
+def run_one(base_url, direction, size, chunk_size, max_chunk_size, buffers):
+    import clients
+    import transfer
+
+    # Build the pooled clients (and their TLS contexts) before measuring
+    for provider in clients.PROVIDERS:
+        clients.get_client(provider)
+    baseline = proc_status('VmRSS')
+    started = time.perf_counter()
+    ring = transfer.ChunkRing(transfer.choose_chunk_size(size, chunk_size, max_chunk_size), buffers)
+    source = 'google' if direction == 'gdrive-to-onedrive' else 'onedrive'
+    response = transfer.open_source(source, f'{base_url}/download/{size}', {})
+    chunks = transfer.source_chunks(response, ring)
+    if direction == 'gdrive-to-onedrive':
+        transfer.upload_to_onedrive(chunks, 'bench.bin', size, 'token', api_url=base_url)
+    else:
+        transfer.upload_to_google(chunks, 'bench.bin', size, 'token', api_url=base_url)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({'rss_growth': proc_status('VmHWM') - baseline, 'elapsed': elapsed}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=['10M', '500M', '5G'])
+    parser.add_argument('--chunk-size', default='1280K', help='smallest chunk size')
+    parser.add_argument('--max-chunk-size', default='5120K', help='largest chunk size, used for big files')
+    parser.add_argument('--buffers', type=int, default=3)
+    parser.add_argument('--direction', choices=['gdrive-to-onedrive', 'onedrive-to-gdrive', 'both'], default='both')
+    parser.add_argument('--run-one', nargs=3, metavar=('BASE_URL', 'DIRECTION', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    chunk_size = parse_size(args.chunk_size)
+    max_chunk_size = parse_size(args.max_chunk_size)
+
+    if args.run_one:
+        base_url, direction, size = args.run_one
+        return run_one(base_url, direction, int(size), chunk_size, max_chunk_size, args.buffers)
+
+    import mock_cloud
+
+    server = mock_cloud.serve()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    directions = ['gdrive-to-onedrive', 'onedrive-to-gdrive'] if args.direction == 'both' else [args.direction]
+
+    print(f'chunk size {chunk_size}-{max_chunk_size} bytes x {args.buffers} buffers')
+    print(f'{"direction":<20} {"size":>8} {"peak RSS growth":>16} {"throughput":>12}')
+    for direction in directions:
+        for label in args.sizes:
+            size = parse_size(label)
+            output = subprocess.run(
+                [sys.executable, __file__, '--chunk-size', args.chunk_size, '--max-chunk-size', args.max_chunk_size,
+                 '--buffers', str(args.buffers), '--run-one', base_url, direction, str(size)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            throughput = size / result['elapsed'] / 1000 ** 2
+            print(f'{direction:<20} {label:>8} {result["rss_growth"] / 1024 ** 2:>13.1f} MiB {throughput:>7.0f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Peak RSS of concurrent uploads from spooled files, by chunking strategy.
+
+Each run starts a fresh interpreter that uploads the same file several times
+at once to bench/mock_cloud.py and reports how far its high-water mark rose:
+
+    read   the whole file read into memory, then copied chunk by chunk
+    ring   the file streamed through a ring of chunk buffers
+    mmap   chunks sliced from a memory map of the file (the upload routes)
+
+    python bench/upload_memory.py                         # 4 x 200 MB to OneDrive
+    python bench/upload_memory.py --uploads 16 --size 500M --budget 64M --provider google
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from transfer_memory import parse_size, proc_status  # noqa: E402
+
+MODES = ('read', 'ring', 'mmap')
+
+
+def open_chunks(mode, path, chunk_size, buffers):
+    import transfer
+
+    file = open(path, 'rb')
+    if mode == 'read':
+        return transfer.file_chunks(io.BytesIO(file.read()), transfer.ChunkRing(chunk_size, buffers))
+    if mode == 'ring':
+        return transfer.file_chunks(file, transfer.ChunkRing(chunk_size, buffers))
+    return transfer.MappedChunks(file, chunk_size, buffers)
+
+
+def run_one(base_url, mode, path, uploads, provider, chunk_size, buffers, budget):
+    import clients
+    import transfer
+
+    for name in clients.PROVIDERS:
+        clients.get_client(name)
+    size = os.path.getsize(path)
+    upload = transfer.upload_to_google if provider == 'google' else transfer.upload_to_onedrive
+    memory = transfer.MemoryBudget(budget or uploads * chunk_size * buffers)
+    errors = []
+
+    def one():
+        try:
+            with memory.reserve(chunk_size * buffers):
+                upload(open_chunks(mode, path, chunk_size, buffers), 'bench.bin', size, 'token', api_url=base_url)
+        except Exception as e:
+            errors.append(e)
+
+    baseline = proc_status('VmRSS')
+    started = time.perf_counter()
+    threads = [threading.Thread(target=one) for _ in range(uploads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({'rss_growth': proc_status('VmHWM') - baseline, 'elapsed': elapsed,
+                      'errors': [repr(e) for e in errors]}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='200M', help='file size')
+    parser.add_argument('--uploads', type=int, default=4, help='concurrent uploads')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--provider', choices=('google', 'onedrive'), default='onedrive')
+    parser.add_argument('--chunk-size', default='5120K')
+    parser.add_argument('--buffers', type=int, default=3)
+    parser.add_argument('--budget', default='0', help='upload memory budget; 0 lets every upload run at once')
+    parser.add_argument('--run-one', nargs=3, metavar=('BASE_URL', 'MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    chunk_size = parse_size(args.chunk_size)
+
+    if args.run_one:
+        base_url, mode, path = args.run_one
+        return run_one(base_url, mode, path, args.uploads, args.provider, chunk_size, args.buffers,
+                       parse_size(args.budget))
+
+    import mock_cloud
+
+    server = mock_cloud.serve()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    size = parse_size(args.size)
+
+    with tempfile.NamedTemporaryFile(suffix='.bin') as spool:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size // len(block)):
+            spool.write(block)
+        spool.write(block[:size % len(block)])
+        spool.flush()
+
+        print(f'{args.uploads} x {args.size} uploads to {args.provider}, {chunk_size} byte chunks x {args.buffers}')
+        print(f'{"mode":<6} {"peak RSS growth":>16} {"throughput":>12}')
+        for mode in args.modes:
+            output = subprocess.run(
+                [sys.executable, __file__, '--uploads', str(args.uploads), '--provider', args.provider,
+                 '--chunk-size', args.chunk_size, '--buffers', str(args.buffers), '--budget', args.budget,
+                 '--run-one', base_url, mode, spool.name],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            throughput = args.uploads * size / result['elapsed'] / 1000 ** 2
+            failed = f'  ({len(result["errors"])} failed: {result["errors"][0]})' if result['errors'] else ''
+            print(f'{mode:<6} {result["rss_growth"] / 1024 ** 2:>13.1f} MiB {throughput:>7.0f} MB/s{failed}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Change feeds: Google Drive changes.list page tokens and Graph delta links.
+
+Both feeds are reduced to the same shape: a list of (file_id, item) pairs,
+where item is the provider's metadata or None if the file was removed, plus
+the cursor to pass next time.
+"""
+import logging
+
+from clients import get_client
+from transfer import GOOGLE_API_URL, GRAPH_API_URL
+
+logger = logging.getLogger(__name__)
+
+# File fields requested from Drive wherever metadata is cached or indexed
+GOOGLE_FILE_FIELDS = 'kind,id,name,mimeType,size,modifiedTime,parents,md5Checksum,headRevisionId,trashed'
+
+
+class ChangeFeedError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _auth(access_token):
+    return {'Authorization': f'Bearer {access_token}'}
+
+
+def google_start_token(access_token, api_url=GOOGLE_API_URL):
+    response = get_client('google').get(f'{api_url}/drive/v3/changes/startPageToken', headers=_auth(access_token))
+    if response.status_code != 200:
+        raise ChangeFeedError("Failed to get Google Drive change token", response.status_code)
+    return response.json()['startPageToken']
+
+
+def iter_google_changes(access_token, page_token, api_url=GOOGLE_API_URL):
+    """Yield (changes, new_start_token) a page at a time; the token is None until the last page."""
+    params = {
+        'pageToken': page_token,
+        'pageSize': 1000,
+        'fields': f'nextPageToken,newStartPageToken,changes(fileId,removed,file({GOOGLE_FILE_FIELDS}))'
+    }
+    while True:
+        response = get_client('google').get(f'{api_url}/drive/v3/changes', headers=_auth(access_token), params=params)
+        if response.status_code != 200:
+            raise ChangeFeedError("Failed to list Google Drive changes", response.status_code)
+        page = response.json()
+        changes = []
+        for change in page.get('changes', []):
+            item = change.get('file')
+            removed = change.get('removed') or not item or item.get('trashed')
+            changes.append((change['fileId'], None if removed else item))
+        yield changes, page.get('newStartPageToken')
+        if 'newStartPageToken' in page:
+            return
+        params['pageToken'] = page['nextPageToken']
+
+
+def google_changes(access_token, page_token, api_url=GOOGLE_API_URL):
+    """All changes since page_token, and the token for the next poll."""
+    changes = []
+    for page, new_token in iter_google_changes(access_token, page_token, api_url):
+        changes.extend(page)
+    return changes, new_token
+
+
+def graph_latest_delta(access_token, api_url=GRAPH_API_URL):
+    """A delta link that starts from now, without enumerating the drive."""
+    response = get_client('onedrive').get(f'{api_url}/me/drive/root/delta', headers=_auth(access_token),
+                                          params={'token': 'latest'})
+    if response.status_code != 200:
+        raise ChangeFeedError("Failed to get OneDrive delta link", response.status_code)
+    return response.json()['@odata.deltaLink']
+
+
+def iter_graph_delta(access_token, url):
+    """Yield (changes, next_link, delta_link) a page at a time.
+
+    Started from the plain delta URL this enumerates the whole drive. next_link
+    is where an interrupted walk can carry on; delta_link is only set on the
+    last page.
+    """
+    while True:
+        response = get_client('onedrive').get(url, headers=_auth(access_token))
+        if response.status_code == 410:
+            # The delta link expired; the caller has to start over
+            raise ChangeFeedError("OneDrive delta link expired", 410)
+        if response.status_code != 200:
+            raise ChangeFeedError("Failed to get OneDrive delta", response.status_code)
+        page = response.json()
+        changes = [(item['id'], None if 'deleted' in item else item) for item in page.get('value', [])]
+        yield changes, page.get('@odata.nextLink'), page.get('@odata.deltaLink')
+        if '@odata.deltaLink' in page:
+            return
+        url = page['@odata.nextLink']
+
+
+def graph_delta(access_token, delta_link):
+    """All changes since delta_link, and the delta link for the next poll."""
+    changes = []
+    for page, _, new_link in iter_graph_delta(access_token, delta_link):
+        changes.extend(page)
+    return changes, new_link
+
+
+def start_cursor(provider, access_token):
+    if provider == 'google':
+        return google_start_token(access_token)
+    return graph_latest_delta(access_token)
+
+
+def poll_changes(provider, access_token, cursor):
+    if provider == 'google':
+        return google_changes(access_token, cursor)
+    return graph_delta(access_token, cursor)
@@ -0,0 +1,312 @@
+"""Shared, pooled HTTP clients for the Google and Microsoft APIs.
+
+Each provider gets one long-lived httpx client, so connections (and their TLS
+sessions) are kept alive and reused across requests and threads instead of
+being set up for every call. HTTP/2 is optional and needs the h2 package.
+Requests are paced and retried according to the provider's ProviderPolicy
+(see throttling.py).
+
+The ASGI app uses asyncio counterparts with the same settings; those belong
+to the event loop that first asks for them.
+"""
+import asyncio
+import importlib.util
+import itertools
+import logging
+import threading
+import time
+
+import httpx
+
+from metrics import BYTES_TRANSFERRED, observe_upstream
+from throttling import ProviderPolicy
+
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which would mean one line per upload chunk
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+PROVIDERS = ('google', 'onedrive')
+
+DEFAULT_OPTIONS = {
+    'max_connections': 20,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 60.0,
+    'http2': False,
+    'connect_timeout': 10.0,
+    'timeout': 60.0,
+    # Requests per second for each provider; a provider without one isn't paced
+    'rate_limits': {},
+    'rate_recovery': 30.0,
+    'max_retries': 5,
+    'backoff_base': 0.5,
+    'backoff_max': 60.0,
+}
+POLICY_OPTIONS = ('rate_limits', 'rate_recovery', 'max_retries', 'backoff_base', 'backoff_max')
+
+_clients = {}
+_async_clients = {}
+_settings = dict(DEFAULT_OPTIONS)
+_async_settings = {}
+_policies = {}
+_lock = threading.Lock()
+
+
+def _httpx_options(name, max_connections, max_keepalive_connections, keepalive_expiry, http2,
+                   connect_timeout, timeout, verify=True):
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning(f"h2 is not installed; {name} client falls back to HTTP/1.1")
+        http2 = False
+    return {
+        'http2': http2,
+        'limits': httpx.Limits(max_connections=max_connections,
+                               max_keepalive_connections=max_keepalive_connections,
+                               keepalive_expiry=keepalive_expiry),
+        'timeout': httpx.Timeout(timeout, connect=connect_timeout),
+        'verify': verify,
+        # OneDrive content URLs redirect to a pre-authenticated download host
+        'follow_redirects': True,
+    }
+
+
+def _split(settings):
+    """(httpx options, ProviderPolicy options) from client settings."""
+    return ({k: v for k, v in settings.items() if k not in POLICY_OPTIONS},
+            {k: v for k, v in settings.items() if k in POLICY_OPTIONS})
+
+
+def _content(content):
+    # A memoryview is wrapped afresh for every attempt, so a retry can send it again
+    return iter((content,)) if isinstance(content, memoryview) else content
+
+
+def _replayable(content):
+    return content is None or isinstance(content, (bytes, str, memoryview))
+
+
+class _CountedStream(httpx.SyncByteStream):
+    """A response body that adds its bytes to a metrics counter as they are read."""
+
+    def __init__(self, stream, counter):
+        self._stream = stream
+        self._counter = counter
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._counter.inc(len(chunk))
+            yield chunk
+
+    def close(self):
+        self._stream.close()
+
+
+class _AsyncCountedStream(httpx.AsyncByteStream):
+    def __init__(self, stream, counter):
+        self._stream = stream
+        self._counter = counter
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._counter.inc(len(chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+
+class ProviderClient:
+    """Pooled client for one provider; a thin layer over httpx.Client."""
+
+    def __init__(self, name, policy, **options):
+        self.name = name
+        self.policy = policy
+        settings = _httpx_options(name, **options)
+        self.http2 = settings['http2']
+        self._client = httpx.Client(**settings)
+        self._received = BYTES_TRANSFERRED.labels(name, 'received')
+
+    def request(self, method, url, stream=False, retry=True, content=None, **kwargs):
+        """Send a request, paced and retried per the provider's policy.
+
+        With stream=True the caller must close the response. Content given as
+        an iterator can't be sent twice, so those requests are never retried;
+        pass bytes or a memoryview instead. retry=False still paces the
+        request and notes throttling, for callers that retry on their own.
+        """
+        retry = retry and _replayable(content)
+        attempt = 0
+        while True:
+            attempt += 1
+            pause = self.policy.pause()
+            if pause:
+                time.sleep(pause)
+            request = self._client.build_request(method, url, content=_content(content), **kwargs)
+            started = time.perf_counter()
+            response = None
+            try:
+                response = self._client.send(request, stream=True)
+                observe_upstream(self.name, request, response.status_code, started)
+                response.stream = _CountedStream(response.stream, self._received)
+                if not stream or self.policy.needs_body(response):
+                    response.read()
+            except httpx.TransportError as e:
+                if response is None:
+                    observe_upstream(self.name, request, type(e).__name__, started)
+                else:
+                    response.close()
+                delay = self.policy.retry_error(method, e, attempt) if retry else None
+                if delay is None:
+                    raise
+            else:
+                if not retry:
+                    self.policy.check(response)
+                    return response
+                delay = self.policy.retry_response(method, response, attempt)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self._client.close()
+
+
+class AsyncProviderClient:
+    """Pooled asyncio client for one provider, over one or more httpx.AsyncClients.
+
+    httpcore's async pool scans all of its connections whenever a request
+    starts or ends, which costs more than the requests themselves once a pool
+    holds hundreds of connections; pool_shards splits the connection limit
+    over that many smaller pools, used in turn.
+    """
+
+    def __init__(self, name, policy, pool_shards=1, **options):
+        self.name = name
+        self.policy = policy
+        shards = max(1, pool_shards)
+        options = {**options,
+                   'max_connections': -(-options['max_connections'] // shards),
+                   'max_keepalive_connections': -(-options['max_keepalive_connections'] // shards)}
+        self._clients = [httpx.AsyncClient(**_httpx_options(name, **options)) for _ in range(shards)]
+        self._next = itertools.cycle(self._clients)
+        self._received = BYTES_TRANSFERRED.labels(name, 'received')
+
+    async def request(self, method, url, stream=False, retry=True, content=None, **kwargs):
+        """As ProviderClient.request; with stream=True the caller must aclose the response."""
+        retry = retry and _replayable(content)
+        attempt = 0
+        while True:
+            attempt += 1
+            pause = self.policy.pause()
+            if pause:
+                await asyncio.sleep(pause)
+            client = next(self._next)
+            request = client.build_request(method, url, content=_content(content), **kwargs)
+            started = time.perf_counter()
+            response = None
+            try:
+                response = await client.send(request, stream=True)
+                observe_upstream(self.name, request, response.status_code, started)
+                response.stream = _AsyncCountedStream(response.stream, self._received)
+                if not stream or self.policy.needs_body(response):
+                    await response.aread()
+            except httpx.TransportError as e:
+                if response is None:
+                    observe_upstream(self.name, request, type(e).__name__, started)
+                else:
+                    await response.aclose()
+                delay = self.policy.retry_error(method, e, attempt) if retry else None
+                if delay is None:
+                    raise
+            else:
+                if not retry:
+                    self.policy.check(response)
+                    return response
+                delay = self.policy.retry_response(method, response, attempt)
+                if delay is None:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
+
+
+def get_policy(provider):
+    if provider not in _policies:
+        with _lock:
+            if provider not in _policies:
+                options = _split(_settings)[1]
+                _policies[provider] = ProviderPolicy(provider, options['rate_limits'].get(provider),
+                                                     options['rate_recovery'], options['max_retries'],
+                                                     options['backoff_base'], options['backoff_max'])
+    return _policies[provider]
+
+
+def configure_clients(**options):
+    """(Re)build the provider clients; unspecified options keep their defaults."""
+    global _settings
+    settings = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    with _lock:
+        _settings = settings
+        _policies.clear()
+    old = dict(_clients)
+    for provider in PROVIDERS:
+        _clients[provider] = ProviderClient(provider, get_policy(provider), **_split(settings)[0])
+    for client in old.values():
+        client.close()
+    logger.info(f"Provider HTTP clients configured: {settings}")
+
+
+def get_client(provider):
+    if provider not in _clients:
+        policy = get_policy(provider)
+        with _lock:
+            if provider not in _clients:
+                _clients[provider] = ProviderClient(provider, policy, **_split(_settings)[0])
+    return _clients[provider]
+
+
+def configure_async_clients(**options):
+    """Override settings for the async clients, which usually need a bigger pool; call before first use."""
+    global _async_settings
+    _async_settings = {k: v for k, v in options.items() if v is not None}
+
+
+def get_async_client(provider):
+    # Only called from the event loop's thread, so no lock is needed. The policy is the sync client's,
+    # so both keep to one rate.
+    if provider not in _async_clients:
+        _async_clients[provider] = AsyncProviderClient(provider, get_policy(provider),
+                                                       **_split({**_settings, **_async_settings})[0])
+    return _async_clients[provider]
+
+
+async def close_async_clients():
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.aclose()
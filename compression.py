@@ -0,0 +1,68 @@
+"""Negotiated compression and conditional GETs for JSON responses.
+
+JSON answers to GET requests carry a strong ETag, which is a hash of their
+body. Once a body is at least the minimum size, it is sent compressed with
+brotli, zstd or gzip, whichever the client's Accept-Encoding prefers (in
+that order on a tie). A client that sends the ETag back in If-None-Match
+gets 304 Not Modified with no body.
+
+A compressed body is a different representation. It gets its own ETag: the
+body's ETag with the encoding appended.
+
+The app keeps the EncodedBody of a cached listing next to the listing. An
+unchanged drive can then be polled without serializing, hashing or
+compressing anything again.
+"""
+import gzip
+import hashlib
+
+import brotli
+import zstandard
+
+ENCODINGS = ('br', 'zstd', 'gzip')
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level)
+
+
+class EncodedBody:
+    """A serialized JSON body with its ETag; compressed copies are made once, when first asked for."""
+
+    def __init__(self, data):
+        self.data = data
+        self.etag = hashlib.sha256(data).hexdigest()
+        self._variants = {}
+
+    def variant(self, encoding, level):
+        data = self._variants.get(encoding)
+        if data is None:
+            # Two requests racing here both compress; either copy is fine to keep
+            data = self._variants[encoding] = compress(self.data, encoding, level)
+        return data
+
+
+def send_encoded(request, response, body, levels, min_size):
+    """Fill a 200 response to request from body: 304 Not Modified if the client has it, else compressed if accepted."""
+    encoding = request.accept_encodings.best_match(ENCODINGS) if len(body.data) >= min_size else None
+    etag = f'{body.etag}-{encoding}' if encoding else body.etag
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    # Per-user data: browsers may keep it, but must check the ETag before reusing it
+    if not response.headers.get('Cache-Control'):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        response.set_data(b'')
+        return response
+    if encoding:
+        response.set_data(body.variant(encoding, levels[encoding]))
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response.set_data(body.data)
+    return response
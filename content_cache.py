@@ -0,0 +1,110 @@
+"""Read-through disk cache of downloaded file content.
+
+Entries are keyed by provider, file ID and revision (Drive headRevisionId,
+OneDrive cTag or eTag), so an edited file is simply a new entry and old
+revisions age out of the LRU. A hit is served from disk. A miss streams from
+the provider as before, copying each chunk to a temp file on the way; once
+the whole file has arrived the copy becomes the cached entry. Range requests
+and files larger than max_file_size are not cached.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+# Metadata fields identifying a file's content revision, in order of preference
+REVISION_FIELDS = {'google': ('headRevisionId',), 'onedrive': ('cTag', 'eTag')}
+
+
+def content_revision(provider, metadata):
+    """The revision of a file's content from its metadata, or None if it has none (e.g. Google Docs)."""
+    return next((metadata[field] for field in REVISION_FIELDS[provider] if metadata.get(field)), None)
+
+
+class ContentFill:
+    """Copies a download into the cache as it streams; commit() keeps it only if it is complete."""
+
+    def __init__(self, cache, name, size):
+        self._cache = cache
+        self._name = name
+        self._size = size
+        self._temp_path = cache._files.temp_path(name)
+        self._file = open(self._temp_path, 'wb')
+        self._written = 0
+
+    def write(self, chunk):
+        if self._file is None:
+            return
+        try:
+            self._file.write(chunk)
+            self._written += len(chunk)
+        except OSError as e:
+            # A full disk stops the copy, never the download
+            logger.warning(f"Stopped caching {self._name}: {e}")
+            self.discard()
+
+    def commit(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self._written == self._size:
+            self._cache._files.commit(self._name, self._temp_path)
+            logger.info(f"Cached {self._size} bytes of content as {self._name}")
+        else:
+            os.unlink(self._temp_path)
+        self._cache._done(self._name)
+
+    def discard(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.unlink(self._temp_path)
+        self._cache._done(self._name)
+
+
+class ContentCache:
+    def __init__(self, directory, max_bytes, max_file_size):
+        self._files = DiskCache(directory, max_bytes)
+        self.max_file_size = min(max_file_size, max_bytes)
+        # Entries being filled right now; a second download of the same file doesn't copy it again
+        self._filling = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name(provider, file_id, revision):
+        digest = hashlib.sha256(f'{file_id}\n{revision}'.encode()).hexdigest()
+        return f'{provider}/{digest[:2]}/{digest}'
+
+    def etag(self, provider, file_id, revision):
+        return self._name(provider, file_id, revision).rsplit('/', 1)[1]
+
+    def get(self, provider, file_id, revision):
+        """Path of the cached content, or None on a miss."""
+        name = self._name(provider, file_id, revision)
+        return self._files.path(name) if self._files.touch(name) else None
+
+    def fill(self, provider, file_id, revision, size):
+        """A ContentFill for a download about to stream, or None if it shouldn't be cached."""
+        if size is None or size > self.max_file_size:
+            return None
+        name = self._name(provider, file_id, revision)
+        with self._lock:
+            if name in self._filling:
+                return None
+            self._filling.add(name)
+        try:
+            return ContentFill(self, name, size)
+        except OSError as e:
+            logger.warning(f"Not caching {name}: {e}")
+            self._done(name)
+            return None
+
+    def _done(self, name):
+        with self._lock:
+            self._filling.discard(name)
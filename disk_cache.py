@@ -0,0 +1,115 @@
+"""Size-bounded store of files under one directory, evicted least recently used.
+
+Used by the preview and content caches. Files are named by the caller with
+slash-separated paths relative to the directory. Recency is kept in file
+mtimes, so the eviction order survives a restart. Files are written aside
+and renamed into place, so a reader never sees a partial one.
+"""
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Name -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _load(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if file_name.endswith('.tmp'):
+                    # Left by a write that never finished
+                    os.unlink(path)
+                    continue
+                stat = os.stat(path)
+                name = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+        if found:
+            logger.info(f"{self.directory} holds {len(found)} cached files ({self._size} bytes)")
+        self._evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, *name.split('/'))
+
+    def touch(self, name):
+        """Mark name as just used; False if it isn't in the cache."""
+        with self._lock:
+            if name not in self._entries:
+                return False
+            self._entries.move_to_end(name)
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            self.remove(name)
+            return False
+        return True
+
+    def read(self, name):
+        if not self.touch(name):
+            return None
+        try:
+            with open(self.path(name), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            self.remove(name)
+            return None
+
+    def write(self, name, content):
+        temp_path = self.temp_path(name)
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        self.commit(name, temp_path)
+
+    def temp_path(self, name):
+        """A fresh path to write name's content to before commit()."""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f'{path}.{uuid.uuid4().hex}.tmp'
+
+    def commit(self, name, temp_path):
+        """Move a file written at temp_path into the cache as name."""
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, self.path(name))
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+        self._evict()
+
+    def remove(self, name):
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.max_bytes or not self._entries:
+                    return
+                name, size = self._entries.popitem(last=False)
+                self._size -= size
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
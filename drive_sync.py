@@ -0,0 +1,539 @@
+"""Scheduled sync jobs between Google Drive and OneDrive.
+
+A sync job pairs a folder on each drive (the whole drive by default) and runs
+on a cron schedule, either one-way, mirroring one side onto the other, or
+two-way. Runs work from the local drive index (file_index.py) instead of
+listing the drives: after an incremental index sync, a run looks only at the
+files indexed since its previous run, plus files it synced before that are no
+longer where it left them. Each of those paths is compared, by size and
+content hash, across the two drives and against the baseline the last run
+recorded for it, and only the differences are copied or deleted, several at a
+time. A run that finds nothing to do makes no provider calls beyond the
+change feeds.
+
+When both sides of a two-way sync changed, the conflict policy picks the
+copy to keep: the newer one, always Google Drive's, always OneDrive's, or
+neither (skip), which leaves both as they are and lists the conflict in the
+run's result. Deletions are passed on only with propagate_deletes, and never
+to a file that changed since it was last synced. Without it, a file deleted
+from a one-way sync's source stays on the destination, and a file deleted on
+one side of a two-way sync is copied back.
+"""
+import datetime
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import sqlalchemy as sa
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+from fingerprints import NATIVE_HASH, native_hashes
+from jobs import TRANSFER_DIRECTIONS
+from tree_transfer import MAKE_FOLDER
+
+logger = logging.getLogger(__name__)
+
+SYNC_MODES = (*TRANSFER_DIRECTIONS, 'two-way')
+CONFLICT_POLICIES = ('newer', 'google', 'onedrive', 'skip')
+PROVIDERS = ('google', 'onedrive')
+DIRECTIONS = {providers: direction for direction, providers in TRANSFER_DIRECTIONS.items()}
+# Paths per IN (...) query, well under SQLite's bound-parameter limit
+PATH_CHUNK = 500
+# Changes listed in a run's result; the counts cover all of them
+MAX_LISTED_CHANGES = 200
+# Seconds between heartbeats of a run waiting on its copies
+HEARTBEAT_INTERVAL = 30
+
+SYNC_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS ix_indexed_file_path ON indexed_file (user_id, provider, path)',
+    'CREATE INDEX IF NOT EXISTS ix_indexed_file_indexed_at ON indexed_file (user_id, provider, indexed_at)',
+)
+
+# kind is copy (source to destination), delete (from destination), record (the two
+# sides already match; only the baseline is updated), forget (drop the baseline
+# of a path gone from both sides) or conflict (both changed; left alone)
+SyncAction = namedtuple('SyncAction', 'kind path source destination conflict', defaults=(None, None, False))
+
+
+class SyncError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def install_sync_indexes(connection):
+    """Index the drive index by path and by indexing time, which the runs look files up by."""
+    for statement in SYNC_INDEXES:
+        connection.exec_driver_sql(statement)
+
+
+def parse_schedule(expression):
+    """A trigger for a five-field crontab expression; raises ValueError if it isn't one."""
+    return CronTrigger.from_crontab(expression)
+
+
+def next_run_time(expression):
+    trigger = parse_schedule(expression)
+    return trigger.get_next_fire_time(None, datetime.datetime.now(trigger.timezone))
+
+
+def normalize_root(path):
+    """A sync folder as the index writes paths ('/Photos/2024'), '' for the whole drive; None if invalid."""
+    if not isinstance(path, str):
+        return None
+    path = path.strip().rstrip('/')
+    if path and (not path.startswith('/') or '//' in path):
+        return None
+    return path
+
+
+def _other(provider):
+    return 'onedrive' if provider == 'google' else 'google'
+
+
+def _changed(rows, entry, provider):
+    """Whether provider's side of a path differs from what the last run left there."""
+    row = rows[provider]
+    if entry is None or getattr(entry, f'{provider}_id') is None:
+        return row is not None
+    if row is None:
+        return True
+    recorded_hash = getattr(entry, f'{provider}_hash')
+    return (row.file_id != getattr(entry, f'{provider}_id') or row.size != entry.size
+            or (recorded_hash is not None and row.content_hash != recorded_hash))
+
+
+def _conflict_winner(conflict_policy, rows):
+    if conflict_policy in PROVIDERS:
+        return conflict_policy
+    if conflict_policy == 'newer':
+        google, onedrive = rows['google'].modified_time, rows['onedrive'].modified_time
+        if google is not None and onedrive is not None:
+            return 'google' if google >= onedrive else 'onedrive'
+    return None
+
+
+def plan(mode, conflict_policy, propagate_deletes, path, rows, entry, same_content):
+    """The SyncAction that brings a path's two sides (index rows by provider) in line, or None if they are."""
+    changed = {provider: _changed(rows, entry, provider) for provider in PROVIDERS}
+    if rows['google'] is None and rows['onedrive'] is None:
+        return SyncAction('forget', path) if entry is not None else None
+    if not changed['google'] and not changed['onedrive']:
+        return None
+    if rows['google'] is not None and rows['onedrive'] is not None and same_content(rows['google'], rows['onedrive']):
+        return SyncAction('record', path)
+
+    if mode in TRANSFER_DIRECTIONS:
+        source, destination = TRANSFER_DIRECTIONS[mode]
+        # A mirror: the destination is put back to the source's copy, whichever side changed
+        if rows[source] is not None:
+            return SyncAction('copy', path, source, destination)
+        if entry is None:
+            return None
+        if rows[destination] is not None and propagate_deletes and not changed[destination]:
+            return SyncAction('delete', path, destination=destination)
+        return SyncAction('forget', path)
+
+    if rows['google'] is not None and rows['onedrive'] is not None:
+        if changed['google'] and changed['onedrive']:
+            winner = _conflict_winner(conflict_policy, rows)
+            if winner is None:
+                return SyncAction('conflict', path)
+            return SyncAction('copy', path, winner, _other(winner), conflict=True)
+        source = 'google' if changed['google'] else 'onedrive'
+        return SyncAction('copy', path, source, _other(source))
+    source = 'google' if rows['google'] is not None else 'onedrive'
+    synced = entry is not None and getattr(entry, f'{_other(source)}_id') is not None
+    if synced and propagate_deletes and not changed[source]:
+        return SyncAction('delete', path, destination=source)
+    return SyncAction('copy', path, source, _other(source))
+
+
+def _index_item(provider, row):
+    """Enough of a provider item, built from an index row, for the fingerprint store."""
+    item = {'id': row.file_id}
+    if row.hash_algorithm == NATIVE_HASH[provider]:
+        if provider == 'google':
+            item['md5Checksum'] = row.content_hash
+        else:
+            item['file'] = {'hashes': {'quickXorHash': row.content_hash}}
+    return item
+
+
+class _CopyProgress:
+    """What copy_file reports for one file; a run only keeps the byte count."""
+
+    def __init__(self):
+        self.bytes_done = 0
+
+    def start(self, file_name, bytes_total):
+        pass
+
+    def advance(self, bytes_done):
+        self.bytes_done = bytes_done
+
+    def touch(self):
+        pass
+
+
+class _DestinationFolders:
+    """Folder IDs by path for one run: from the index, else found or created on the drive."""
+
+    def __init__(self, db, file_model, state_model, access_token):
+        self.db = db
+        self.file_model = file_model
+        self.state_model = state_model
+        self.access_token = access_token
+        self._ids = {}
+        # Held while creating, so two copies into one new folder don't both make it
+        self._lock = threading.Lock()
+
+    def resolve(self, user, provider, path):
+        with self._lock:
+            return self._resolve(user, provider, path)
+
+    def _resolve(self, user, provider, path):
+        key = (provider, path)
+        if key not in self._ids:
+            if not path:
+                state = self.db.session.get(self.state_model, (user.id, provider))
+                folder_id = state.root_id if state and state.root_id else 'root'
+            else:
+                File = self.file_model
+                row = File.query.with_entities(File.file_id).filter_by(
+                    user_id=user.id, provider=provider, path=path, is_folder=True).first()
+                if row:
+                    folder_id = row.file_id
+                else:
+                    parent, name = path.rsplit('/', 1)
+                    parent_id = self._resolve(user, provider, parent)
+                    folder_id = MAKE_FOLDER[provider](self.access_token(user, provider), name, parent_id)['id']
+            self._ids[key] = folder_id
+        return self._ids[key]
+
+
+class SyncScheduler:
+    def __init__(self, app, db, sync_model, run_model, entry_model, file_model, state_model, indexer,
+                 fingerprints, get_user, access_token, copy_file, delete_file, workers=4, stale_after=600,
+                 reload_interval=60):
+        self.app = app
+        self.db = db
+        self.sync_model = sync_model
+        self.run_model = run_model
+        self.entry_model = entry_model
+        self.file_model = file_model
+        self.state_model = state_model
+        self.indexer = indexer
+        self.fingerprints = fingerprints
+        self.get_user = get_user
+        # access_token(user, provider); copy_file(user, direction, file_id, progress, parent_id) -> result
+        # with the copy's metadata as 'file'; delete_file(user, provider, file_id)
+        self.access_token = access_token
+        self.copy_file = copy_file
+        self.delete_file = delete_file
+        self.workers = workers
+        self.stale_after = stale_after
+        self.reload_interval = reload_interval
+        self._scheduler = None
+        self._schedules = {}
+
+    def start(self):
+        self._scheduler = BackgroundScheduler(daemon=True)
+        # Other processes create and change sync jobs too; pick their schedules up periodically
+        self._scheduler.add_job(self.reload, 'interval', seconds=self.reload_interval, id='reload-syncs',
+                                max_instances=1, coalesce=True, next_run_time=datetime.datetime.now())
+        self._scheduler.start()
+        logger.info(f"Sync scheduler started with {self.workers} copies per run")
+
+    def shutdown(self):
+        if self._scheduler:
+            self._scheduler.shutdown(wait=False)
+
+    @property
+    def running(self):
+        return bool(self._scheduler and self._scheduler.running)
+
+    def reload(self):
+        """Schedule every enabled sync job, and unschedule the rest."""
+        if not self.running:
+            return
+        with self.app.app_context():
+            Sync = self.sync_model
+            schedules = dict(Sync.query.with_entities(Sync.id, Sync.schedule).filter_by(enabled=True))
+            self.db.session.remove()
+        for sync_id in set(self._schedules) - set(schedules):
+            self._scheduler.remove_job(f'sync-{sync_id}')
+            del self._schedules[sync_id]
+        for sync_id, schedule in schedules.items():
+            if self._schedules.get(sync_id) == schedule:
+                continue
+            self._scheduler.add_job(self.run, parse_schedule(schedule), args=[sync_id], id=f'sync-{sync_id}',
+                                    replace_existing=True, max_instances=1, coalesce=True, misfire_grace_time=3600)
+            self._schedules[sync_id] = schedule
+
+    def run_now(self, sync_id):
+        """Start a run outside the schedule; False if this process doesn't run syncs."""
+        if not self.running:
+            return False
+        self._scheduler.add_job(self.run, args=[sync_id], id=f'sync-now-{sync_id}', replace_existing=True)
+        return True
+
+    def run(self, sync_id):
+        with self.app.app_context():
+            try:
+                self._run(sync_id)
+            finally:
+                self.db.session.remove()
+
+    def _run(self, sync_id):
+        if not self._claim(sync_id):
+            logger.info(f"Sync {sync_id} is already running or was deleted; skipping this run")
+            return
+        sync = self.db.session.get(self.sync_model, sync_id)
+        run = self.run_model(sync_id=sync_id, status='running', started_at=datetime.datetime.now())
+        self.db.session.add(run)
+        self.db.session.commit()
+        logger.info(f"Running sync {sync_id}: {sync.mode} {sync.google_path or '/'} <-> {sync.onedrive_path or '/'}")
+        try:
+            run.result = self._sync(sync)
+            run.status = 'completed_with_errors' if run.result['counts']['failed'] else 'completed'
+            logger.info(f"Sync {sync_id} finished: {run.result['counts']}")
+        except SyncError as e:
+            logger.warning(f"Sync {sync_id} could not run: {e.message}")
+            self.db.session.rollback()
+            run.status = 'failed'
+            run.error = e.message
+        except Exception as e:
+            logger.exception(f"Sync {sync_id} failed")
+            self.db.session.rollback()
+            run.status = 'failed'
+            run.error = getattr(e, 'message', str(e))
+        run.finished_at = datetime.datetime.now()
+        sync.heartbeat_at = None
+        self.db.session.commit()
+
+    def _claim(self, sync_id):
+        # Conditional update, so a schedule firing in several processes runs once
+        Sync, Run = self.sync_model, self.run_model
+        now = datetime.datetime.now()
+        cutoff = now - datetime.timedelta(seconds=self.stale_after)
+        claimed = Sync.query.filter(Sync.id == sync_id, sa.or_(Sync.heartbeat_at.is_(None), Sync.heartbeat_at < cutoff)
+                                    ).update({'heartbeat_at': now}, synchronize_session=False)
+        if claimed:
+            abandoned = Run.query.filter_by(sync_id=sync_id, status='running').update(
+                {'status': 'failed', 'error': 'The process running this sync stopped reporting',
+                 'finished_at': now}, synchronize_session=False)
+            if abandoned:
+                logger.warning(f"Sync {sync_id} run was abandoned by its process; starting again")
+        self.db.session.commit()
+        return claimed == 1
+
+    def _heartbeat(self, sync_id):
+        self.sync_model.query.filter_by(id=sync_id).update({'heartbeat_at': datetime.datetime.now()})
+        self.db.session.commit()
+
+    def _keep_alive(self, sync_id, stop):
+        with self.app.app_context():
+            try:
+                while not stop.wait(HEARTBEAT_INTERVAL):
+                    self._heartbeat(sync_id)
+            finally:
+                self.db.session.remove()
+
+    def _sync(self, sync):
+        user = self.get_user(sync.user_id)
+        if not user or not user.google_token or not user.onedrive_token:
+            raise SyncError("User not authenticated with both Google Drive and OneDrive", 401)
+        for provider in PROVIDERS:
+            state = self.db.session.get(self.state_model, (user.id, provider))
+            # The index's first crawl runs on its own schedule; a run can't wait the hours it may take
+            if state is None or state.full_synced_at is None:
+                raise SyncError(f"The {provider} index is still being built; syncs start once it is complete", 409)
+        started = datetime.datetime.now()
+        # The indexer's lock may be held for a sync of every user; keep the claim alive while waiting for it
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._keep_alive, args=(sync.id, stop), daemon=True,
+                                     name=f'sync-{sync.id}-heartbeat')
+        heartbeat.start()
+        try:
+            self.indexer.sync_user(user)
+        finally:
+            stop.set()
+            heartbeat.join()
+        for provider in PROVIDERS:
+            state = self.db.session.get(self.state_model, (user.id, provider))
+            self.db.session.refresh(state)
+            if state.error:
+                raise SyncError(f"Could not bring the {provider} index up to date: {state.error}", 502)
+
+        paths = self._changed_paths(sync)
+        rows, entries = self._load(sync, paths)
+        counts = {'checked': len(paths), 'copied': 0, 'deleted': 0, 'matched': 0, 'conflicts': 0, 'failed': 0,
+                  'bytes': 0}
+        changes = []
+        copies = []
+        for path in sorted(paths):
+            entry = entries.get(path)
+            action = plan(sync.mode, sync.conflict_policy, sync.propagate_deletes, path, rows[path], entry,
+                          lambda google, onedrive: self._same_content(user.id, google, onedrive))
+            if action is None:
+                continue
+            if action.kind == 'record':
+                self._record(sync, entries, path, rows[path])
+                counts['matched'] += 1
+            elif action.kind == 'forget':
+                self.db.session.delete(entry)
+            elif action.kind == 'conflict':
+                counts['conflicts'] += 1
+                changes.append({"path": path, "action": "conflict"})
+            else:
+                copies.append(action)
+        self.db.session.commit()
+
+        for action, item, moved, error in self._apply(user, sync, copies, rows):
+            change = {"path": action.path, "action": action.kind}
+            if action.kind == 'copy':
+                change.update({"from": action.source, "to": action.destination, "conflict": action.conflict})
+            else:
+                change["provider"] = action.destination
+            counts['bytes'] += moved
+            if error:
+                counts['failed'] += 1
+                change["error"] = error
+            elif action.kind == 'copy':
+                counts['copied'] += 1
+                self._record(sync, entries, action.path, rows[action.path], action.destination, item)
+            else:
+                counts['deleted'] += 1
+                self.db.session.delete(entries[action.path])
+            changes.append(change)
+            self.db.session.commit()
+
+        # A failed copy or delete is looked at again next run, along with everything changed since this one
+        if not counts['failed']:
+            sync.index_watermark = started
+        self.db.session.commit()
+        return {"counts": counts, "changes": changes[:MAX_LISTED_CHANGES],
+                "more_changes": max(len(changes) - MAX_LISTED_CHANGES, 0)}
+
+    def _files_under(self, user_id, provider, root):
+        File = self.file_model
+        # '0' sorts right after '/', so this range is every path under root, and the path index serves it.
+        # Files without a content hash (Drive-native documents, OneNote notebooks) have no bytes to copy.
+        return File.query.filter(File.user_id == user_id, File.provider == provider, File.is_folder.is_(False),
+                                 File.content_hash.isnot(None), File.path > root + '/', File.path < root + '0')
+
+    def _changed_paths(self, sync):
+        """Paths (relative to the sync folders) of files changed since the last run, on either side."""
+        File, Entry = self.file_model, self.entry_model
+        paths = set()
+        for provider in PROVIDERS:
+            root = getattr(sync, f'{provider}_path')
+            query = self._files_under(sync.user_id, provider, root).with_entities(File.path)
+            if sync.index_watermark is not None:
+                query = query.filter(File.indexed_at >= sync.index_watermark)
+            paths.update(path[len(root):] for path, in query)
+            # Synced files no longer at their path: deleted, moved or renamed since
+            synced_id = getattr(Entry, f'{provider}_id')
+            gone = Entry.query.with_entities(Entry.path).outerjoin(File, sa.and_(
+                File.user_id == sync.user_id, File.provider == provider, File.file_id == synced_id,
+                File.path == sa.literal(root) + Entry.path)).filter(
+                Entry.sync_id == sync.id, synced_id.isnot(None), File.file_id.is_(None))
+            paths.update(path for path, in gone)
+        return paths
+
+    def _load(self, sync, paths):
+        """Index rows by path and provider (None where a side has no file), and baseline entries by path."""
+        File, Entry = self.file_model, self.entry_model
+        rows = {path: dict.fromkeys(PROVIDERS) for path in paths}
+        entries = {}
+        ordered = sorted(paths)
+        for start in range(0, len(ordered), PATH_CHUNK):
+            chunk = ordered[start:start + PATH_CHUNK]
+            for provider in PROVIDERS:
+                root = getattr(sync, f'{provider}_path')
+                query = self._files_under(sync.user_id, provider, root).with_entities(
+                    File.file_id, File.path, File.size, File.content_hash, File.hash_algorithm, File.modified_time
+                ).filter(File.path.in_([root + path for path in chunk]))
+                for row in query:
+                    path = row.path[len(root):]
+                    current = rows[path][provider]
+                    # Drive allows several files of one name in a folder; the newest stands for the path
+                    if current is None or (row.modified_time or datetime.datetime.min) > \
+                            (current.modified_time or datetime.datetime.min):
+                        rows[path][provider] = row
+            entries.update((entry.path, entry) for entry in Entry.query.filter(
+                Entry.sync_id == sync.id, Entry.path.in_(chunk)))
+        return rows, entries
+
+    def _same_content(self, user_id, google, onedrive):
+        """Whether two files hold the same bytes, as far as their hashes (and any transfer fingerprints) tell."""
+        if google.size != onedrive.size:
+            return False
+        hashes = {'google': self.fingerprints.hashes_for(user_id, 'google', _index_item('google', google)),
+                  'onedrive': self.fingerprints.hashes_for(user_id, 'onedrive', _index_item('onedrive', onedrive))}
+        shared = hashes['google'].keys() & hashes['onedrive'].keys()
+        return bool(shared) and all(hashes['google'][algorithm] == hashes['onedrive'][algorithm]
+                                    for algorithm in shared)
+
+    def _record(self, sync, entries, path, rows, destination=None, item=None):
+        """Save what both sides hold now as the path's baseline; item is a fresh copy on destination."""
+        entry = entries.get(path)
+        if entry is None:
+            entry = entries[path] = self.entry_model(sync_id=sync.id, path=path)
+            self.db.session.add(entry)
+        for provider in PROVIDERS:
+            if provider == destination:
+                file_id, content_hash = item['id'], native_hashes(provider, item).get(NATIVE_HASH[provider])
+            else:
+                file_id, content_hash = rows[provider].file_id, rows[provider].content_hash
+            setattr(entry, f'{provider}_id', file_id)
+            setattr(entry, f'{provider}_hash', content_hash)
+        entry.size = rows[_other(destination) if destination else 'google'].size
+        entry.synced_at = datetime.datetime.now()
+
+    def _apply(self, user, sync, actions, rows):
+        """Run the copies and deletes on a thread pool; yield (action, copy's metadata, bytes, error) for each."""
+        if not actions:
+            return
+        roots = {provider: getattr(sync, f'{provider}_path') for provider in PROVIDERS}
+        folders = _DestinationFolders(self.db, self.file_model, self.state_model, self.access_token)
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sync-run')
+        try:
+            pending = {executor.submit(self._apply_one, user, roots, folders, action, rows[action.path]): action
+                       for action in actions}
+            while pending:
+                done, _ = wait(pending, timeout=HEARTBEAT_INTERVAL, return_when=FIRST_COMPLETED)
+                self._heartbeat(sync.id)
+                for future in done:
+                    action = pending.pop(future)
+                    try:
+                        item, moved = future.result()
+                        yield action, item, moved, None
+                    except Exception as e:
+                        logger.warning(f"Sync {sync.id}: {action.kind} of {action.path} failed: {e}")
+                        yield action, None, 0, getattr(e, 'message', str(e))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _apply_one(self, user, roots, folders, action, rows):
+        with self.app.app_context():
+            try:
+                if action.kind == 'delete':
+                    self.delete_file(user, action.destination, rows[action.destination].file_id)
+                    return None, 0
+                source, destination = action.source, action.destination
+                parent_id = folders.resolve(user, destination, roots[destination] + action.path.rsplit('/', 1)[0])
+                progress = _CopyProgress()
+                item = self.copy_file(user, DIRECTIONS[(source, destination)], rows[source].file_id, progress,
+                                      parent_id)['file']
+                replaced = rows[destination]
+                # OneDrive overwrites the file of that name in place; Drive uploads a second one beside it
+                if replaced is not None and replaced.file_id != item['id']:
+                    self.delete_file(user, destination, replaced.file_id)
+                return item, progress.bytes_done
+            finally:
+                self.db.session.remove()
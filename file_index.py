@@ -0,0 +1,321 @@
+"""Local SQLite index of both drives, kept current from the change feeds.
+
+The first sync of a (user, provider) pair walks the whole drive: Drive
+files.list after taking a changes start token, or a Graph delta walk from
+scratch, which ends with the delta link. Every later sync only applies the
+changes since the saved cursor. A walk commits its position after every page,
+so an interrupted crawl of a large drive carries on where it stopped. When a
+crawl finishes, rows it did not touch belong to files that no longer exist and
+are removed.
+"""
+import datetime
+import logging
+import threading
+
+import sqlalchemy as sa
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from changes import ChangeFeedError, GOOGLE_FILE_FIELDS, google_start_token, iter_google_changes, iter_graph_delta
+from clients import get_client
+from transfer import GOOGLE_API_URL, GRAPH_API_URL
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_FOLDER_TYPE = 'application/vnd.google-apps.folder'
+# Only what the index stores; delta links keep the $select for later polls
+GRAPH_DELTA_SELECT = 'id,name,size,file,folder,root,parentReference,lastModifiedDateTime,deleted'
+CRAWL_PAGE_SIZE = 1000
+# Guards the path walk against a parent cycle in provider data
+MAX_PATH_DEPTH = 64
+
+# Recomputes the path ('/Folder/Sub/file.txt') of the starting rows and
+# everything beneath them; rows whose parent is not indexed start a new '/'.
+# A row whose path changes counts as changed, so sync runs see moved files.
+PATH_REFRESH_SQL = '''
+WITH RECURSIVE tree(file_id, path, depth) AS (
+    SELECT f.file_id,
+           CASE WHEN f.file_id = :root_id THEN '' ELSE COALESCE(p.path, '') || '/' || f.name END,
+           0
+    FROM indexed_file f
+    LEFT JOIN indexed_file p ON p.user_id = f.user_id AND p.provider = f.provider AND p.file_id = f.parent_id
+    WHERE f.user_id = :user_id AND f.provider = :provider AND {start}
+    UNION ALL
+    SELECT c.file_id, tree.path || '/' || c.name, tree.depth + 1
+    FROM tree JOIN indexed_file c ON c.user_id = :user_id AND c.provider = :provider AND c.parent_id = tree.file_id
+    WHERE tree.depth < {max_depth}
+)
+UPDATE indexed_file SET path = tree.path, indexed_at = :indexed_at FROM tree
+WHERE indexed_file.user_id = :user_id AND indexed_file.provider = :provider
+  AND indexed_file.file_id = tree.file_id AND indexed_file.path IS NOT tree.path
+'''
+# Whole drive: start from rows with no indexed parent (the root, shared items)
+_FULL_START = 'p.file_id IS NULL'
+# Changed rows only, skipping those whose parent changed too (reached through it)
+_PARTIAL_START = 'f.file_id IN :file_ids AND (f.parent_id IS NULL OR f.parent_id NOT IN :file_ids)'
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def google_row(item):
+    parents = item.get('parents') or [None]
+    return {
+        'file_id': item['id'],
+        'name': item.get('name', ''),
+        'size': int(item['size']) if 'size' in item else None,
+        'mime_type': item.get('mimeType'),
+        'is_folder': item.get('mimeType') == GOOGLE_FOLDER_TYPE,
+        'parent_id': parents[0],
+        'modified_time': _parse_time(item.get('modifiedTime')),
+        'content_hash': item.get('md5Checksum'),
+        'hash_algorithm': 'md5' if item.get('md5Checksum') else None,
+    }
+
+
+def graph_row(item):
+    hashes = item.get('file', {}).get('hashes', {})
+    if 'quickXorHash' in hashes:
+        content_hash, algorithm = hashes['quickXorHash'], 'quickXorHash'
+    elif 'sha1Hash' in hashes:
+        content_hash, algorithm = hashes['sha1Hash'], 'sha1'
+    else:
+        content_hash, algorithm = None, None
+    return {
+        'file_id': item['id'],
+        'name': item.get('name', ''),
+        'size': item.get('size'),
+        'mime_type': item.get('file', {}).get('mimeType'),
+        'is_folder': 'folder' in item or 'root' in item,
+        'parent_id': item.get('parentReference', {}).get('id'),
+        'modified_time': _parse_time(item.get('lastModifiedDateTime')),
+        'content_hash': content_hash,
+        'hash_algorithm': algorithm,
+    }
+
+
+ROW_BUILDERS = {'google': google_row, 'onedrive': graph_row}
+
+
+def entry_dict(entry):
+    return {
+        'provider': entry.provider,
+        'id': entry.file_id,
+        'name': entry.name,
+        'size': entry.size,
+        'mimeType': entry.mime_type,
+        'isFolder': entry.is_folder,
+        'parentId': entry.parent_id,
+        'path': entry.path,
+        'modifiedTime': entry.modified_time.isoformat() + 'Z' if entry.modified_time else None,
+        'hash': entry.content_hash,
+        'hashAlgorithm': entry.hash_algorithm,
+    }
+
+
+class DriveIndexer:
+    def __init__(self, app, db, file_model, state_model, user_model, access_token, interval=60):
+        self.app = app
+        self.db = db
+        self.file_model = file_model
+        self.state_model = state_model
+        self.user_model = user_model
+        # access_token(user, provider) -> a current token, refreshing it if needed
+        self.access_token = access_token
+        self.interval = interval
+        self._scheduler = None
+        self._sync_lock = threading.Lock()
+        self._resync = False
+
+    def start(self):
+        self._scheduler = BackgroundScheduler(daemon=True)
+        self._scheduler.add_job(self.sync_all, 'interval', seconds=self.interval, id='sync-index',
+                                max_instances=1, coalesce=True, next_run_time=datetime.datetime.now())
+        self._scheduler.start()
+        logger.info(f"File index sync started, every {self.interval}s")
+
+    def shutdown(self):
+        if self._scheduler:
+            self._scheduler.shutdown(wait=False)
+
+    def wake(self):
+        # Same hand-off as the transfer queue: a sync in progress goes round again
+        self._resync = True
+        if self._scheduler and self._scheduler.running and not self._sync_lock.locked():
+            self._scheduler.add_job(self.sync_all, id='sync-index-now', replace_existing=True)
+
+    def sync_all(self):
+        with self._sync_lock, self.app.app_context():
+            self._resync = True
+            while self._resync:
+                self._resync = False
+                for user in self.user_model.query.all():
+                    for provider in ROW_BUILDERS:
+                        if getattr(user, f'{provider}_token'):
+                            self.sync(user, provider)
+            self.db.session.remove()
+
+    def sync_user(self, user):
+        """Bring one user's index up to date now, waiting for a sync in progress to finish first."""
+        with self._sync_lock:
+            for provider in ROW_BUILDERS:
+                if getattr(user, f'{provider}_token'):
+                    self.sync(user, provider)
+
+    def sync(self, user, provider):
+        state = self.db.session.get(self.state_model, (user.id, provider))
+        if state is None:
+            state = self.state_model(user_id=user.id, provider=provider)
+            self.db.session.add(state)
+            self.db.session.commit()
+        started = datetime.datetime.now()
+        try:
+            access_token = self.access_token(user, provider)
+            if state.full_synced_at is None:
+                self._crawl(state, provider, access_token)
+            else:
+                self._apply_changes(state, provider, access_token)
+            state.error = None
+            state.synced_at = datetime.datetime.now()
+            self.db.session.commit()
+            logger.info(f"Synced {provider} index for user {user.id} in "
+                        f"{(datetime.datetime.now() - started).total_seconds():.1f}s")
+        except ChangeFeedError as e:
+            self.db.session.rollback()
+            if e.status == 410 or (provider == 'google' and e.status in (400, 404)):
+                # Cursor no longer valid: crawl again, then drop whatever the crawl didn't see
+                logger.warning(f"{provider} change cursor for user {user.id} expired; starting a full crawl")
+                state.cursor = None
+                state.crawl_cursor = None
+                state.crawl_started_at = None
+                state.full_synced_at = None
+            state.error = e.message
+            self.db.session.commit()
+        except Exception as e:
+            logger.exception(f"Syncing {provider} index for user {user.id} failed")
+            self.db.session.rollback()
+            state.error = getattr(e, 'message', str(e))
+            self.db.session.commit()
+
+    def _crawl(self, state, provider, access_token):
+        if state.crawl_started_at is None:
+            state.crawl_started_at = datetime.datetime.now()
+            if provider == 'google':
+                # Taken first so nothing changed during the crawl is missed
+                state.cursor = google_start_token(access_token)
+                state.root_id = self._google_root_id(access_token)
+            self.db.session.commit()
+            logger.info(f"Starting full {provider} crawl for user {state.user_id}")
+        else:
+            logger.info(f"Resuming {provider} crawl for user {state.user_id}")
+
+        if provider == 'google':
+            self._crawl_google(state, access_token)
+        else:
+            self._crawl_graph(state, access_token)
+
+        File = self.file_model
+        removed = File.query.filter(File.user_id == state.user_id, File.provider == provider,
+                                    File.indexed_at < state.crawl_started_at).delete(synchronize_session=False)
+        self._refresh_paths(state, provider)
+        state.full_synced_at = datetime.datetime.now()
+        state.crawl_cursor = None
+        state.crawl_started_at = None
+        count = File.query.filter_by(user_id=state.user_id, provider=provider).count()
+        logger.info(f"Full {provider} crawl for user {state.user_id} indexed {count} files, removed {removed}")
+
+    def _google_root_id(self, access_token):
+        response = get_client('google').get(f'{GOOGLE_API_URL}/drive/v3/files/root', params={'fields': 'id'},
+                                            headers={'Authorization': f'Bearer {access_token}'})
+        if response.status_code != 200:
+            raise ChangeFeedError("Failed to get Google Drive root folder", response.status_code)
+        return response.json()['id']
+
+    def _crawl_google(self, state, access_token):
+        params = {
+            'q': 'trashed = false',
+            'pageSize': CRAWL_PAGE_SIZE,
+            'fields': f'nextPageToken,files({GOOGLE_FILE_FIELDS})'
+        }
+        while True:
+            if state.crawl_cursor:
+                params['pageToken'] = state.crawl_cursor
+            response = get_client('google').get(f'{GOOGLE_API_URL}/drive/v3/files', params=params,
+                                                headers={'Authorization': f'Bearer {access_token}'})
+            if response.status_code != 200:
+                raise ChangeFeedError("Failed to list Google Drive files", response.status_code)
+            page = response.json()
+            self._upsert(state.user_id, 'google', page.get('files', []))
+            state.crawl_cursor = page.get('nextPageToken')
+            self.db.session.commit()
+            if not state.crawl_cursor:
+                return
+
+    def _crawl_graph(self, state, access_token):
+        url = state.crawl_cursor or f'{GRAPH_API_URL}/me/drive/root/delta?$select={GRAPH_DELTA_SELECT}'
+        for changes, next_link, delta_link in iter_graph_delta(access_token, url):
+            self._apply(state, 'onedrive', changes)
+            state.crawl_cursor = next_link
+            if delta_link:
+                state.cursor = delta_link
+            self.db.session.commit()
+
+    def _apply_changes(self, state, provider, access_token):
+        if provider == 'google':
+            for changes, new_token in iter_google_changes(access_token, state.cursor):
+                self._apply(state, provider, changes)
+                self._refresh_paths(state, provider, [file_id for file_id, item in changes if item])
+                if new_token:
+                    state.cursor = new_token
+        else:
+            for changes, _, delta_link in iter_graph_delta(access_token, state.cursor):
+                self._apply(state, provider, changes)
+                self._refresh_paths(state, provider, [file_id for file_id, item in changes if item])
+                if delta_link:
+                    state.cursor = delta_link
+
+    def _apply(self, state, provider, changes):
+        present = [item for _, item in changes if item is not None]
+        removed = [file_id for file_id, item in changes if item is None]
+        if provider == 'onedrive':
+            for item in present:
+                if 'root' in item:
+                    state.root_id = item['id']
+        self._upsert(state.user_id, provider, present)
+        if removed:
+            File = self.file_model
+            File.query.filter(File.user_id == state.user_id, File.provider == provider,
+                              File.file_id.in_(removed)).delete(synchronize_session=False)
+
+    def _refresh_paths(self, state, provider, file_ids=None):
+        """Recompute paths for the whole drive, or for changed files and their descendants."""
+        if file_ids is not None and not file_ids:
+            return
+        params = {'user_id': state.user_id, 'provider': provider, 'root_id': state.root_id,
+                  'indexed_at': datetime.datetime.now()}
+        statement = sa.text(PATH_REFRESH_SQL.format(start=_FULL_START if file_ids is None else _PARTIAL_START,
+                                                    max_depth=MAX_PATH_DEPTH)).bindparams(
+            sa.bindparam('indexed_at', type_=sa.DateTime()))
+        if file_ids is not None:
+            statement = statement.bindparams(sa.bindparam('file_ids', expanding=True))
+            params['file_ids'] = list(file_ids)
+        self.db.session.execute(statement, params)
+
+    def _upsert(self, user_id, provider, items):
+        if not items:
+            return
+        now = datetime.datetime.now()
+        build = ROW_BUILDERS[provider]
+        rows = [{**build(item), 'user_id': user_id, 'provider': provider, 'indexed_at': now} for item in items]
+        stmt = sqlite_insert(self.file_model.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'provider', 'file_id'],
+            set_={column: stmt.excluded[column] for column in rows[0] if column not in ('user_id', 'provider', 'file_id')}
+        )
+        self.db.session.execute(stmt, rows)
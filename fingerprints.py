@@ -0,0 +1,190 @@
+"""Content fingerprints for skipping transfers whose bytes are already there.
+
+Each provider reports one hash natively: Drive an md5Checksum, OneDrive a
+quickXorHash. A transfer computes the destination's hash while the bytes
+stream through, so afterwards both the source and the new copy are known
+under both algorithms. Those fingerprints are stored per file; before a later
+transfer, a destination file with the same name, size and hash (from the
+store or the drive index) is checked against the provider and, if it still
+matches, the transfer finishes without moving any bytes.
+"""
+import base64
+import datetime
+import hashlib
+import logging
+
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# The hash each provider reports for its files
+NATIVE_HASH = {'google': 'md5', 'onedrive': 'quickXorHash'}
+# Store column for each algorithm
+HASH_COLUMNS = {'md5': 'md5', 'quickXorHash': 'quick_xor_hash'}
+
+
+class QuickXorHash:
+    """OneDrive's quickXorHash, streaming.
+
+    Byte n of the input is XORed into a 160-bit ring at bit (11 * n) % 160,
+    so bytes 160 apart land in the same place. update() only XOR-folds the
+    input into 160 per-position accumulators, which is a handful of big-int
+    operations per chunk; digest() shifts the accumulators into the ring once.
+    """
+    WIDTH = 160
+    SHIFT = 11
+
+    def __init__(self):
+        self._folded = 0
+        self._length = 0
+
+    def update(self, data):
+        if not len(data):
+            return
+        phase = self._length % self.WIDTH
+        size = phase + len(data)
+        # Line the input up on 160-byte blocks; transfer chunks already are, so this rarely copies
+        if phase or size % self.WIDTH:
+            data = bytes(phase) + bytes(data) + bytes(-size % self.WIDTH)
+        view = memoryview(data)
+        blocks = len(view) // self.WIDTH
+        low = blocks // 2
+        # XOR the top blocks onto the bottom ones, halving until one block remains
+        value = int.from_bytes(view[:low * self.WIDTH], 'little') ^ int.from_bytes(view[low * self.WIDTH:], 'little')
+        blocks -= low
+        while blocks > 1:
+            low = blocks // 2
+            bits = low * self.WIDTH * 8
+            value = (value & ((1 << bits) - 1)) ^ (value >> bits)
+            blocks -= low
+        self._folded ^= value
+        self._length += len(view) - phase - (-size % self.WIDTH)
+
+    def digest(self):
+        ring = 0
+        mask = (1 << self.WIDTH) - 1
+        for position in range(self.WIDTH):
+            byte = (self._folded >> (8 * position)) & 0xFF
+            if byte:
+                offset = (position * self.SHIFT) % self.WIDTH
+                ring ^= ((byte << offset) | (byte >> (self.WIDTH - offset))) & mask
+        result = bytearray(ring.to_bytes(self.WIDTH // 8, 'little'))
+        for i, length_byte in enumerate(self._length.to_bytes(8, 'little')):
+            result[self.WIDTH // 8 - 8 + i] ^= length_byte
+        return bytes(result)
+
+    def b64digest(self):
+        return base64.b64encode(self.digest()).decode()
+
+
+class ContentHasher:
+    """md5 and quickXorHash of a stream, updated chunk by chunk as it is read."""
+
+    def __init__(self):
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._quick_xor = QuickXorHash()
+
+    def update(self, chunk):
+        self._md5.update(chunk)
+        self._quick_xor.update(chunk)
+        self.size += len(chunk)
+
+    def hashes(self):
+        # In the encodings the providers report: hex md5, base64 quickXorHash
+        return {'md5': self._md5.hexdigest(), 'quickXorHash': self._quick_xor.b64digest()}
+
+
+def parent_ids(provider, item):
+    if provider == 'google':
+        return item.get('parents', [])
+    return [item['parentReference']['id']] if item.get('parentReference', {}).get('id') else []
+
+
+def native_hashes(provider, item):
+    """The hashes a provider reported in a file's metadata."""
+    if provider == 'google':
+        value = item.get('md5Checksum')
+    else:
+        value = item.get('file', {}).get('hashes', {}).get('quickXorHash')
+    return {NATIVE_HASH[provider]: value} if value else {}
+
+
+class FingerprintStore:
+    def __init__(self, db, model, index_model=None):
+        self.db = db
+        self.model = model
+        # The drive index also knows every indexed file's native hash
+        self.index_model = index_model
+
+    def hashes_for(self, user_id, provider, item):
+        """All known hashes of a file: its native one, plus any stored for the same content."""
+        hashes = native_hashes(provider, item)
+        if not hashes:
+            return {}
+        stored = self.db.session.get(self.model, (user_id, provider, item['id']))
+        native = NATIVE_HASH[provider]
+        # The stored row only describes the file if its content hasn't changed since
+        if stored and getattr(stored, HASH_COLUMNS[native]) == hashes[native]:
+            for algorithm, column in HASH_COLUMNS.items():
+                hashes.setdefault(algorithm, getattr(stored, column))
+        return {algorithm: value for algorithm, value in hashes.items() if value}
+
+    def candidates(self, user_id, provider, algorithm, value, size, name):
+        """IDs of provider files thought to hold this content under this name."""
+        Fingerprint = self.model
+        column = getattr(Fingerprint, HASH_COLUMNS[algorithm])
+        file_ids = [row.file_id for row in Fingerprint.query.filter(
+            Fingerprint.user_id == user_id, Fingerprint.provider == provider,
+            column == value, Fingerprint.size == size, Fingerprint.name == name).limit(10)]
+        if self.index_model is not None:
+            File = self.index_model
+            file_ids += [row.file_id for row in File.query.filter(
+                File.user_id == user_id, File.provider == provider, File.hash_algorithm == algorithm,
+                File.content_hash == value, File.size == size, File.name == name).limit(10)
+                if row.file_id not in file_ids]
+        return file_ids
+
+    def find_copy(self, user_id, source, item, destination, fetch, folder_id=None):
+        """An existing destination file identical to item, or None.
+
+        fetch(file_id) must return the destination file's current metadata
+        from the provider (None if it is gone), so a stale fingerprint never
+        causes a skip. With folder_id, only a copy in that folder counts.
+        """
+        if item.get('size') is None:
+            return None
+        size = int(item['size'])
+        algorithm = NATIVE_HASH[destination]
+        value = self.hashes_for(user_id, source, item).get(algorithm)
+        if not value:
+            return None
+        for file_id in self.candidates(user_id, destination, algorithm, value, size, item.get('name')):
+            current = fetch(file_id)
+            if (current is not None and not current.get('trashed')
+                    and native_hashes(destination, current).get(algorithm) == value
+                    and current.get('name') == item.get('name')):
+                if folder_id is None or folder_id in parent_ids(destination, current):
+                    return current
+                continue
+            logger.info(f"Fingerprint for {destination} file {file_id} is stale; forgetting it")
+            self.forget(user_id, destination, file_id)
+        return None
+
+    def record(self, user_id, provider, item, hashes, size):
+        def fingerprint():
+            return self.model(user_id=user_id, provider=provider, file_id=item['id'], name=item.get('name'),
+                              size=size, md5=hashes.get('md5'), quick_xor_hash=hashes.get('quickXorHash'),
+                              recorded_at=datetime.datetime.now())
+        self.db.session.merge(fingerprint())
+        try:
+            self.db.session.commit()
+        except IntegrityError:
+            # A concurrent copy of the same file inserted it first; update that row instead
+            self.db.session.rollback()
+            self.db.session.merge(fingerprint())
+            self.db.session.commit()
+
+    def forget(self, user_id, provider, file_id):
+        self.model.query.filter_by(user_id=user_id, provider=provider, file_id=file_id).delete()
+        self.db.session.commit()
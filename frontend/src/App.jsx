@@ -28,7 +28,7 @@ export default function App() {
   const fetchGoogleFiles = async () => {
     try {
       setLoading(prev => ({ ...prev, google: true }));
-      const res = await axios.get(`${API_BASE}/files/google`);
+      const res = await axios.get(`${API_BASE}/files/google`, { params: { fields: "id,name" } });
       setGoogleFiles(res.data.files || []);
     } catch (err) {
       console.error("Error fetching Google Drive files:", err);
@@ -43,7 +43,7 @@ export default function App() {
   const fetchOneDriveFiles = async () => {
     try {
       setLoading(prev => ({ ...prev, onedrive: true }));
-      const res = await axios.get(`${API_BASE}/files/onedrive`);
+      const res = await axios.get(`${API_BASE}/files/onedrive`, { params: { fields: "id,name" } });
       setOneDriveFiles(res.data.value || []);
     } catch (err) {
       console.error("Error fetching OneDrive files:", err);
@@ -115,7 +115,21 @@ export default function App() {
       
       const response = await axios.post(`${API_BASE}${endpoint}`);
       
-      alert(`File transferred successfully to ${response.data.destination}!`);
+      // Transfers run as background jobs; poll until this one finishes
+      let job;
+      do {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        job = (await axios.get(`${API_BASE}${response.data.status_url}`)).data;
+        if (job.bytes_total) {
+          const percent = Math.floor((job.bytes_done / job.bytes_total) * 100);
+          setTransferStatus(`Transferring ${fileName}... ${percent}%`);
+        }
+      } while (job.status === "queued" || job.status === "running");
+      
+      if (job.status === "failed") {
+        throw new Error(job.error);
+      }
+      alert(`File transferred successfully to ${job.result.destination}!`);
       // Refresh both file lists
       fetchGoogleFiles();
       fetchOneDriveFiles();
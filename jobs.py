@@ -0,0 +1,260 @@
+"""Persistent transfer job queue.
+
+Jobs are rows in the app's SQLite database. An APScheduler interval job claims
+queued rows and hands them to a thread pool, respecting a global concurrency
+limit and a per-provider limit (a transfer counts against both its source and
+destination provider). Running jobs write their progress back periodically so
+any process can report it.
+
+A folder job crawls a source folder and queues one file job per file it
+finds, each tagged with the folder job's id (tree_id) so the tree's progress
+can be summed from them.
+"""
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from metrics import TRANSFERS_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+# Source and destination provider for each transfer direction
+TRANSFER_DIRECTIONS = {
+    'gdrive-to-onedrive': ('google', 'onedrive'),
+    'onedrive-to-gdrive': ('onedrive', 'google'),
+}
+
+
+class JobProgress:
+    """Tracks one running job; progress is flushed to the database at most once per interval."""
+
+    def __init__(self, queue, job_id):
+        self._queue = queue
+        self.job_id = job_id
+        self.file_name = None
+        self.bytes_total = None
+        self.bytes_done = 0
+        self._flushed = 0
+
+    def start(self, file_name, bytes_total):
+        self.file_name = file_name
+        self.bytes_total = bytes_total
+        self._flush()
+
+    def advance(self, bytes_done):
+        self.bytes_done = bytes_done
+        self.touch()
+
+    def touch(self):
+        # Keeps the heartbeat fresh for work that moves no bytes, like crawling a folder
+        if time.monotonic() - self._flushed >= self._queue.progress_interval:
+            self._flush()
+
+    def _flush(self):
+        self._flushed = time.monotonic()
+        self._queue.update_job(self.job_id, file_name=self.file_name, bytes_total=self.bytes_total,
+                               bytes_done=self.bytes_done, heartbeat_at=datetime.datetime.now())
+
+
+class TransferQueue:
+    def __init__(self, app, db, model, runner, workers=4, provider_limits=None,
+                 poll_interval=2, progress_interval=1, stale_after=300):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.runner = runner
+        self.workers = workers
+        self.provider_limits = provider_limits or {}
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.stale_after = stale_after
+        self._executor = None
+        self._scheduler = None
+        self._dispatch_lock = threading.Lock()
+        self._redispatch = False
+        # Jobs running in this process, for live progress between flushes
+        self.active = {}
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='transfer-job')
+        self._scheduler = BackgroundScheduler(daemon=True)
+        self._scheduler.add_job(self.dispatch, 'interval', seconds=self.poll_interval, id='dispatch-transfers',
+                                max_instances=1, coalesce=True)
+        self._scheduler.start()
+        logger.info(f"Transfer queue started with {self.workers} workers, provider limits {self.provider_limits}")
+
+    def shutdown(self):
+        if self._scheduler:
+            self._scheduler.shutdown(wait=False)
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, user_id, direction, file_id):
+        return self.submit_many(user_id, [(direction, file_id)])[0]
+
+    def submit_tree(self, user_id, direction, folder_id, destination_parent_id=None):
+        if direction not in TRANSFER_DIRECTIONS:
+            raise ValueError(f"Unknown transfer direction: {direction}")
+        job = self.model(user_id=user_id, direction=direction, file_id=folder_id, kind='folder',
+                         destination_parent_id=destination_parent_id)
+        self.db.session.add(job)
+        self.db.session.commit()
+        self.wake()
+        return job
+
+    def submit_tree_files(self, tree, destination_parent_id, files):
+        """Queue a file job for each listed file (an item with id, name, size) of a folder job's tree."""
+        jobs = [self.model(user_id=tree.user_id, direction=tree.direction, file_id=item['id'], file_name=item['name'],
+                           bytes_total=int(item['size']) if item.get('size') is not None else None,
+                           tree_id=tree.id, destination_parent_id=destination_parent_id) for item in files]
+        self.db.session.add_all(jobs)
+        self.db.session.commit()
+        self.wake()
+        return jobs
+
+    def tree_file_ids(self, tree_id):
+        """Source file IDs already queued for a tree, so a resumed crawl doesn't queue them twice."""
+        return {file_id for file_id, in self.db.session.query(self.model.file_id).filter_by(tree_id=tree_id)}
+
+    def tree_summary(self, tree, failures=20):
+        """File counts by status and byte totals across a folder job's file jobs."""
+        Job = self.model
+        rows = self.db.session.query(Job.status, self.db.func.count(), self.db.func.sum(Job.bytes_total),
+                                     self.db.func.sum(Job.bytes_done)).filter_by(tree_id=tree.id).group_by(Job.status)
+        files = {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0}
+        bytes_total = bytes_done = 0
+        for status, count, total, done in rows:
+            files[status] = count
+            bytes_total += total or 0
+            bytes_done += done or 0
+        # Running jobs flush progress periodically; use the live figures where this process has them
+        for job_id, done in Job.query.with_entities(Job.id, Job.bytes_done).filter_by(tree_id=tree.id, status='running'):
+            live = self.active.get(job_id)
+            if live:
+                bytes_done += live.bytes_done - (done or 0)
+        if tree.status in ('queued', 'running'):
+            state = 'crawling'
+        elif files['queued'] or files['running']:
+            state = 'transferring'
+        elif tree.status == 'failed' or files['failed']:
+            state = 'completed_with_errors' if files['completed'] else 'failed'
+        else:
+            state = 'completed'
+        failed = Job.query.filter_by(tree_id=tree.id, status='failed').order_by(Job.finished_at).limit(failures)
+        return {
+            "state": state,
+            "files": {**files, "total": sum(files.values())},
+            "bytes_total": bytes_total,
+            "bytes_done": bytes_done,
+            "failures": [{"job_id": job.id, "file_id": job.file_id, "file_name": job.file_name, "error": job.error}
+                         for job in failed]
+        }
+
+    def submit_many(self, user_id, transfers):
+        """Queue (direction, file_id) pairs in one commit and return their jobs."""
+        for direction, _ in transfers:
+            if direction not in TRANSFER_DIRECTIONS:
+                raise ValueError(f"Unknown transfer direction: {direction}")
+        jobs = [self.model(user_id=user_id, direction=direction, file_id=file_id) for direction, file_id in transfers]
+        self.db.session.add_all(jobs)
+        self.db.session.commit()
+        self.wake()
+        return jobs
+
+    def wake(self):
+        # Dispatch right away instead of waiting for the next poll; a dispatch
+        # that is already running picks up the flag and goes round again
+        self._redispatch = True
+        if self._scheduler and self._scheduler.running and not self._dispatch_lock.locked():
+            self._scheduler.add_job(self.dispatch, id='dispatch-transfers-now', replace_existing=True)
+
+    def update_job(self, job_id, **values):
+        with self.app.app_context():
+            self.model.query.filter_by(id=job_id).update(values)
+            self.db.session.commit()
+
+    def progress(self, job):
+        """Live (bytes_done, bytes_total) for a job, preferring in-process state."""
+        live = self.active.get(job.id)
+        if live:
+            return live.bytes_done, live.bytes_total or job.bytes_total
+        return job.bytes_done, job.bytes_total
+
+    def dispatch(self):
+        with self._dispatch_lock, self.app.app_context():
+            self._redispatch = True
+            while self._redispatch:
+                self._redispatch = False
+                self._dispatch_once()
+
+    def _dispatch_once(self):
+        self._requeue_stale()
+        Job = self.model
+        running = Job.query.filter_by(status='running').all()
+        in_use = {}
+        for job in running:
+            for provider in TRANSFER_DIRECTIONS[job.direction]:
+                in_use[provider] = in_use.get(provider, 0) + 1
+        free = self.workers - len(self.active)
+        if free <= 0:
+            return
+
+        # Look a little past the free slots so a saturated provider doesn't block the other
+        candidates = Job.query.filter_by(status='queued').order_by(Job.created_at).limit(free * 4).all()
+        for job in candidates:
+            if free <= 0:
+                break
+            providers = TRANSFER_DIRECTIONS[job.direction]
+            if any(in_use.get(p, 0) >= self.provider_limits.get(p, self.workers) for p in providers):
+                continue
+            if not self._claim(job.id):
+                continue
+            for provider in providers:
+                in_use[provider] = in_use.get(provider, 0) + 1
+            free -= 1
+            self.active[job.id] = JobProgress(self, job.id)
+            self._executor.submit(self._run, job.id)
+
+    def _claim(self, job_id):
+        # Conditional update so two processes never claim the same job
+        now = datetime.datetime.now()
+        claimed = self.model.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'started_at': now, 'heartbeat_at': now, 'bytes_done': 0})
+        self.db.session.commit()
+        return claimed == 1
+
+    def _requeue_stale(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.stale_after)
+        stale = self.model.query.filter(self.model.status == 'running', self.model.heartbeat_at < cutoff,
+                                        self.model.id.notin_(list(self.active))).update(
+            {'status': 'queued', 'started_at': None}, synchronize_session=False)
+        if stale:
+            logger.warning(f"Requeued {stale} transfer jobs whose worker stopped reporting")
+        self.db.session.commit()
+
+    def _run(self, job_id):
+        progress = self.active[job_id]
+        with self.app.app_context():
+            try:
+                job = self.db.session.get(self.model, job_id)
+                # Don't hold a pooled connection for the length of the transfer
+                self.db.session.expunge(job)
+                self.db.session.commit()
+                logger.info(f"Running transfer job {job_id}: {job.direction} {job.kind} {job.file_id}")
+                with TRANSFERS_IN_FLIGHT.labels(job.direction).track_inprogress():
+                    result = self.runner(job, progress)
+                self.update_job(job_id, status='completed', result=result, bytes_done=progress.bytes_done,
+                                finished_at=datetime.datetime.now())
+                logger.info(f"Transfer job {job_id} completed")
+            except Exception as e:
+                logger.exception(f"Transfer job {job_id} failed")
+                self.update_job(job_id, status='failed', error=getattr(e, 'message', str(e)),
+                                bytes_done=progress.bytes_done, finished_at=datetime.datetime.now())
+            finally:
+                self.db.session.remove()
+                self.active.pop(job_id, None)
+        self.wake()
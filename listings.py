@@ -0,0 +1,147 @@
+"""Paged and streamed file listings for Drive files.list and Graph children.
+
+A page is fetched with an optional field projection (Drive `fields`, Graph
+`$select`), a page size and an opaque cursor: the Drive nextPageToken, or the
+`$skiptoken` from the Graph nextLink, so clients never hand us a URL to send a
+bearer token to. iter_pages follows every page and stream_listing encodes the
+merged items as NDJSON or as one chunked JSON document.
+"""
+import json
+import logging
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+from clients import get_client
+from transfer import GOOGLE_API_URL, GRAPH_API_URL
+
+logger = logging.getLogger(__name__)
+
+# Largest page each API will return, used when following every page
+MAX_PAGE_SIZE = {'google': 1000, 'onedrive': 999}
+# Key the items are under in each provider's listing body
+ITEMS_KEY = {'google': 'files', 'onedrive': 'value'}
+
+_FIELD_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+
+class ListingError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_fields(value):
+    """Comma-separated item fields from a query string, or None for everything."""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    for field in fields:
+        if not _FIELD_NAME.match(field):
+            raise ListingError(f"Invalid field name: {field}")
+    # The id is what every other endpoint takes, so it is always returned
+    return ['id'] + [field for field in fields if field != 'id']
+
+
+def parse_page_size(provider, value):
+    if value is None:
+        return None
+    try:
+        page_size = int(value)
+    except ValueError:
+        raise ListingError("page_size must be an integer")
+    if not 1 <= page_size <= MAX_PAGE_SIZE[provider]:
+        raise ListingError(f"page_size must be between 1 and {MAX_PAGE_SIZE[provider]}")
+    return page_size
+
+
+def project(items, fields):
+    if fields is None:
+        return items
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+def page_request(provider, item_fields, fields=None, page_size=None, cursor=None):
+    """URL and query parameters for one listing page."""
+    if provider == 'google':
+        params = {'fields': f"kind,nextPageToken,incompleteSearch,files({','.join(fields) if fields else item_fields})"}
+        if page_size:
+            params['pageSize'] = page_size
+        if cursor:
+            params['pageToken'] = cursor
+        return f'{GOOGLE_API_URL}/drive/v3/files', params
+    params = {}
+    if fields:
+        params['$select'] = ','.join(fields)
+    if page_size:
+        params['$top'] = page_size
+    if cursor:
+        params['$skiptoken'] = cursor
+    return f'{GRAPH_API_URL}/me/drive/root/children', params
+
+
+def page_result(provider, response):
+    """(body, items, next_cursor) from a listing response, or raise ListingError."""
+    if response.status_code != 200:
+        name = 'Google Drive' if provider == 'google' else 'OneDrive'
+        raise ListingError(f"Failed to list {name} files", response.status_code)
+    body = response.json()
+    if provider == 'google':
+        return body, body.get('files', []), body.get('nextPageToken')
+    next_cursor = None
+    if '@odata.nextLink' in body:
+        next_cursor = parse_qs(urlsplit(body['@odata.nextLink']).query).get('$skiptoken', [None])[0]
+    return body, body.get('value', []), next_cursor
+
+
+def fetch_page(provider, access_token, item_fields, fields=None, page_size=None, cursor=None):
+    """One page of Drive files or OneDrive root children: (body, items, next_cursor)."""
+    url, params = page_request(provider, item_fields, fields, page_size, cursor)
+    response = get_client(provider).get(url, params=params, headers={'Authorization': f'Bearer {access_token}'})
+    return page_result(provider, response)
+
+
+def iter_pages(provider, access_token, item_fields, fields=None):
+    """Yield the items of every page in turn, largest pages first."""
+    cursor = None
+    while True:
+        _, items, cursor = fetch_page(provider, access_token, item_fields, fields,
+                                      MAX_PAGE_SIZE[provider], cursor)
+        yield items
+        if not cursor:
+            return
+
+
+def stream_listing(provider, pages, fmt='ndjson'):
+    """Encode pages of items incrementally as NDJSON lines or one JSON object.
+
+    A failure part way through is reported in-band, since the status line has
+    already been sent: a final {"error": ...} line, or an "error" member.
+    """
+    key = ITEMS_KEY[provider]
+    count = 0
+    if fmt == 'json':
+        yield f'{{"{key}": ['
+    try:
+        for items in pages:
+            if not items:
+                continue
+            # One write per page rather than per item
+            if fmt == 'json':
+                yield (',' if count else '') + ','.join(json.dumps(item) for item in items)
+            else:
+                yield ''.join(json.dumps(item) + '\n' for item in items)
+            count += len(items)
+        error = None
+    except ListingError as e:
+        logger.error(f"{provider} listing failed after {count} items: {e.message}")
+        error = e.message
+    except httpx.HTTPError as e:
+        logger.error(f"{provider} listing failed after {count} items: {e}")
+        error = f"Failed to list {provider} files"
+    if fmt == 'json':
+        yield f'], "count": {count}' + (f', "error": {json.dumps(error)}' if error else '') + '}'
+    elif error:
+        yield json.dumps({'error': error, 'count': count}) + '\n'
@@ -0,0 +1,94 @@
+"""Per-user file metadata cache.
+
+Item metadata is keyed by (user, provider, file ID) in a size-bounded LRU with
+a TTL. Root listings are cached alongside it with the provider change cursor
+(Drive page token or Graph delta link) taken just before the listing was
+fetched. Before a cached listing is served the cursor is polled, at most once
+per check interval: changed items are refreshed or evicted, and any change
+drops the cached listing.
+"""
+import logging
+import threading
+import time
+
+from cachetools import TTLCache
+
+from changes import ChangeFeedError, poll_changes
+
+logger = logging.getLogger(__name__)
+
+
+class CachedListing:
+    def __init__(self, body, cursor):
+        self.body = body
+        self.cursor = cursor
+        self.checked_at = time.monotonic()
+        # Responses the app has rendered from the body, so they go when it does
+        self.renders = {}
+
+
+class MetadataCache:
+    def __init__(self, maxsize=10000, ttl=300, check_interval=15):
+        self.check_interval = check_interval
+        self._items = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._listings = TTLCache(maxsize=max(1, maxsize // 100), ttl=ttl)
+        self._lock = threading.RLock()
+
+    def get(self, user_id, provider, file_id, fields=()):
+        """Cached metadata for a file, or None if missing or lacking any of fields."""
+        with self._lock:
+            item = self._items.get((user_id, provider, file_id))
+        if item is None or any(field not in item for field in fields):
+            return None
+        return item
+
+    def put_many(self, user_id, provider, items):
+        with self._lock:
+            for item in items:
+                if item.get('id'):
+                    self._items[(user_id, provider, item['id'])] = item
+
+    def evict(self, user_id, provider, file_id=None):
+        """Forget one file (and the listing it may appear in), or only the listing."""
+        with self._lock:
+            if file_id is not None:
+                self._items.pop((user_id, provider, file_id), None)
+            self._listings.pop((user_id, provider), None)
+
+    def put_listing(self, user_id, provider, body, items, cursor):
+        self.put_many(user_id, provider, items)
+        listing = CachedListing(body, cursor)
+        with self._lock:
+            self._listings[(user_id, provider)] = listing
+        return listing
+
+    def get_listing(self, user_id, provider, access_token):
+        """The CachedListing if the provider reports no changes since it was taken."""
+        with self._lock:
+            listing = self._listings.get((user_id, provider))
+        if listing is None or listing.cursor is None:
+            return None
+        if time.monotonic() - listing.checked_at < self.check_interval:
+            return listing
+
+        try:
+            changes, cursor = poll_changes(provider, access_token, listing.cursor)
+        except ChangeFeedError as e:
+            logger.warning(f"Dropping cached {provider} listing, change feed failed: {e.message}")
+            self.evict(user_id, provider)
+            return None
+
+        if not changes:
+            listing.cursor = cursor
+            listing.checked_at = time.monotonic()
+            return listing
+
+        logger.info(f"{len(changes)} {provider} changes since cached listing; refreshing")
+        with self._lock:
+            for file_id, item in changes:
+                if item is None:
+                    self._items.pop((user_id, provider, file_id), None)
+                else:
+                    self._items[(user_id, provider, file_id)] = item
+            self._listings.pop((user_id, provider), None)
+        return None
@@ -0,0 +1,69 @@
+"""Prometheus metrics for the app, the provider clients and transfers.
+
+Served in the Prometheus text format at /metrics by both the Flask and the
+ASGI app; each process reports its own. Under a pre-forking server, set
+PROMETHEUS_MULTIPROC_DIR and every worker's samples are merged.
+
+Upstream calls are labelled by a coarse operation name rather than their
+URL, so the label set stays small whatever the file IDs.
+"""
+import os
+import re
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+# Seconds; from a fast metadata call to a slow chunk upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ROUTE_LATENCY = Histogram('cloud_route_duration_seconds', 'Time to produce a response, by route',
+                          ['app', 'method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+UPSTREAM_LATENCY = Histogram('cloud_upstream_request_duration_seconds',
+                             'Provider API calls, until the response headers arrived',
+                             ['provider', 'operation', 'method', 'status'], buckets=LATENCY_BUCKETS)
+BYTES_TRANSFERRED = Counter('cloud_bytes_transferred_total', 'Request and response body bytes to and from providers',
+                            ['provider', 'direction'])
+RETRIES = Counter('cloud_upstream_retries_total', 'Provider calls and upload chunks sent again, by cause',
+                  ['provider', 'reason'])
+THROTTLED = Counter('cloud_upstream_throttled_total', 'Throttling replies from providers', ['provider'])
+TOKEN_REFRESHES = Counter('cloud_token_refreshes_total', 'OAuth token refreshes', ['provider', 'outcome'])
+TRANSFERS_IN_FLIGHT = Gauge('cloud_transfers_in_flight', 'Transfers being copied right now', ['direction'],
+                            multiprocess_mode='livesum')
+
+# (pattern matched against host + path + query, operation), first match wins
+OPERATIONS = (
+    (re.compile(r'/thumbnails/|googleusercontent\.com'), 'thumbnail'),
+    (re.compile(r'upload_id=|uploadSession'), 'upload'),
+    (re.compile(r'uploadType=resumable|createUploadSession'), 'upload_session'),
+    (re.compile(r'alt=media|/content(\?|$)'), 'content'),
+    (re.compile(r'/upload/drive/v3/files'), 'upload'),
+    (re.compile(r'/batch/|\$batch'), 'batch'),
+    (re.compile(r'/changes|/delta'), 'changes'),
+    (re.compile(r'/files(\?|$)|/children'), 'list'),
+    (re.compile(r'/files/[^/?]+|/items/[^/?]+|/root(\?|$)'), 'item'),
+)
+
+
+def operation(url):
+    """A low-cardinality name for the provider endpoint of a URL."""
+    target = f'{url.host}{url.path}?{url.query.decode()}'
+    return next((name for pattern, name in OPERATIONS if pattern.search(target)), 'other')
+
+
+def observe_upstream(provider, request, status, started):
+    """Record one provider call that got a response with status (or an error name) after started."""
+    UPSTREAM_LATENCY.labels(provider, operation(request.url), request.method, status).observe(
+        time.perf_counter() - started)
+    sent = int(request.headers.get('Content-Length') or 0)
+    if sent:
+        BYTES_TRANSFERRED.labels(provider, 'sent').inc(sent)
+
+
+def render():
+    """(body, content type) of the current metrics."""
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
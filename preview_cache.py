@@ -0,0 +1,55 @@
+"""On-disk LRU cache of file thumbnails for the preview routes.
+
+Thumbnail bytes are stored once per distinct content under blobs/, named by
+their sha256, which is also the ETag they are served with. A small reference
+file under refs/ maps each (user, provider, file, version, size) key to its
+blob, or records that the provider has no thumbnail for it. The file's
+version is part of the key, so an edited file gets a new thumbnail without
+anything having to be invalidated.
+
+Refs and blobs share one DiskCache, so they are bounded together and evicted
+least recently used first.
+"""
+import hashlib
+import json
+from collections import namedtuple
+
+from disk_cache import DiskCache
+
+# Thumbnail sizes offered by /preview, as Graph names them, with Drive's equivalent in pixels
+PREVIEW_SIZES = {'small': 96, 'medium': 176, 'large': 800}
+
+Preview = namedtuple('Preview', 'content etag content_type')
+
+
+class PreviewCache:
+    def __init__(self, directory, max_bytes):
+        self._files = DiskCache(directory, max_bytes)
+
+    @staticmethod
+    def _ref_name(key):
+        return f"refs/{hashlib.sha256(json.dumps(key).encode()).hexdigest()}"
+
+    def get(self, key):
+        """The cached Preview for key (content None if there is no thumbnail), or None if not cached."""
+        ref_name = self._ref_name(key)
+        ref = self._files.read(ref_name)
+        if ref is None:
+            return None
+        ref = json.loads(ref)
+        if ref['etag'] is None:
+            return Preview(None, None, None)
+        content = self._files.read(f"blobs/{ref['etag']}")
+        if content is None:
+            # The blob was evicted first; forget the reference too
+            self._files.remove(ref_name)
+            return None
+        return Preview(content, ref['etag'], ref['content_type'])
+
+    def put(self, key, content, content_type):
+        """Store a thumbnail (or, with content None, its absence) for key and return the Preview."""
+        etag = hashlib.sha256(content).hexdigest() if content is not None else None
+        if etag and not self._files.touch(f'blobs/{etag}'):
+            self._files.write(f'blobs/{etag}', content)
+        self._files.write(self._ref_name(key), json.dumps({'etag': etag, 'content_type': content_type}).encode())
+        return Preview(content, etag, content_type)
@@ -0,0 +1,188 @@
+"""The storage providers behind one interface.
+
+Routes and transfers work with a provider name and get_provider(name): the
+Drive- and Graph-specific URLs, payload shapes and upload protocols sit in
+the two classes here, which wrap the existing code in listings.py,
+transfer.py, async_transfer.py and batch.py.
+
+Every operation takes the user's access token and answers as the underlying
+code does: list raises ListingError, read and write raise TransferError,
+stat returns None for a file that can't be read, and delete returns the
+provider's status code.
+"""
+import re
+
+import async_transfer
+from batch import google_batch_delete, graph_batch_delete
+from changes import GOOGLE_FILE_FIELDS
+from clients import get_async_client, get_client
+from listings import fetch_page, iter_pages
+from preview_cache import PREVIEW_SIZES
+from transfer import GOOGLE_API_URL, GRAPH_API_URL, open_source, upload_to_google, upload_to_onedrive
+
+
+def _auth(access_token):
+    return {'Authorization': f'Bearer {access_token}'}
+
+
+class StorageProvider:
+    name = None
+    # As logs and responses name the drive, and as sign-in errors name the account
+    display_name = None
+    sign_in_name = None
+    # Metadata a transfer needs from its source: name, size and content type
+    transfer_fields = ('name', 'size')
+    # Query parameters for a full metadata lookup
+    stat_params = None
+
+    def __init__(self, api_url):
+        self.api_url = api_url
+
+    @property
+    def http(self):
+        return get_client(self.name)
+
+    @property
+    def async_http(self):
+        return get_async_client(self.name)
+
+    def item_url(self, file_id):
+        raise NotImplementedError
+
+    def content_url(self, file_id):
+        raise NotImplementedError
+
+    def content_type(self, metadata):
+        """The file's MIME type from its metadata, or None."""
+        raise NotImplementedError
+
+    def list(self, access_token, fields=None, page_size=None, cursor=None):
+        """One page of the root folder: (body, items, next_cursor)."""
+        return fetch_page(self.name, access_token, GOOGLE_FILE_FIELDS, fields, page_size, cursor)
+
+    def list_all(self, access_token, fields=None):
+        """Yield the items of every page of the root folder."""
+        return iter_pages(self.name, access_token, GOOGLE_FILE_FIELDS, fields)
+
+    def stat(self, access_token, file_id):
+        response = self.http.get(self.item_url(file_id), params=self.stat_params, headers=_auth(access_token))
+        return response.json() if response.status_code == 200 else None
+
+    async def stat_async(self, access_token, file_id):
+        response = await self.async_http.get(self.item_url(file_id), params=self.stat_params,
+                                             headers=_auth(access_token))
+        return response.json() if response.status_code == 200 else None
+
+    def read(self, access_token, file_id):
+        """A streaming response with the file's content; the caller must close it."""
+        return open_source(self.name, self.content_url(file_id), _auth(access_token))
+
+    async def read_async(self, access_token, file_id):
+        return await async_transfer.open_source(self.name, self.content_url(file_id), _auth(access_token))
+
+    def write(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+              progress=None, parent_id=None):
+        """Upload a ChunkStream as a new file and return its metadata."""
+        raise NotImplementedError
+
+    async def write_async(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                          progress=None, parent_id=None):
+        """Upload an async chunk iterator (async_transfer.iter_chunks) as a new file and return its metadata."""
+        raise NotImplementedError
+
+    def delete(self, access_token, file_id):
+        return self.http.delete(self.item_url(file_id), headers=_auth(access_token)).status_code
+
+    async def delete_async(self, access_token, file_id):
+        return (await self.async_http.delete(self.item_url(file_id), headers=_auth(access_token))).status_code
+
+    def delete_many(self, access_token, file_ids, max_workers=4):
+        """Delete files through the batch endpoint; a result dict per file."""
+        raise NotImplementedError
+
+    def thumbnail(self, access_token, file_id, size):
+        """The thumbnail response for a PREVIEW_SIZES size, or None if the file has no thumbnail."""
+        raise NotImplementedError
+
+
+class GoogleDrive(StorageProvider):
+    name = 'google'
+    display_name = 'Google Drive'
+    sign_in_name = 'Google'
+    transfer_fields = ('name', 'size', 'mimeType')
+    stat_params = {'fields': GOOGLE_FILE_FIELDS}
+
+    def item_url(self, file_id):
+        return f'{self.api_url}/drive/v3/files/{file_id}'
+
+    def content_url(self, file_id):
+        return f'{self.item_url(file_id)}?alt=media'
+
+    def content_type(self, metadata):
+        return metadata.get('mimeType')
+
+    def write(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+              progress=None, parent_id=None):
+        return upload_to_google(chunks, file_name, total_size, access_token, content_type, api_url=self.api_url,
+                                progress=progress, parent_id=parent_id)
+
+    async def write_async(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                          progress=None, parent_id=None):
+        return await async_transfer.upload_to_google(chunks, file_name, total_size, access_token, content_type,
+                                                     api_url=self.api_url, progress=progress, parent_id=parent_id)
+
+    def delete_many(self, access_token, file_ids, max_workers=4):
+        return google_batch_delete(file_ids, access_token, max_workers=max_workers, api_url=self.api_url)
+
+    def thumbnail(self, access_token, file_id, size):
+        response = self.http.get(self.item_url(file_id), params={'fields': 'thumbnailLink'},
+                                 headers=_auth(access_token))
+        if response.status_code != 200:
+            return response
+        link = response.json().get('thumbnailLink')
+        if not link:
+            return None
+        # thumbnailLink ends in a size (=s220); ask for the one wanted instead
+        return self.http.get(f"{re.sub(r'=s[0-9]+$', '', link)}=s{PREVIEW_SIZES[size]}",
+                             headers=_auth(access_token))
+
+
+class OneDrive(StorageProvider):
+    name = 'onedrive'
+    display_name = 'OneDrive'
+    sign_in_name = 'OneDrive'
+
+    def item_url(self, file_id):
+        return f'{self.api_url}/me/drive/items/{file_id}'
+
+    def content_url(self, file_id):
+        return f'{self.item_url(file_id)}/content'
+
+    def content_type(self, metadata):
+        return (metadata.get('file') or {}).get('mimeType')
+
+    def write(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+              progress=None, parent_id=None):
+        # Small files go up in one request, larger ones through an upload session
+        return upload_to_onedrive(chunks, file_name, total_size, access_token, content_type, api_url=self.api_url,
+                                  progress=progress, parent_id=parent_id)
+
+    async def write_async(self, chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                          progress=None, parent_id=None):
+        return await async_transfer.upload_to_onedrive(chunks, file_name, total_size, access_token, content_type,
+                                                       api_url=self.api_url, progress=progress, parent_id=parent_id)
+
+    def delete_many(self, access_token, file_ids, max_workers=4):
+        return graph_batch_delete(file_ids, access_token, max_workers=max_workers, api_url=self.api_url)
+
+    def thumbnail(self, access_token, file_id, size):
+        response = self.http.get(f'{self.item_url(file_id)}/thumbnails/0/{size}/content',
+                                 headers=_auth(access_token))
+        return None if response.status_code == 404 else response
+
+
+STORAGE_PROVIDERS = {provider.name: provider for provider in (GoogleDrive(GOOGLE_API_URL), OneDrive(GRAPH_API_URL))}
+
+
+def get_provider(name):
+    return STORAGE_PROVIDERS[name]
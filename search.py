@@ -0,0 +1,154 @@
+"""Full-text search over the local file index.
+
+Two external-content FTS5 tables shadow indexed_file, kept in step by
+triggers:
+
+- file_search tokenizes name, path and mime type into words, with prefix
+  indexes, for word and word-prefix queries ("ann rep" finds
+  "/Reports/Annual Report.pdf") and for names starting with a phrase.
+- file_search_trigram indexes names by trigram, for matches anywhere inside a
+  word ("port" finds "Report.pdf").
+
+Ranking (bm25) and explicit sorts have to visit every match, so a query that
+matches more than rank_limit rows is returned in index order instead; the
+caller reports that the results are unsorted. The matches of a query, with
+its filters, are collected once as rowids; ranking and sorting then only look
+at those rows rather than running the join again.
+"""
+import json
+
+import sqlalchemy as sa
+
+MIN_TRIGRAM_LENGTH = 3
+
+SEARCH_TABLES = {
+    'file_search': """CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(
+        name, path, mime_type, content='indexed_file', content_rowid='rowid',
+        tokenize="unicode61 remove_diacritics 2", prefix='1 2 3')""",
+    'file_search_trigram': """CREATE VIRTUAL TABLE IF NOT EXISTS file_search_trigram USING fts5(
+        name, content='indexed_file', content_rowid='rowid', tokenize='trigram')""",
+}
+
+SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS indexed_file_search_insert AFTER INSERT ON indexed_file BEGIN
+        INSERT INTO file_search(rowid, name, path, mime_type) VALUES (new.rowid, new.name, new.path, new.mime_type);
+        INSERT INTO file_search_trigram(rowid, name) VALUES (new.rowid, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS indexed_file_search_delete AFTER DELETE ON indexed_file BEGIN
+        INSERT INTO file_search(file_search, rowid, name, path, mime_type)
+            VALUES ('delete', old.rowid, old.name, old.path, old.mime_type);
+        INSERT INTO file_search_trigram(file_search_trigram, rowid, name) VALUES ('delete', old.rowid, old.name);
+    END""",
+    # Re-crawls upsert every row; only touch the FTS indexes when a searched column changed
+    """CREATE TRIGGER IF NOT EXISTS indexed_file_search_update AFTER UPDATE OF name, path, mime_type ON indexed_file
+    WHEN old.name IS NOT new.name OR old.path IS NOT new.path OR old.mime_type IS NOT new.mime_type BEGIN
+        INSERT INTO file_search(file_search, rowid, name, path, mime_type)
+            VALUES ('delete', old.rowid, old.name, old.path, old.mime_type);
+        INSERT INTO file_search(rowid, name, path, mime_type) VALUES (new.rowid, new.name, new.path, new.mime_type);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS indexed_file_search_rename AFTER UPDATE OF name ON indexed_file
+    WHEN old.name IS NOT new.name BEGIN
+        INSERT INTO file_search_trigram(file_search_trigram, rowid, name) VALUES ('delete', old.rowid, old.name);
+        INSERT INTO file_search_trigram(rowid, name) VALUES (new.rowid, new.name);
+    END""",
+)
+
+word_table = sa.table('file_search', sa.column('rowid'), sa.column('name'), sa.column('path'),
+                      sa.column('mime_type'))
+trigram_table = sa.table('file_search_trigram', sa.column('rowid'), sa.column('name'))
+
+SEARCH_MODES = ('words', 'prefix', 'substring')
+
+
+def install_search_index(connection):
+    """Create the FTS tables and triggers if missing, filling new tables from existing rows."""
+    for name, statement in SEARCH_TABLES.items():
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).first()
+        connection.exec_driver_sql(statement)
+        if not exists:
+            connection.exec_driver_sql(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+    for statement in SEARCH_TRIGGERS:
+        connection.exec_driver_sql(statement)
+
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _listed(rowids):
+    # One JSON parameter however many rows there are; SQLite caps the number of bound parameters
+    return sa.func.json_each(json.dumps(rowids)).table_valued('key', 'value')
+
+
+class FileSearch:
+    """One search over model rows.
+
+    mode=words matches rows where every query word starts a word in the name,
+    path or mime type; mode=prefix matches names that start with the query;
+    mode=substring matches names containing every query word anywhere. Words
+    shorter than a trigram are checked with LIKE against the names that the
+    longer words matched; a substring query without any falls back to words.
+    """
+
+    def __init__(self, model, term, mode='words'):
+        self.model = model
+        words = term.split()
+        if mode == 'substring' and not any(len(word) >= MIN_TRIGRAM_LENGTH for word in words):
+            mode = 'words'
+        self.mode = mode
+        self.conditions = []
+
+        if mode == 'substring':
+            self.table = trigram_table
+            match = ' AND '.join(_phrase(word) for word in words if len(word) >= MIN_TRIGRAM_LENGTH)
+            for word in words:
+                if len(word) < MIN_TRIGRAM_LENGTH:
+                    escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    self.conditions.append(self.table.c.name.like(f'%{escaped}%', escape='\\'))
+            self.rank = sa.func.bm25(sa.literal_column(self.table.name))
+        else:
+            self.table = word_table
+            if mode == 'prefix':
+                match = 'name : ^ ' + _phrase(' '.join(words)) + '*'
+            else:
+                match = ' AND '.join(_phrase(word) + '*' for word in words)
+            # A hit in the name counts for more than one in the path
+            self.rank = sa.func.bm25(sa.literal_column(self.table.name), 10.0, 2.0, 1.0)
+        self.conditions.insert(0, sa.literal_column(self.table.name).op('MATCH')(match))
+
+    def matches(self, query, limit):
+        """rowids of the rows a select() query returns, with its filters, stopping after limit + 1."""
+        return query.with_only_columns(self._rowid()).order_by(None).limit(limit + 1)
+
+    def ranked(self, rowids):
+        """The given rowids of matching rows, best match first."""
+        # The + keeps FTS5 from running the MATCH once per listed rowid; it scans its matches once instead
+        listed = sa.literal_column(f'+{self.table.name}.rowid').in_(sa.select(_listed(rowids).c.value))
+        return sa.select(self.table.c.rowid).where(self.conditions[0], listed).order_by(
+            self.rank, self.table.c.rowid)
+
+    def rows(self, rowids, order_by=None):
+        """The model rows with these rowids, sorted by order_by or else in the order given."""
+        listed = _listed(rowids)
+        if order_by:
+            return sa.select(self.model).where(self._rowid().in_(sa.select(listed.c.value))).order_by(*order_by)
+        return sa.select(self.model).join(listed, listed.c.value == self._rowid()).order_by(listed.c.key)
+
+    def select(self, user_id):
+        """The user's rows matching the text.
+
+        The unary + on user_id stops SQLite from walking all of the user's rows
+        through a (user_id, ...) index and running the MATCH once per row; the
+        FTS table drives the join instead.
+        """
+        owner = sa.literal_column(f'+{self.model.__tablename__}.user_id')
+        return sa.select(self.model).join(self.table, self.table.c.rowid == self._rowid()).where(
+            *self.conditions, owner == user_id)
+
+    def index_order(self):
+        # FTS5 walks its rowids in this order without sorting, so a LIMIT stops early
+        return self.table.c.rowid.desc()
+
+    def _rowid(self):
+        return sa.literal_column(f'{self.model.__tablename__}.rowid')
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import, so point it at scratch storage first
+WORKDIR = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ['JWT_SECRET_KEY'] = 'test-secret-key-that-is-long-enough-for-hs256'
+os.environ['PREVIEW_CACHE_DIR'] = os.path.join(WORKDIR, 'previews')
+os.environ['CONTENT_CACHE_DIR'] = os.path.join(WORKDIR, 'content')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as cloud  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """A fresh schema, with the search and sync indexes, inside an app context."""
+    with cloud.app.app_context():
+        cloud.db.drop_all()
+        cloud.db.create_all()
+        with cloud.db.engine.begin() as connection:
+            cloud.install_search_index(connection)
+            cloud.install_sync_indexes(connection)
+        cloud.user_cache._users.clear()
+        yield cloud.db
+        cloud.db.session.remove()
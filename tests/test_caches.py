@@ -0,0 +1,92 @@
+import os
+
+import metadata_cache
+from changes import ChangeFeedError
+from content_cache import ContentCache
+from disk_cache import DiskCache
+from metadata_cache import MetadataCache
+
+
+def test_disk_cache_evicts_least_recently_used_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.write('a', b'aaaa')
+    cache.write('b', b'bbbb')
+    assert cache.touch('a')
+    cache.write('c', b'cccc')
+    assert cache.read('b') is None
+    assert cache.read('a') == b'aaaa'
+    assert cache.size == 8
+    assert not os.path.exists(cache.path('b'))
+
+
+def test_disk_cache_recency_survives_a_restart(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=12)
+    for n, name in enumerate(('old/a', 'old/b', 'new/c')):
+        cache.write(name, b'1234')
+        os.utime(cache.path(name), (1000 + n, 1000 + n))
+    os.utime(cache.path('old/a'), (2000, 2000))
+    reloaded = DiskCache(str(tmp_path), max_bytes=8)
+    assert reloaded.size == 8
+    assert reloaded.read('old/b') is None
+    assert reloaded.read('old/a') == b'1234'
+
+
+def test_content_cache_keeps_only_complete_downloads(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=100, max_file_size=10)
+    fill = cache.fill('google', 'f1', 'r1', 6)
+    fill.write(b'abc')
+    fill.commit()
+    assert cache.get('google', 'f1', 'r1') is None
+    fill = cache.fill('google', 'f1', 'r1', 6)
+    fill.write(b'abc')
+    fill.write(b'def')
+    fill.commit()
+    with open(cache.get('google', 'f1', 'r1'), 'rb') as file:
+        assert file.read() == b'abcdef'
+    # Another revision is another entry
+    assert cache.get('google', 'f1', 'r2') is None
+
+
+def test_content_cache_skips_large_and_duplicate_fills(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=100, max_file_size=10)
+    assert cache.fill('onedrive', 'f1', 'r1', 11) is None
+    assert cache.fill('onedrive', 'f1', 'r1', None) is None
+    fill = cache.fill('onedrive', 'f2', 'r1', 4)
+    assert cache.fill('onedrive', 'f2', 'r1', 4) is None
+    fill.discard()
+    assert cache.fill('onedrive', 'f2', 'r1', 4) is not None
+
+
+def test_metadata_cache_is_bounded():
+    cache = MetadataCache(maxsize=3)
+    cache.put_many(1, 'google', [{'id': str(n)} for n in range(5)])
+    assert len(cache._items) == 3
+    assert cache.get(1, 'google', '0') is None
+    assert cache.get(1, 'google', '4') == {'id': '4'}
+
+
+def test_changes_refresh_items_and_drop_the_listing(monkeypatch):
+    cache = MetadataCache(check_interval=0)
+    cache.put_listing(1, 'google', b'[]', [{'id': 'a'}, {'id': 'b'}], 'cursor-1')
+    monkeypatch.setattr(metadata_cache, 'poll_changes', lambda provider, token, cursor: ([], 'cursor-2'))
+    listing = cache.get_listing(1, 'google', 'token')
+    assert listing.cursor == 'cursor-2'
+
+    changes = [('a', None), ('b', {'id': 'b', 'name': 'renamed'})]
+    monkeypatch.setattr(metadata_cache, 'poll_changes', lambda provider, token, cursor: (changes, 'cursor-3'))
+    assert cache.get_listing(1, 'google', 'token') is None
+    assert cache.get(1, 'google', 'a') is None
+    assert cache.get(1, 'google', 'b') == {'id': 'b', 'name': 'renamed'}
+    assert cache.get_listing(1, 'google', 'token') is None
+
+
+def test_failed_change_feed_drops_the_listing(monkeypatch):
+    def poll_changes(provider, token, cursor):
+        raise ChangeFeedError('cursor expired', 410)
+
+    cache = MetadataCache(check_interval=0)
+    cache.put_listing(1, 'onedrive', b'[]', [{'id': 'a'}], 'cursor-1')
+    monkeypatch.setattr(metadata_cache, 'poll_changes', poll_changes)
+    assert cache.get_listing(1, 'onedrive', 'token') is None
+    assert (1, 'onedrive') not in cache._listings
+    assert cache.get(1, 'onedrive', 'a') == {'id': 'a'}
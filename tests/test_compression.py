@@ -0,0 +1,57 @@
+import gzip
+import json
+
+import brotli
+import pytest
+from flask import Flask, request
+
+from compression import EncodedBody, send_encoded
+
+LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+BODY = json.dumps({'files': [{'id': str(n), 'name': f'file {n}.txt'} for n in range(100)]}).encode()
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.get('/files')
+    def files():
+        return app.response_class(mimetype='application/json')
+
+    @app.after_request
+    def encode(response):
+        min_size = int(request.args.get('min_size', 1024))
+        return send_encoded(request, response, EncodedBody(BODY), LEVELS, min_size)
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize('accept, encoding, decode', [
+    ('gzip', 'gzip', gzip.decompress),
+    ('gzip;q=0.5, br', 'br', brotli.decompress),
+])
+def test_body_is_compressed_as_the_client_prefers(client, accept, encoding, decode):
+    response = client.get('/files', headers={'Accept-Encoding': accept})
+    assert response.headers['Content-Encoding'] == encoding
+    assert decode(response.get_data()) == BODY
+    assert response.get_etag() == (f'{EncodedBody(BODY).etag}-{encoding}', False)
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+def test_small_bodies_are_sent_as_they_are(client):
+    response = client.get('/files?min_size=1000000', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == BODY
+    assert response.get_etag() == (EncodedBody(BODY).etag, False)
+
+
+def test_matching_etag_gets_not_modified(client):
+    etag = client.get('/files', headers={'Accept-Encoding': 'br'}).headers['ETag']
+    response = client.get('/files', headers={'Accept-Encoding': 'br', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    # The br copy's ETag doesn't stand for the gzip one
+    response = client.get('/files', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert gzip.decompress(response.get_data()) == BODY
@@ -0,0 +1,126 @@
+import datetime
+import time
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as sa
+
+import drive_sync
+from conftest import cloud
+from drive_sync import SyncAction, SyncScheduler, plan
+
+TOKEN = {'access_token': 'token', 'refresh_token': 'refresh', 'expires_at': time.time() + 3600}
+
+
+class SlowIndexer:
+    """Stands in for a DriveIndexer whose lock is held by a long sync of every user."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.heartbeats = []
+
+    def sync_user(self, user):
+        for _ in range(4):
+            self.heartbeats.append(cloud.db.session.scalar(sa.select(cloud.SyncJob.heartbeat_at)))
+            time.sleep(self.delay)
+
+
+@pytest.fixture
+def sync_job(database):
+    user = cloud.User(email='sync@example.com', google_token=TOKEN, onedrive_token=TOKEN)
+    database.session.add(user)
+    database.session.commit()
+    for provider in drive_sync.PROVIDERS:
+        database.session.add(cloud.IndexSyncState(user_id=user.id, provider=provider,
+                                                  full_synced_at=datetime.datetime.now()))
+    sync = cloud.SyncJob(user_id=user.id, mode='two-way', schedule='0 * * * *')
+    database.session.add(sync)
+    database.session.commit()
+    return sync.id
+
+
+def scheduler(indexer):
+    return SyncScheduler(
+        cloud.app, cloud.db, cloud.SyncJob, cloud.SyncRun, cloud.SyncedFile, cloud.IndexedFile,
+        cloud.IndexSyncState, indexer, None, lambda user_id: cloud.db.session.get(cloud.User, user_id),
+        lambda user, provider: 'token', None, None)
+
+
+def test_run_heartbeats_while_waiting_for_the_indexer(sync_job, monkeypatch):
+    monkeypatch.setattr(drive_sync, 'HEARTBEAT_INTERVAL', 0.05)
+    indexer = SlowIndexer(delay=0.1)
+    scheduler(indexer).run(sync_job)
+    # The claim stayed fresh, so no other process could take the run over
+    assert len(set(indexer.heartbeats)) > 1
+    run = cloud.SyncRun.query.filter_by(sync_id=sync_job).one()
+    assert run.status == 'completed'
+
+
+def row(file_id, content_hash, modified_time=None):
+    return SimpleNamespace(file_id=file_id, size=10, content_hash=content_hash, modified_time=modified_time)
+
+
+def synced():
+    """The baseline a run left for a path synced as g1 and o1, each hashing to its own ID."""
+    return SimpleNamespace(google_id='g1', onedrive_id='o1', size=10, google_hash='g1', onedrive_hash='o1')
+
+
+def different(a, b):
+    return False
+
+
+def two_way(rows, entry, conflict_policy='newer', propagate_deletes=False, same_content=different):
+    return plan('two-way', conflict_policy, propagate_deletes, '/a.txt', rows, entry, same_content)
+
+
+def test_plan_copies_a_new_file_and_leaves_unchanged_ones():
+    assert two_way({'google': row('g1', 'g1'), 'onedrive': None}, None) == \
+        SyncAction('copy', '/a.txt', 'google', 'onedrive')
+    assert two_way({'google': row('g1', 'g1'), 'onedrive': row('o1', 'o1')}, synced()) is None
+
+
+def test_plan_copies_the_changed_side():
+    rows = {'google': row('g1', 'g1'), 'onedrive': row('o1', 'o2')}
+    assert two_way(rows, synced()) == SyncAction('copy', '/a.txt', 'onedrive', 'google')
+
+
+@pytest.mark.parametrize('conflict_policy, expected', [
+    ('newer', SyncAction('copy', '/a.txt', 'onedrive', 'google', conflict=True)),
+    ('google', SyncAction('copy', '/a.txt', 'google', 'onedrive', conflict=True)),
+    ('skip', SyncAction('conflict', '/a.txt')),
+])
+def test_plan_resolves_conflicts_by_policy(conflict_policy, expected):
+    earlier, later = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 2)
+    rows = {'google': row('g1', 'g2', earlier), 'onedrive': row('o1', 'o2', later)}
+    assert two_way(rows, synced(), conflict_policy) == expected
+
+
+def test_plan_records_sides_that_changed_to_the_same_content():
+    rows = {'google': row('g1', 'g2'), 'onedrive': row('o1', 'o2')}
+    assert two_way(rows, synced(), same_content=lambda google, onedrive: True) == SyncAction('record', '/a.txt')
+
+
+def test_plan_propagates_deletes_only_when_asked():
+    rows = {'google': row('g1', 'g1'), 'onedrive': None}
+    assert two_way(rows, synced(), propagate_deletes=True) == \
+        SyncAction('delete', '/a.txt', destination='google')
+    assert two_way(rows, synced()) == SyncAction('copy', '/a.txt', 'google', 'onedrive')
+    # Nor over a change made since the last run
+    rows = {'google': row('g1', 'g2'), 'onedrive': None}
+    assert two_way(rows, synced(), propagate_deletes=True) == SyncAction('copy', '/a.txt', 'google', 'onedrive')
+
+
+def test_plan_forgets_a_path_gone_from_both_sides():
+    assert two_way({'google': None, 'onedrive': None}, synced()) == SyncAction('forget', '/a.txt')
+    assert two_way({'google': None, 'onedrive': None}, None) is None
+
+
+def test_one_way_plan_mirrors_the_source():
+    rows = {'google': row('g1', 'g1'), 'onedrive': row('o1', 'o2')}
+    assert plan('gdrive-to-onedrive', 'onedrive', False, '/a.txt', rows, synced(), different) == \
+        SyncAction('copy', '/a.txt', 'google', 'onedrive')
+    rows = {'google': None, 'onedrive': row('o1', 'o1')}
+    assert plan('gdrive-to-onedrive', 'newer', False, '/a.txt', rows, synced(), different) == \
+        SyncAction('forget', '/a.txt')
+    assert plan('gdrive-to-onedrive', 'newer', True, '/a.txt', rows, synced(), different) == \
+        SyncAction('delete', '/a.txt', destination='onedrive')
@@ -0,0 +1,75 @@
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import cloud
+from jobs import JobProgress, TransferQueue
+
+
+class Runner:
+    """Stands in for run_transfer_job, holding every job until released."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.release = threading.Event()
+
+    def __call__(self, job, progress):
+        self.release.wait(5)
+        if job.file_id in self.fail:
+            raise RuntimeError(f'copy of {job.file_id} failed')
+        return {'id': f'copy-of-{job.file_id}'}
+
+
+@pytest.fixture
+def user_id(database):
+    user = cloud.User(email='jobs@example.com')
+    database.session.add(user)
+    database.session.commit()
+    return user.id
+
+
+def transfer_queue(runner, **kwargs):
+    # Dispatched by hand rather than by start()'s scheduler
+    queue = TransferQueue(cloud.app, cloud.db, cloud.TransferJob, runner, **kwargs)
+    queue._executor = ThreadPoolExecutor(max_workers=queue.workers)
+    return queue
+
+
+def statuses():
+    cloud.db.session.expire_all()
+    return {job.file_id: job.status for job in cloud.TransferJob.query}
+
+
+def test_a_job_is_claimed_once(user_id):
+    queue = transfer_queue(Runner())
+    job, = queue.submit_many(user_id, [('gdrive-to-onedrive', 'a')])
+    assert queue._claim(job.id)
+    # Another process, or a second dispatch, finds it already running
+    assert not queue._claim(job.id)
+
+
+def test_dispatch_respects_provider_limits(user_id):
+    runner = Runner(fail={'b'})
+    queue = transfer_queue(runner, workers=4, provider_limits={'onedrive': 2})
+    queue.submit_many(user_id, [('gdrive-to-onedrive', file_id) for file_id in 'abc'])
+    queue.dispatch()
+    assert statuses() == {'a': 'running', 'b': 'running', 'c': 'queued'}
+    runner.release.set()
+    queue._executor.shutdown(wait=True)
+    assert statuses() == {'a': 'completed', 'b': 'failed', 'c': 'queued'}
+
+
+def test_stale_jobs_are_requeued(user_id):
+    queue = transfer_queue(Runner(), stale_after=60)
+    jobs = queue.submit_many(user_id, [('gdrive-to-onedrive', file_id) for file_id in 'abc'])
+    for job in jobs:
+        queue._claim(job.id)
+    long_ago = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    # a's worker went away; b's is this process, still working; c's reported recently
+    queue.update_job(jobs[0].id, heartbeat_at=long_ago)
+    queue.update_job(jobs[1].id, heartbeat_at=long_ago)
+    queue.active[jobs[1].id] = JobProgress(queue, jobs[1].id)
+    queue._requeue_stale()
+    assert statuses() == {'a': 'queued', 'b': 'running', 'c': 'running'}
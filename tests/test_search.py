@@ -0,0 +1,96 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from flask_jwt_extended import create_access_token
+
+from conftest import cloud
+from search import FileSearch
+
+
+def add_file(user_id, file_id, name, size=100, folder=''):
+    cloud.db.session.add(cloud.IndexedFile(
+        user_id=user_id, provider='google', file_id=file_id, name=name, size=size, path=f'{folder}/{name}',
+        content_hash=f'hash-{file_id}', indexed_at=datetime.datetime.now()))
+
+
+@pytest.fixture
+def users(database):
+    owner, other = cloud.User(email='owner@example.com'), cloud.User(email='other@example.com')
+    database.session.add_all([owner, other])
+    database.session.commit()
+    add_file(owner.id, 'o1', 'report 2024.pdf', size=10)
+    add_file(owner.id, 'o2', 'report draft.docx', size=5000)
+    for n in range(5):
+        add_file(other.id, f'x{n}', f'report {n}.txt')
+    database.session.commit()
+    return {user.email: create_access_token(identity=str(user.id)) for user in (owner, other)}
+
+
+def search(token, **params):
+    # A context of its own, as in production, so g (and the user cached in it) isn't shared between requests
+    with cloud.app.app_context():
+        response = cloud.app.test_client().get('/search', query_string=params,
+                                               headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_matches_only_count_the_requesting_users_files(users):
+    body = search(users['owner@example.com'], q='report')
+    assert body['matches'] == 2
+    assert body['more_matches'] is False
+    assert {file['id'] for file in body['files']} == {'o1', 'o2'}
+
+
+def test_matches_count_applies_column_filters(users):
+    body = search(users['owner@example.com'], q='report', min_size=1000)
+    assert body['matches'] == 1
+    assert [file['id'] for file in body['files']] == ['o2']
+
+
+def test_other_users_matches_do_not_turn_off_ranking(users, monkeypatch):
+    monkeypatch.setitem(cloud.app.config, 'SEARCH_RANK_LIMIT', 3)
+    body = search(users['owner@example.com'], q='report')
+    assert body['sorted'] is True
+    body = search(users['other@example.com'], q='report')
+    assert body['sorted'] is False
+    # Counting stops past the limit; the response says there are more
+    assert body['matches'] == 3 and body['more_matches'] is True
+
+
+@pytest.mark.parametrize('mode', ['words', 'prefix', 'substring'])
+def test_full_text_table_drives_the_join(users, mode):
+    search_ = FileSearch(cloud.IndexedFile, 'report', mode)
+    statement = search_.select(1).where(cloud.IndexedFile.provider == 'google')
+    sql = str(statement.compile(dialect=cloud.db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    plan = [row[-1] for row in cloud.db.session.execute(sa.text(f'EXPLAIN QUERY PLAN {sql}'))]
+    # The MATCH runs once, then each hit is fetched by rowid; never a walk of the user's rows
+    assert plan[0].startswith('SCAN file_search')
+    assert 'USING INTEGER PRIMARY KEY (rowid=?)' in plan[1]
+    assert not any('ix_indexed_file' in step for step in plan)
+
+
+def test_results_are_ranked_or_sorted_among_the_matches(users, database):
+    owner = cloud.User.query.filter_by(email='owner@example.com').one()
+    add_file(owner.id, 'o3', 'summary.txt', size=1, folder='/Report')
+    database.session.commit()
+    token = users['owner@example.com']
+    # A hit in the name ranks above one only in the path
+    body = search(token, q='report')
+    assert body['matches'] == 3
+    assert body['files'][-1]['id'] == 'o3'
+    body = search(token, q='report', sort='size')
+    assert [file['id'] for file in body['files']] == ['o2', 'o1', 'o3']
+    body = search(token, q='report', sort='name', limit=1, offset=1)
+    assert [file['id'] for file in body['files']] == ['o2']
+    assert body['next_offset'] == 2
+
+
+def test_ranking_scans_the_matches_once(users):
+    search_ = FileSearch(cloud.IndexedFile, 'report', 'words')
+    statement = search_.ranked([1, 2, 3])
+    sql = str(statement.compile(dialect=cloud.db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    plan = [row[-1] for row in cloud.db.session.execute(sa.text(f'EXPLAIN QUERY PLAN {sql}'))]
+    # INDEX 0:=M would run the MATCH again for every listed rowid
+    assert 'VIRTUAL TABLE INDEX 0:M' in plan[0]
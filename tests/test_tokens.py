@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import cloud
+from tokens import TokenManager, TokenRefreshError
+from users import CachedUser
+
+
+def token(expires_in, access='access'):
+    return {'access_token': access, 'refresh_token': 'refresh', 'expires_at': time.time() + expires_in}
+
+
+def add_user(database, email, google_token):
+    user = cloud.User(email=email, google_token=google_token)
+    database.session.add(user)
+    database.session.commit()
+    return user
+
+
+def manager(refresh, **kwargs):
+    return TokenManager(cloud.app, cloud.db, cloud.User, {'google': refresh}, **kwargs)
+
+
+def test_cache_holds_at_most_maxsize_tokens(database):
+    tokens = manager(lambda refresh_token: token(3600), maxsize=2)
+    for n in range(5):
+        tokens.token(add_user(database, f'user{n}@example.com', token(3600, f'access-{n}')), 'google')
+    assert len(tokens._tokens) == 2
+
+
+def test_failed_refresh_drops_the_cached_token(database):
+    def refresh(refresh_token):
+        raise RuntimeError('invalid_grant')
+
+    tokens = manager(refresh)
+    user = add_user(database, 'expired@example.com', token(-60))
+    with pytest.raises(TokenRefreshError):
+        tokens.token(user, 'google')
+    assert (user.id, 'google') not in tokens._tokens
+    # Nor does the background refresher keep retrying it
+    tokens.refresh_due()
+    assert not tokens._tokens
+
+
+def test_concurrent_callers_share_one_refresh(database):
+    calls = []
+
+    def refresh(refresh_token):
+        calls.append(refresh_token)
+        time.sleep(0.2)
+        return token(3600, f'access-{len(calls)}')
+
+    tokens = manager(refresh)
+    user = CachedUser(add_user(database, 'busy@example.com', token(-60)))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: tokens.token(user, 'google'), range(8)))
+    assert calls == ['refresh']
+    assert {result['access_token'] for result in results} == {'access-1'}
@@ -0,0 +1,90 @@
+import io
+import os
+import sys
+import threading
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+from transfer import (CHUNK_ALIGNMENT, ChunkRing, TransferError, _resume_chunk, file_chunks, onedrive_item_path,
+                      upload_to_google, upload_to_onedrive)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+from mock_cloud import serve  # noqa: E402
+
+
+def test_onedrive_item_path_quotes_the_file_name():
+    assert onedrive_item_path('Q1 #2 100%?.pdf') == 'root:/Q1%20%232%20100%25%3F.pdf:'
+    assert onedrive_item_path('a&b.txt', parent_id='ABC!123') == 'items/ABC!123:/a%26b.txt:'
+
+
+class Policy:
+    """A provider policy that retries every failed chunk at once."""
+
+    def retry_chunk(self, response, attempt):
+        return 0 if response.status_code == 429 else None
+
+    def retry_chunk_error(self, error, attempt):
+        return 0
+
+
+def test_resume_chunk_sends_only_what_the_session_is_missing():
+    sends = []
+
+    def put(data, start):
+        sends.append((start, bytes(data)))
+        if len(sends) == 1:
+            raise httpx.ReadError('connection reset')
+        return httpx.Response(202)
+
+    chunk = memoryview(b'0123456789')
+    response = _resume_chunk('Test', Policy(), chunk, 100, put, lambda: (104, None))
+    assert response.status_code == 202
+    assert sends == [(100, b'0123456789'), (104, b'456789')]
+
+
+def test_resume_chunk_stops_when_the_session_has_the_whole_chunk():
+    def put(data, start):
+        return httpx.Response(429)
+
+    assert _resume_chunk('Test', Policy(), memoryview(b'0123'), 0, put, lambda: (4, None)) is None
+
+
+def test_resume_chunk_fails_when_the_session_lost_earlier_bytes():
+    def put(data, start):
+        raise httpx.ReadError('connection reset')
+
+    with pytest.raises(TransferError):
+        _resume_chunk('Test', Policy(), memoryview(b'0123'), 8, put, lambda: (0, None))
+
+
+@pytest.fixture
+def mock_cloud():
+    # Every third request or so is throttled, with no wait, so chunks are retried
+    server = serve(throttle=0.3, retry_after=0, seed=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def retries(provider):
+    return sum(REGISTRY.get_sample_value('cloud_upstream_retries_total', {'provider': provider, 'reason': reason}) or 0
+               for reason in ('429', 'ReadError'))
+
+
+@pytest.mark.parametrize('provider, upload, api_path', [
+    ('onedrive', upload_to_onedrive, '/v1.0'),
+    ('google', upload_to_google, ''),
+])
+def test_session_upload_survives_throttled_chunks(mock_cloud, provider, upload, api_path):
+    data = os.urandom(CHUNK_ALIGNMENT * 7 // 2)
+    acknowledged = []
+    before = retries(provider)
+    result = upload(file_chunks(io.BytesIO(data), ChunkRing(CHUNK_ALIGNMENT, 3)), 'report 2024.bin', len(data),
+                    'token', api_url=mock_cloud + api_path, progress=acknowledged.append)
+    assert result['size'] == len(data)
+    assert acknowledged[-1] == len(data)
+    assert retries(provider) > before
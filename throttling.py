@@ -0,0 +1,195 @@
+"""Request pacing and retries for provider calls.
+
+Each provider has one ProviderPolicy, shared by its sync and async clients.
+Requests are paced by a token bucket. A throttling response (429, Graph's
+503 and 509 with Retry-After, Drive's 403 rate-limit errors) halves the
+bucket's rate, holds every caller until Retry-After has passed, and the rate
+then climbs back to the configured limit over the recovery period. A burst
+of throttled replies to requests that were already in flight counts as one,
+so the rate steps down gradually instead of collapsing.
+
+Failed requests are retried with jittered exponential backoff, or after
+Retry-After when the provider gives one. A request the provider refused
+without acting on it (throttled, or a connection that never opened) is
+retried whatever its method. Server errors and dropped responses are only
+retried for idempotent methods, since a POST may have taken effect.
+"""
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+from metrics import RETRIES, THROTTLED
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+SERVER_ERRORS = frozenset({500, 502, 503, 504})
+# Errors raised before the request reached the provider
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Drive's 403 reasons that mean slow down, as opposed to permission errors or daily quota
+GOOGLE_RATE_LIMIT_REASONS = frozenset({'rateLimitExceeded', 'userRateLimitExceeded'})
+# Throttled replies within this many seconds of the last rate cut are the same episode
+THROTTLE_EPISODE = 1.0
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP-date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Token bucket whose rate halves on throttling and recovers linearly."""
+
+    def __init__(self, rate, min_rate=1.0, recovery=30.0):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.recovery = recovery
+        self._floor = rate
+        self._throttled_at = None
+        self._paused_until = 0.0
+        self._tokens = max(1.0, rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def rate(self, now=None):
+        """Requests per second allowed now."""
+        if self._throttled_at is None:
+            return self.max_rate
+        now = time.monotonic() if now is None else now
+        progress = (now - self._throttled_at) / self.recovery if self.recovery else 1
+        return min(self.max_rate, self._floor + (self.max_rate - self._floor) * progress)
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate(now)
+            # The bucket doesn't refill while paused
+            start = max(now, self._paused_until)
+            if start > self._updated:
+                self._tokens = min(max(1.0, rate), self._tokens + (start - self._updated) * rate)
+                self._updated = start
+            self._tokens -= 1
+            deficit = -self._tokens / rate if self._tokens < 0 else 0.0
+            return max(0.0, self._updated - now) + deficit
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            if self._throttled_at is None or now - self._throttled_at >= THROTTLE_EPISODE:
+                self._floor = max(self.min_rate, self.rate(now) / 2)
+                self._throttled_at = now
+                logger.warning(f"Throttled; pacing to {self._floor:.1f} requests/s")
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self._tokens = min(self._tokens, 0.0)
+                self._updated = max(self._updated, self._paused_until)
+
+
+class ProviderPolicy:
+    def __init__(self, provider, rate_limit, rate_recovery=30.0, max_retries=5, backoff_base=0.5, backoff_max=60.0):
+        self.provider = provider
+        self.limiter = RateLimiter(rate_limit, recovery=rate_recovery) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def pause(self):
+        """Seconds to wait before sending the next request."""
+        return self.limiter.reserve() if self.limiter else 0.0
+
+    def backoff(self, attempt, retry_after=None):
+        """Delay before retry number attempt (from 1): Retry-After if given, else full-jitter exponential."""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def needs_body(self, response):
+        # Drive says why it refused in the body of a 403
+        return self.provider == 'google' and response.status_code == 403
+
+    def is_throttled(self, response):
+        status = response.status_code
+        if status == 429:
+            return True
+        if status in (503, 509) and 'Retry-After' in response.headers:
+            return True
+        if self.needs_body(response):
+            try:
+                errors = response.json().get('error', {}).get('errors', [])
+            except ValueError:
+                return False
+            return any(error.get('reason') in GOOGLE_RATE_LIMIT_REASONS for error in errors)
+        return False
+
+    def check(self, response):
+        """Note a throttling response; returns (throttled, Retry-After seconds or None)."""
+        if not self.is_throttled(response):
+            return False, None
+        retry_after = self.retry_after(response)
+        self.throttled(retry_after)
+        return True, retry_after
+
+    def throttled(self, retry_after=None):
+        """Slow down after a throttling reply, including one inside a batch response."""
+        THROTTLED.labels(self.provider).inc()
+        if self.limiter:
+            self.limiter.throttled(retry_after)
+
+    def retry_after(self, response):
+        # A Retry-After of hours means a daily quota; wait no longer than the backoff cap and fail then
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        return min(retry_after, self.backoff_max) if retry_after is not None else None
+
+    def retry_response(self, method, response, attempt):
+        """Delay before retrying a request that got this response, or None to return it."""
+        throttled, retry_after = self.check(response)
+        if attempt > self.max_retries:
+            return None
+        if throttled or (response.status_code in SERVER_ERRORS and method in IDEMPOTENT_METHODS):
+            logger.warning(f"{self.provider} {method} returned {response.status_code}; retry {attempt} of "
+                           f"{self.max_retries}")
+            RETRIES.labels(self.provider, str(response.status_code)).inc()
+            return self.backoff(attempt, retry_after)
+        return None
+
+    def retry_error(self, method, error, attempt):
+        """Delay before retrying a request that raised this error, or None to raise it."""
+        if attempt > self.max_retries:
+            return None
+        if isinstance(error, NOT_SENT_ERRORS) or method in IDEMPOTENT_METHODS:
+            logger.warning(f"{self.provider} {method} failed ({type(error).__name__}: {error}); retry {attempt} of "
+                           f"{self.max_retries}")
+            RETRIES.labels(self.provider, type(error).__name__).inc()
+            return self.backoff(attempt)
+        return None
+
+    def retry_chunk(self, response, attempt):
+        """Delay before re-sending an upload chunk after this response, or None if it shouldn't be.
+
+        The client has already noted any throttling, since chunks are sent with retry=False.
+        """
+        if self.is_throttled(response) or response.status_code >= 500:
+            RETRIES.labels(self.provider, str(response.status_code)).inc()
+            return self.backoff(attempt, self.retry_after(response))
+        return None
+
+    def retry_chunk_error(self, error, attempt):
+        """Delay before re-sending an upload chunk whose connection failed."""
+        RETRIES.labels(self.provider, type(error).__name__).inc()
+        return self.backoff(attempt)
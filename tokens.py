@@ -0,0 +1,165 @@
+"""In-memory OAuth tokens with ahead-of-expiry refresh.
+
+Tokens are held per (user, provider) after the first lookup, so a request
+pays a dict lookup for its access token. The cache is bounded and entries
+expire, like the user cache; a token that dropped out is read from the User
+row again. A background job refreshes cached tokens that expire within the
+refresh margin; a request only refreshes inline if it finds a token that is
+about to expire anyway (the job isn't running, or the machine slept).
+Refreshes of one token are single-flight: whoever holds the token's lock
+calls the provider and writes the User row once, and everyone waiting on the
+lock gets the new token.
+
+The User row is re-read before refreshing, so a token another process has
+already refreshed is picked up instead of being refreshed again.
+"""
+import logging
+import threading
+import time
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from cachetools import TTLCache
+
+from metrics import TOKEN_REFRESHES
+
+logger = logging.getLogger(__name__)
+
+# Tokens with less than this many seconds left are refreshed before use
+INLINE_REFRESH_MARGIN = 30
+
+# Refreshes of different tokens sharing a lock just wait for each other
+LOCK_STRIPES = 64
+
+
+class TokenRefreshError(Exception):
+    def __init__(self, provider, message=None):
+        self.provider = provider
+        self.message = message or f"Could not refresh the {provider} token; sign in again"
+        super().__init__(self.message)
+
+
+def fresh_for(token, seconds):
+    """Whether a token is good for at least this many more seconds (tokens without an expiry always are)."""
+    return token.get('expires_at') is None or token['expires_at'] - time.time() >= seconds
+
+
+class TokenManager:
+    def __init__(self, app, db, user_model, refreshers, refresh_margin=300, check_interval=60, maxsize=10000,
+                 ttl=900):
+        self.app = app
+        self.db = db
+        self.user_model = user_model
+        # provider -> callable(refresh_token) returning the new token dict
+        self.refreshers = refreshers
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        # Tokens of users idle past the TTL drop out, and the refresher leaves them alone
+        self._tokens = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._tokens_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._scheduler = None
+
+    def start(self):
+        self._scheduler = BackgroundScheduler(daemon=True)
+        self._scheduler.add_job(self.refresh_due, 'interval', seconds=self.check_interval, id='refresh-tokens',
+                                max_instances=1, coalesce=True)
+        self._scheduler.start()
+        logger.info(f"Token refresher started: tokens refreshed {self.refresh_margin}s before expiry")
+
+    def shutdown(self):
+        if self._scheduler:
+            self._scheduler.shutdown(wait=False)
+
+    def access_token(self, user, provider):
+        return self.token(user, provider)['access_token']
+
+    def token(self, user, provider):
+        """A user's current token for provider, refreshed first if it is about to expire."""
+        key = (user.id, provider)
+        token = self._cached(key)
+        if token is None:
+            token = getattr(user, f'{provider}_token')
+            if not token:
+                raise TokenRefreshError(provider, f"User not authenticated with {provider}")
+            self._cache(key, token)
+        if not fresh_for(token, INLINE_REFRESH_MARGIN):
+            token = self.refresh(user.id, provider)
+        return token
+
+    def store(self, user_id, provider, token):
+        """Use a token just obtained by signing in."""
+        with self._lock(user_id, provider):
+            self._cache((user_id, provider), token)
+
+    def forget(self, user_id, provider=None):
+        with self._tokens_lock:
+            for key in list(self._tokens):
+                if key[0] == user_id and provider in (None, key[1]):
+                    self._tokens.pop(key, None)
+
+    def refresh(self, user_id, provider, margin=INLINE_REFRESH_MARGIN):
+        """Refresh one token unless it already has more than margin seconds left."""
+        key = (user_id, provider)
+        with self._lock(user_id, provider):
+            # Whoever held the lock before us may have refreshed it already
+            token = self._cached(key)
+            if token is not None and fresh_for(token, margin):
+                return token
+            with self.app.app_context():
+                try:
+                    user = self.db.session.get(self.user_model, user_id)
+                    stored = getattr(user, f'{provider}_token') if user else None
+                    if not stored:
+                        self._evict(key)
+                        raise TokenRefreshError(provider, f"User not authenticated with {provider}")
+                    # Another process may have refreshed it
+                    if fresh_for(stored, margin):
+                        self._cache(key, stored)
+                        return stored
+                    if not stored.get('refresh_token'):
+                        self._evict(key)
+                        raise TokenRefreshError(provider)
+                    logger.info(f"Refreshing {provider} token for user {user_id}")
+                    try:
+                        fresh = dict(self.refreshers[provider](stored['refresh_token']))
+                    except Exception as e:
+                        logger.error(f"Refreshing {provider} token for user {user_id} failed: {e}")
+                        TOKEN_REFRESHES.labels(provider, 'failed').inc()
+                        # Not kept for the refresher to retry forever; the next request reads the row again
+                        self._evict(key)
+                        raise TokenRefreshError(provider)
+                    TOKEN_REFRESHES.labels(provider, 'ok').inc()
+                    # Refresh responses don't always repeat the refresh token
+                    fresh.setdefault('refresh_token', stored['refresh_token'])
+                    setattr(user, f'{provider}_token', fresh)
+                    self.db.session.commit()
+                    self._cache(key, fresh)
+                    return fresh
+                finally:
+                    self.db.session.remove()
+
+    def refresh_due(self):
+        """Refresh every cached token that expires within the refresh margin."""
+        with self._tokens_lock:
+            due = [key for key, token in self._tokens.items() if not fresh_for(token, self.refresh_margin)]
+        for user_id, provider in due:
+            try:
+                self.refresh(user_id, provider, margin=self.refresh_margin)
+            except TokenRefreshError:
+                # Already evicted; the next request loads the row again and reports the failure
+                pass
+
+    def _cached(self, key):
+        with self._tokens_lock:
+            return self._tokens.get(key)
+
+    def _cache(self, key, token):
+        with self._tokens_lock:
+            self._tokens[key] = token
+
+    def _evict(self, key):
+        with self._tokens_lock:
+            self._tokens.pop(key, None)
+
+    def _lock(self, user_id, provider):
+        return self._locks[hash((user_id, provider)) % LOCK_STRIPES]
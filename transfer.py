@@ -0,0 +1,519 @@
+"""Streaming cloud-to-cloud transfers and chunked uploads.
+
+The source is read as a stream and packed into a small ring of reusable
+buffers. Each filled buffer is sent to the destination as one upload-session
+chunk, so memory per transfer stays at a few chunks whatever the file size.
+
+Chunks go out on a background thread while the next one is being read, and a
+chunk whose connection drops is resumed from the offset the upload session
+reports instead of restarting the file.
+
+An upload already spooled to disk is memory-mapped instead, and its chunks
+are memoryview slices of the mapping: nothing is copied, and pages are handed
+back to the page cache as soon as their chunk has been sent.
+"""
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import httpx
+
+from clients import get_client
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_URL = 'https://graph.microsoft.com/v1.0'
+GOOGLE_API_URL = 'https://www.googleapis.com'
+
+# OneDrive wants session chunks in multiples of 320 KiB and Google resumable
+# uploads in multiples of 256 KiB; 1280 KiB satisfies both.
+CHUNK_ALIGNMENT = 1280 * 1024
+
+# Size of the pieces pulled off the source before packing into a chunk
+READ_SIZE = 64 * 1024
+
+# Chunk size grows with the file so big files need about this many requests
+TARGET_CHUNKS = 32
+
+# Attempts per chunk when the connection drops or the provider errors
+UPLOAD_ATTEMPTS = 5
+
+# Fields Drive returns for an uploaded file; md5Checksum lets the caller verify the copy
+UPLOAD_RESULT_FIELDS = 'kind,id,name,mimeType,size,md5Checksum,modifiedTime,parents'
+
+# Chunk progress is logged at most once per this many seconds per upload
+CHUNK_LOG_INTERVAL = 10.0
+
+
+class LogSampler:
+    """Rate-limits a log line that would otherwise be written for every chunk."""
+
+    def __init__(self, interval=CHUNK_LOG_INTERVAL):
+        self.interval = interval
+        self._next = 0.0
+
+    def due(self):
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        return True
+
+
+class TransferError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def choose_chunk_size(total_size, minimum=CHUNK_ALIGNMENT, maximum=4 * CHUNK_ALIGNMENT):
+    """Pick an aligned chunk size between minimum and maximum for a file."""
+    if not total_size:
+        return minimum
+    wanted = -(-total_size // TARGET_CHUNKS)
+    aligned = -(-wanted // CHUNK_ALIGNMENT) * CHUNK_ALIGNMENT
+    return max(minimum, min(aligned, maximum))
+
+
+class ChunkRing:
+    """Fixed set of reusable chunk buffers handed out round-robin."""
+
+    def __init__(self, chunk_size, slots=3):
+        if chunk_size % CHUNK_ALIGNMENT:
+            raise ValueError(f"chunk_size must be a multiple of {CHUNK_ALIGNMENT} bytes")
+        if slots < 2:
+            raise ValueError("a chunk ring needs at least two buffers")
+        self.chunk_size = chunk_size
+        self._buffers = [bytearray(chunk_size) for _ in range(slots)]
+        self._next = 0
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def next_buffer(self):
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+        return memoryview(buffer)
+
+
+def iter_chunks(pieces, ring):
+    """Pack an iterable of byte strings into ring buffers.
+
+    Yields memoryviews over full buffers (the last one may be short). A
+    yielded view is overwritten once len(ring) more chunks have been pulled,
+    so consumers must be done with it by then.
+    """
+    view = ring.next_buffer()
+    filled = 0
+    for piece in pieces:
+        piece = memoryview(piece)
+        offset = 0
+        while offset < len(piece):
+            count = min(len(piece) - offset, len(view) - filled)
+            view[filled:filled + count] = piece[offset:offset + count]
+            filled += count
+            offset += count
+            if filled == len(view):
+                yield view
+                view = ring.next_buffer()
+                filled = 0
+    if filled:
+        yield view[:filled]
+
+
+class ChunkStream:
+    """A byte source read as ring-buffer chunks."""
+
+    def __init__(self, pieces, ring, on_close=None, hasher=None):
+        self.ring = ring
+        self._pieces = pieces
+        self._on_close = on_close
+        # Sees every chunk, in order, before it is handed to the uploader
+        self.hasher = hasher
+
+    @property
+    def chunk_size(self):
+        return self.ring.chunk_size
+
+    @property
+    def max_in_flight(self):
+        # Chunks that may still be sending while the next one is read
+        return len(self.ring) - 1
+
+    def __iter__(self):
+        try:
+            for chunk in iter_chunks(self._pieces, self.ring):
+                if self.hasher:
+                    self.hasher.update(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+
+class MappedChunks:
+    """A file on disk read as chunk-sized memoryviews of a read-only mapping.
+
+    Behaves like a ChunkStream over a ring of window buffers: once window more
+    chunks have been pulled, an earlier chunk is done with and its pages are
+    dropped from this process's resident set.
+    """
+
+    def __init__(self, file, chunk_size, window=3, hasher=None):
+        if chunk_size % mmap.PAGESIZE:
+            raise ValueError(f"chunk_size must be a multiple of {mmap.PAGESIZE} bytes")
+        self.chunk_size = chunk_size
+        self.window = window
+        self.hasher = hasher
+        file.flush()
+        size = os.fstat(file.fileno()).st_size
+        # An empty file can't be mapped
+        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    @property
+    def max_in_flight(self):
+        return self.window - 1
+
+    def __iter__(self):
+        try:
+            if self._map is None:
+                return
+            view = memoryview(self._map)
+            for offset in range(0, len(view), self.chunk_size):
+                self._release(offset - self.window * self.chunk_size)
+                chunk = view[offset:offset + self.chunk_size]
+                if self.hasher:
+                    self.hasher.update(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def _release(self, offset):
+        if offset >= 0 and hasattr(mmap, 'MADV_DONTNEED'):
+            self._map.madvise(mmap.MADV_DONTNEED, offset, min(self.chunk_size, len(self._map) - offset))
+
+    def close(self):
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            # A chunk is still referenced; the mapping goes when the last view does
+            pass
+        self._map = None
+
+
+class MemoryBudget:
+    """Bytes of chunk buffers that concurrent uploads may hold between them."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._available = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        """Hold size bytes of the budget, waiting until they are free."""
+        # One upload larger than the whole budget still runs, alone
+        size = min(size, self.limit)
+        with self._available:
+            if self._used + size > self.limit:
+                logger.info(f"Upload waiting for {size} bytes of the {self.limit} byte memory budget")
+            self._available.wait_for(lambda: self._used + size <= self.limit)
+            self._used += size
+        try:
+            yield
+        finally:
+            with self._available:
+                self._used -= size
+                self._available.notify_all()
+
+
+def open_source(provider, url, headers):
+    """Open a provider content URL for streaming, or raise TransferError."""
+    # Ask for the raw bytes so the sizes we upload match the source
+    response = get_client(provider).get(url, headers={**headers, 'Accept-Encoding': 'identity'}, stream=True)
+    if response.status_code != 200:
+        response.close()
+        raise TransferError("Failed to download source file", response.status_code)
+    return response
+
+
+def source_chunks(response, ring, hasher=None):
+    return ChunkStream(response.iter_raw(chunk_size=READ_SIZE), ring, response.close, hasher)
+
+
+def file_chunks(stream, ring, hasher=None):
+    return ChunkStream(iter(lambda: stream.read(READ_SIZE), b''), ring, hasher=hasher)
+
+
+class ChunkPipeline:
+    """Sends chunks in order on one background thread while the caller reads ahead."""
+
+    def __init__(self, send, max_in_flight):
+        self._send = send
+        self._max_in_flight = max(1, max_in_flight)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chunk-upload')
+        self.last_response = None
+
+    def submit(self, chunk, offset):
+        while len(self._pending) >= self._max_in_flight:
+            self._wait_oldest()
+        self._pending.append(self._executor.submit(self._send, chunk, offset))
+
+    def _wait_oldest(self):
+        response = self._pending.popleft().result()
+        if response is not None:
+            self.last_response = response
+
+    def finish(self):
+        try:
+            while self._pending:
+                self._wait_oldest()
+        finally:
+            self.abort()
+        return self.last_response
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+
+def _resume_chunk(provider, policy, chunk, offset, put, query_offset):
+    """PUT one chunk, resuming from the session's reported offset on failure.
+
+    Failed and throttled chunks are re-sent after the provider policy's
+    backoff (or Retry-After). Returns the last provider response, or None if
+    the session had already received the whole chunk.
+    """
+    end = offset + len(chunk)
+    sent = offset
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            response = put(chunk[sent - offset:], sent)
+            delay = policy.retry_chunk(response, attempt)
+            if delay is None:
+                return response
+            logger.warning(f"{provider} chunk at {sent} failed with {response.status_code} (attempt {attempt})")
+        except httpx.TransportError as e:
+            logger.warning(f"{provider} chunk at {sent} lost connection (attempt {attempt}): {e}")
+            delay = policy.retry_chunk_error(e, attempt)
+        if attempt == UPLOAD_ATTEMPTS:
+            break
+        time.sleep(delay)
+        # Ask the session how much it has, then send only the rest
+        sent, response = query_offset()
+        if response is not None:
+            return response
+        if sent is None or not offset <= sent <= end:
+            raise TransferError(f"{provider} upload session lost the chunk at offset {offset}")
+        if sent == end:
+            return None
+    raise TransferError(f"Failed to upload chunk to {provider}")
+
+
+def onedrive_item_path(file_name, parent_id=None):
+    """Graph path, under /me/drive, of file_name in the folder parent_id or the drive root."""
+    name = quote(file_name)
+    return f'items/{parent_id}:/{name}:' if parent_id else f'root:/{name}:'
+
+
+def upload_to_onedrive(chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                       api_url=GRAPH_API_URL, progress=None, parent_id=None):
+    """Upload a ChunkStream to OneDrive and return the created item.
+
+    The file goes into the folder parent_id, or the drive root. progress, if
+    given, is called with the number of bytes the provider has acknowledged
+    after each chunk.
+    """
+    item_path = onedrive_item_path(file_name, parent_id)
+    if total_size is None:
+        raise TransferError("File size is required for a OneDrive upload session")
+
+    chunk_iter = iter(chunks)
+    first = next(chunk_iter, memoryview(b''))
+
+    # Whole file fits in one chunk: a single simple upload is enough
+    client = get_client('onedrive')
+    if len(first) == total_size:
+        logger.info(f"Using simple upload for small file to OneDrive: {file_name}")
+        headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': content_type,
+                   'Content-Length': str(len(first))}
+        response = client.put(f'{api_url}/me/drive/{item_path}/content', headers=headers, content=first)
+        chunks.close()
+        if response.status_code not in (200, 201):
+            raise TransferError("Failed to upload file to OneDrive", response.status_code)
+        if progress:
+            progress(total_size)
+        return response.json()
+
+    logger.info(f"Using session upload for large file to OneDrive: {file_name} ({len(first)} byte chunks)")
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+    session_response = client.post(f'{api_url}/me/drive/{item_path}/createUploadSession', headers=headers)
+    upload_url = session_response.json().get('uploadUrl') if session_response.is_success else None
+    if not upload_url:
+        chunks.close()
+        raise TransferError("Failed to create upload session for OneDrive", session_response.status_code)
+
+    def put(data, start):
+        # Chunks are retried by _resume_chunk, which first asks the session what it has
+        return client.put(upload_url, content=data, retry=False, headers={
+            'Content-Length': str(len(data)),
+            'Content-Range': f'bytes {start}-{start + len(data) - 1}/{total_size}'
+        })
+
+    def query_offset():
+        # Upload URLs are pre-authenticated; GET reports nextExpectedRanges
+        status = client.get(upload_url)
+        if status.status_code != 200:
+            return None, None
+        ranges = status.json().get('nextExpectedRanges') or []
+        return (int(ranges[0].split('-')[0]) if ranges else None), None
+
+    chunk_log = LogSampler()
+
+    def send(chunk, offset):
+        if chunk_log.due():
+            logger.info(f"Uploading chunk {offset}-{offset + len(chunk) - 1}/{total_size} for file to OneDrive: {file_name}")
+        response = _resume_chunk('OneDrive', client.policy, chunk, offset, put, query_offset)
+        if response is not None and response.status_code not in (200, 201, 202):
+            raise TransferError("Failed to upload chunk to OneDrive", response.status_code)
+        if progress:
+            progress(offset + len(chunk))
+        return response
+
+    pipeline = ChunkPipeline(send, chunks.max_in_flight)
+    offset = 0
+    try:
+        for chunk in _prepend(first, chunk_iter):
+            pipeline.submit(chunk, offset)
+            offset += len(chunk)
+        response = pipeline.finish()
+    except BaseException:
+        pipeline.abort()
+        chunks.close()
+        client.delete(upload_url)
+        raise
+
+    if offset != total_size or response is None or response.status_code not in (200, 201):
+        client.delete(upload_url)
+        raise TransferError("Failed to complete upload to OneDrive",
+                            response.status_code if response is not None else None)
+    return response.json()
+
+
+def upload_to_google(chunks, file_name, total_size, access_token, content_type='application/octet-stream',
+                     api_url=GOOGLE_API_URL, progress=None, parent_id=None):
+    """Upload a ChunkStream to Google Drive and return the created file.
+
+    parent_id and progress are as for upload_to_onedrive.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    metadata = {'name': file_name}
+    if parent_id:
+        metadata['parents'] = [parent_id]
+
+    chunk_iter = iter(chunks)
+    first = next(chunk_iter, memoryview(b''))
+    client = get_client('google')
+
+    # Whole file fits in one chunk: a single multipart request is enough
+    if total_size is not None and len(first) == total_size:
+        files = {
+            'metadata': ('metadata', json.dumps(metadata), 'application/json'),
+            'file': (file_name, bytes(first), content_type)
+        }
+        response = client.post(f'{api_url}/upload/drive/v3/files?uploadType=multipart&fields={UPLOAD_RESULT_FIELDS}', headers=headers, files=files)
+        chunks.close()
+        if response.status_code not in (200, 201):
+            raise TransferError("Failed to upload file to Google Drive", response.status_code)
+        if progress:
+            progress(len(first))
+        return response.json()
+
+    logger.info(f"Using resumable upload for large file to Google Drive: {file_name} ({len(first)} byte chunks)")
+    session_headers = {**headers, 'Content-Type': 'application/json; charset=UTF-8', 'X-Upload-Content-Type': content_type}
+    if total_size is not None:
+        session_headers['X-Upload-Content-Length'] = str(total_size)
+    session_response = client.post(f'{api_url}/upload/drive/v3/files?uploadType=resumable&fields={UPLOAD_RESULT_FIELDS}',
+                                   headers=session_headers, content=json.dumps(metadata))
+    upload_url = session_response.headers.get('Location')
+    if session_response.status_code != 200 or not upload_url:
+        chunks.close()
+        raise TransferError("Failed to create upload session for Google Drive", session_response.status_code)
+
+    # Until the source ends the total may be unknown; a short chunk is always the last
+    state = {'total': '*' if total_size is None else total_size}
+
+    def put(data, start):
+        content_range = f'bytes {start}-{start + len(data) - 1}/{state["total"]}' if len(data) else f'bytes */{state["total"]}'
+        # Chunks are retried by _resume_chunk, which first asks the session what it has
+        return client.put(upload_url, content=data, retry=False, headers={
+            'Content-Length': str(len(data)),
+            'Content-Range': content_range
+        })
+
+    def query_offset():
+        # An empty PUT reports how much the session has stored
+        status = client.put(upload_url, content=b'', headers={'Content-Range': f'bytes */{state["total"]}'})
+        if status.status_code in (200, 201):
+            return None, status
+        if status.status_code != 308:
+            return None, None
+        received = status.headers.get('Range')
+        return (int(received.rsplit('-', 1)[1]) + 1 if received else 0), None
+
+    chunk_log = LogSampler()
+
+    def send(chunk, offset):
+        if chunk_log.due():
+            logger.info(f"Uploading chunk {offset}-{offset + len(chunk) - 1}/{state['total']} for file to Google Drive: {file_name}")
+        response = _resume_chunk('Google Drive', client.policy, chunk, offset, put, query_offset)
+        if response is not None and response.status_code not in (200, 201, 308):
+            raise TransferError("Failed to upload chunk to Google Drive", response.status_code)
+        if progress:
+            progress(offset + len(chunk))
+        return response
+
+    pipeline = ChunkPipeline(send, chunks.max_in_flight)
+    offset = 0
+    try:
+        for chunk in _prepend(first, chunk_iter):
+            if len(chunk) < chunks.chunk_size:
+                state['total'] = offset + len(chunk)
+            pipeline.submit(chunk, offset)
+            offset += len(chunk)
+        response = pipeline.finish()
+        if state['total'] == '*':
+            # Source ended on a chunk boundary; close the session with an empty request
+            state['total'] = offset
+            response = send(memoryview(b''), offset)
+    except BaseException:
+        pipeline.abort()
+        chunks.close()
+        raise
+
+    if response is None or response.status_code not in (200, 201):
+        raise TransferError("Failed to complete upload to Google Drive",
+                            response.status_code if response is not None else None)
+    return response.json()
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
@@ -0,0 +1,172 @@
+"""Recursive folder transfers.
+
+copy_tree walks a source folder breadth-first on a small thread pool: each
+task finds or creates the matching destination folder and lists the source
+folder's children, so sibling folders are crawled in parallel. As each folder
+is listed its files are handed back to the caller, which queues them as
+ordinary transfer jobs; copies start while the rest of the tree is still
+being crawled, and the job queue's worker pool bounds how many run at once.
+
+Destination folders are matched by name before being created, so a tree
+transfer that is re-run (or resumed after a restart) fills in the existing
+copy rather than making a second one.
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote
+
+from clients import get_client
+from transfer import GOOGLE_API_URL, GRAPH_API_URL, TransferError
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_FOLDER_MIME = 'application/vnd.google-apps.folder'
+# Docs, Sheets, shortcuts and other Drive-native types have no bytes to download
+GOOGLE_NATIVE_PREFIX = 'application/vnd.google-apps.'
+GOOGLE_CHILD_FIELDS = 'nextPageToken,files(id,name,mimeType,size,md5Checksum)'
+GRAPH_CHILD_SELECT = 'id,name,size,file,folder'
+
+
+def _quoted(value):
+    # String literal for a Drive query
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def google_children(access_token, folder_id, api_url=GOOGLE_API_URL):
+    """All non-trashed children of a Drive folder."""
+    params = {'q': f"{_quoted(folder_id)} in parents and trashed = false",
+              'fields': GOOGLE_CHILD_FIELDS, 'pageSize': 1000}
+    headers = {'Authorization': f'Bearer {access_token}'}
+    items = []
+    while True:
+        response = get_client('google').get(f'{api_url}/drive/v3/files', params=params, headers=headers)
+        if response.status_code != 200:
+            raise TransferError("Failed to list Google Drive folder", response.status_code)
+        body = response.json()
+        items += body.get('files', [])
+        if not body.get('nextPageToken'):
+            return items
+        params['pageToken'] = body['nextPageToken']
+
+
+def graph_children(access_token, folder_id, api_url=GRAPH_API_URL):
+    """All children of a OneDrive folder."""
+    url = f'{api_url}/me/drive/items/{folder_id}/children'
+    params = {'$select': GRAPH_CHILD_SELECT, '$top': 999}
+    headers = {'Authorization': f'Bearer {access_token}'}
+    items = []
+    while url:
+        response = get_client('onedrive').get(url, params=params, headers=headers)
+        if response.status_code != 200:
+            raise TransferError("Failed to list OneDrive folder", response.status_code)
+        body = response.json()
+        items += body.get('value', [])
+        # The nextLink already carries the query
+        url, params = body.get('@odata.nextLink'), None
+    return items
+
+
+def is_folder(provider, item):
+    if provider == 'google':
+        return item.get('mimeType') == GOOGLE_FOLDER_MIME
+    return 'folder' in item
+
+
+def split_children(provider, items):
+    """(folders, files, skipped) among a folder's children."""
+    folders, files, skipped = [], [], []
+    for item in items:
+        if is_folder(provider, item):
+            folders.append(item)
+        elif provider == 'google':
+            if item.get('mimeType', '').startswith(GOOGLE_NATIVE_PREFIX):
+                skipped.append(item)
+            else:
+                files.append(item)
+        elif 'file' in item:
+            files.append(item)
+        else:
+            # OneNote notebooks and other packages
+            skipped.append(item)
+    return folders, files, skipped
+
+
+def google_folder(access_token, name, parent_id, api_url=GOOGLE_API_URL):
+    """The Drive folder called name in parent_id, created if there isn't one."""
+    client = get_client('google')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = client.get(f'{api_url}/drive/v3/files', headers=headers, params={
+        'q': f"name = {_quoted(name)} and {_quoted(parent_id)} in parents "
+             f"and mimeType = '{GOOGLE_FOLDER_MIME}' and trashed = false",
+        'fields': 'files(id,name)', 'pageSize': 1})
+    if response.status_code != 200:
+        raise TransferError("Failed to look up Google Drive folder", response.status_code)
+    existing = response.json().get('files', [])
+    if existing:
+        return existing[0]
+    response = client.post(f'{api_url}/drive/v3/files', headers=headers, params={'fields': 'id,name'},
+                           json={'name': name, 'mimeType': GOOGLE_FOLDER_MIME, 'parents': [parent_id]})
+    if response.status_code not in (200, 201):
+        raise TransferError("Failed to create Google Drive folder", response.status_code)
+    return response.json()
+
+
+def graph_folder(access_token, name, parent_id, api_url=GRAPH_API_URL):
+    """The OneDrive folder called name in parent_id, created if there isn't one."""
+    client = get_client('onedrive')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = client.post(f'{api_url}/me/drive/items/{parent_id}/children', headers=headers, json={
+        'name': name, 'folder': {}, '@microsoft.graph.conflictBehavior': 'fail'})
+    if response.status_code in (200, 201):
+        return response.json()
+    if response.status_code != 409:
+        raise TransferError("Failed to create OneDrive folder", response.status_code)
+    # Already there: use it, unless it is a file
+    response = client.get(f'{api_url}/me/drive/items/{parent_id}:/{quote(name)}', headers=headers)
+    if response.status_code != 200 or 'folder' not in response.json():
+        raise TransferError(f"A file named {name} is in the way of a OneDrive folder", 409)
+    return response.json()
+
+
+LIST_CHILDREN = {'google': google_children, 'onedrive': graph_children}
+MAKE_FOLDER = {'google': google_folder, 'onedrive': graph_folder}
+
+
+def copy_tree(source, destination, tokens, folder, destination_parent_id, on_folder, workers=8):
+    """Recreate the source folder (an item with id and name) under destination_parent_id.
+
+    tokens() returns the current access token for each provider; it and
+    on_folder(destination_folder_id, path, files, skipped) are only called on
+    the calling thread, so both may use the database. Returns the destination
+    copy of the folder and counts of what was found.
+    """
+    summary = {'folders': 0, 'files': 0, 'bytes': 0, 'skipped': 0}
+
+    def visit(source_id, name, parent_id, access_tokens):
+        created = MAKE_FOLDER[destination](access_tokens[destination], name, parent_id)
+        children = LIST_CHILDREN[source](access_tokens[source], source_id)
+        return created, split_children(source, children)
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tree-crawl')
+    try:
+        root = None
+        pending = {executor.submit(visit, folder['id'], folder['name'], destination_parent_id, tokens()): folder['name']}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            access_tokens = tokens()
+            for future in done:
+                path = pending.pop(future)
+                created, (folders, files, skipped) = future.result()
+                root = root or created
+                summary['folders'] += 1
+                summary['files'] += len(files)
+                summary['bytes'] += sum(int(item.get('size') or 0) for item in files)
+                summary['skipped'] += len(skipped)
+                on_folder(created['id'], path, files, skipped)
+                for child in folders:
+                    pending[executor.submit(visit, child['id'], child['name'], created['id'], access_tokens)] = \
+                        f"{path}/{child['name']}"
+        logger.info(f"Crawled {source} folder {folder['name']}: {summary}")
+        return root, summary
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,30 @@
+"""Where multipart uploads are buffered while the request body is parsed.
+
+Werkzeug keeps each uploaded file in a SpooledTemporaryFile, which grows in
+memory up to 500 KB and is only then copied out to disk. Here a file part is
+written straight to a temp file when the request is bigger than
+UPLOAD_SPOOL_THRESHOLD, so the upload routes can map it and send it to the
+provider without ever holding it in memory, and small requests stay in a
+BytesIO.
+"""
+import io
+import tempfile
+
+from flask import Request, current_app
+
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = current_app.config
+        if total_content_length is not None and total_content_length <= config["UPLOAD_SPOOL_THRESHOLD"]:
+            return io.BytesIO()
+        return tempfile.TemporaryFile('w+b', dir=config["UPLOAD_SPOOL_DIR"])
+
+
+def is_spooled(stream):
+    """True if an uploaded file's stream is a real file that can be memory-mapped."""
+    try:
+        stream.fileno()
+    except (AttributeError, OSError):
+        return False
+    return True
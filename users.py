@@ -0,0 +1,62 @@
+"""Resolving the signed-in user of a request.
+
+A request names its user with a JWT (Authorization: Bearer, issued by
+/auth/token) or with the user ID the sign-in routes put in the session. The
+row behind that ID is cached in process as a detached snapshot for a short
+TTL, so most requests find their user without touching the database; the
+sign-in routes evict a user's entry when they change the row. Access tokens
+themselves come from the token manager, which keeps them current.
+"""
+import logging
+import threading
+
+from cachetools import TTLCache
+from flask import session
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+logger = logging.getLogger(__name__)
+
+
+class CachedUser:
+    """The parts of a User row a request needs, usable outside the session that loaded it."""
+    __slots__ = ('id', 'email', 'google_token', 'onedrive_token')
+
+    def __init__(self, row):
+        self.id = row.id
+        self.email = row.email
+        self.google_token = row.google_token
+        self.onedrive_token = row.onedrive_token
+
+
+class UserCache:
+    def __init__(self, db, model, maxsize=10000, ttl=300):
+        self.db = db
+        self.model = model
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """A snapshot of the user's row, or None if there is no such user."""
+        with self._lock:
+            user = self._users.get(user_id)
+        if user is not None:
+            return user
+        row = self.db.session.get(self.model, user_id)
+        if row is None:
+            return None
+        user = CachedUser(row)
+        with self._lock:
+            self._users[user_id] = user
+        return user
+
+    def evict(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+
+def request_user_id():
+    """The user ID a request carries in its JWT or session, or None."""
+    # A malformed or expired token is rejected by flask-jwt-extended's 401 handlers
+    if verify_jwt_in_request(optional=True):
+        return int(get_jwt_identity())
+    return session.get('user_id')